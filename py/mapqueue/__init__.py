@@ -0,0 +1,2 @@
+# backends are imported on first use so importing the package stays fast
+from .registry import create, open, register
@@ -0,0 +1,4 @@
+# python -m mapqueue dump and load snapshots
+from .snapshot import main
+
+main()
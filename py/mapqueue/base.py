@@ -1,17 +1,42 @@
 # Interfaces for Map and Queue
 from collections import namedtuple
-from datetime import datetime, timezone
+from datetime import datetime
+from heapq import merge
 import pickle
-from typing import Optional
+from struct import Struct
+from tempfile import TemporaryFile
+from threading import Event, RLock, Timer
+from time import monotonic_ns, sleep, time_ns
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, Optional, Tuple, TYPE_CHECKING
 from uuid import uuid4, UUID
-from zlib import compress, decompress
+from .codec import Codec, Zlib
+from .metrics import instrument, Sink
+if TYPE_CHECKING:
+    from asyncio import Semaphore  # only for annotations since async maps import asyncio when used
 
-ENDIAN = 'little'
+BATCH = 500  # default number of items per bulk request
 EMPTY = b''  # encoding to represent None
+EARLIEST = -(2 ** 63 - 1)  # bounds of time ranges where -time still fits in 8 bytes
+LATEST = 2 ** 63 - 1
+LIMIT = 8  # default number of concurrent operations for async maps and queues
 NAME = 'mapqueue'
+SEPARATOR = '/'  # between the parts of a string key
 MILLIS = 1000.0
-SIGNED = True
+NANOS = 1000000  # nanoseconds per millisecond
+EPOCH = time_ns() - monotonic_ns()  # unix epoch on the monotonic clock so now() never steps back with the wall clock
+TIMEOUT = 30000  # default milliseconds before an unacknowledged queue value is delivered again
+RETENTION = 3600000  # default milliseconds between compactions of a retention policy
+LAG = 1000  # default milliseconds change streams trail the clock so writes with earlier times land first
+POLL = 100  # default milliseconds between polls of a change stream
+RUN = 100000  # most versions ordered in memory before changes without a change log spill to a temporary file
+CODEC = Zlib()  # default codec for values
 UTF8 = 'utf-8'
+# big endian uuid bytes_le then -time so keys sort by uuid then newest time first
+KEY = Struct('>16sq')
+INT = Struct('>q')
+SPILLED = Struct('>II')  # lengths of the key_bytes and the value of a version spilled to a file
+# version of the stored key encoding where 1 kept -time little endian so versions did not sort by time
+FORMAT = 2
 
 # key to unique identify values in a Map
 Key = namedtuple('Key', [
@@ -22,17 +47,37 @@ Key = namedtuple('Key', [
 
 
 def bytes_key(b: bytes) -> Key:
-    """convert Key to bytes"""
-    return Key(
-        uuid=UUID(bytes_le=b[:16]),
-        time=-bytes_int(b[16:24]),
-        kind=b[24:].decode(UTF8)
-    )
+    """convert bytes or a memoryview to Key without copying the kind"""
+    uuid, time = KEY.unpack_from(b)
+    return Key(UUID(bytes_le=uuid), -time, str(memoryview(b)[KEY.size:], UTF8))
+
+
+def bytes_keys(items: Iterable[bytes]) -> List[Key]:
+    """convert many keys for scans"""
+    unpack = KEY.unpack_from
+    size = KEY.size
+    keys = []
+    for b in items:
+        uuid, time = unpack(b)
+        keys.append(Key(UUID(bytes_le=uuid), -time, str(memoryview(b)[size:], UTF8)))
+    return keys
 
 
 def bytes_int(b: bytes) -> int:
     """convert bytes to int"""
-    return int.from_bytes(bytes=b, byteorder=ENDIAN, signed=SIGNED)
+    return INT.unpack_from(b)[0]
+
+
+def chunks(items: Iterable, size: int = BATCH) -> Iterator[list]:
+    """split items into lists with at most size elements"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def dt_millis(dt: datetime) -> int:
@@ -41,18 +86,30 @@ def dt_millis(dt: datetime) -> int:
 
 
 def key_bytes(key: Key) -> bytes:
-    """"convert Key to bytes with the format uid, -time, key"""
-    return key.uuid.bytes_le + int_bytes(-key.time) + key.kind.encode(UTF8)
+    """convert Key to bytes with the format uuid, -time, kind"""
+    return KEY.pack(key.uuid.bytes_le, -key.time) + key.kind.encode(UTF8)
+
+
+def keys_bytes(keys: Iterable[Key]) -> List[bytes]:
+    """convert many keys for bulk writes"""
+    pack = KEY.pack
+    return [pack(key.uuid.bytes_le, -key.time) + key.kind.encode(UTF8) for key in keys]
+
+
+def key_time(b: bytes) -> int:
+    """time of a key in bytes without decoding the rest"""
+    return -KEY.unpack_from(b)[1]
 
 
 def key_str(key: Key) -> str:
-    """"convert the Key to string with the format uid, -time, key"""
-    return ''.join([key.uuid.hex, str(-key.time), key.kind])
+    """convert the Key to a string with the format uuid/LATEST-time/kind which sorts like key_bytes"""
+    return '{uuid}{separator}{time:016x}{separator}{kind}'.format(
+        uuid=key.uuid.hex, separator=SEPARATOR, time=LATEST - key.time, kind=key.kind)
 
 
 def int_bytes(i: int) -> bytes:
     """convert int to bytes"""
-    return i.to_bytes(length=8, byteorder=ENDIAN, signed=SIGNED)
+    return INT.pack(i)
 
 
 def is_none(value: bytes) -> bool:
@@ -66,16 +123,77 @@ def millis_dt(millis: int) -> datetime:
 
 
 def now() -> int:
-    """return current time as milliseconds since the unix epoch"""
-    return dt_millis(datetime.now(timezone.utc))
+    """return current time as milliseconds since the unix epoch which never goes backwards within a process"""
+    return (monotonic_ns() + EPOCH) // NANOS
+
 
 def str_key(s: str) -> Key:
     """convert string to Key"""
-    return Key(uuid=s[:32], time=s[32:45], kind=s[45:])
+    uuid, time, kind = s.split(SEPARATOR, 2)
+    return Key(uuid=UUID(hex=uuid), time=LATEST - int(time, 16), kind=kind)
+
 
 def get_or_now(time: Optional[int]) -> int:
     return now() if time is None else time
 
+
+def stamp(items: Iterable[Tuple[UUID, str, bytes]], codec: Codec) -> List[Tuple[Key, bytes]]:
+    """keys and encoded values sharing one time where earlier repeats of a uuid are a millisecond older each"""
+    # a uuid may hold one version per time so repeats would collide on the primary key and the last one must win
+    items = list(items)
+    time = now()
+    repeats = {}
+    for uuid, _, _ in items:
+        repeats[uuid] = repeats.get(uuid, 0) + 1
+    versions = []
+    for uuid, kind, value in items:
+        repeats[uuid] -= 1
+        versions.append((
+            Key(kind=kind, uuid=uuid, time=time - repeats[uuid]),
+            EMPTY if is_none(value) else codec.encode(value)
+        ))
+    return versions
+
+
+def change_order(version: Tuple[Key, bytes]) -> Tuple[int, bytes]:
+    """sort key of change streams which order versions by time then uuid"""
+    return version[0].time, version[0].uuid.bytes_le
+
+
+def ordered(versions: Iterable[Tuple[Key, bytes]], run: int = RUN) -> Iterator[Tuple[Key, bytes]]:
+    """versions ordered by time then uuid where runs of at most run versions are sorted and merged from files"""
+    runs = []
+    for chunk in chunks(items=versions, size=run):
+        chunk.sort(key=change_order)
+        runs.append(chunk)
+        if len(runs) > 1:
+            # only the last run stays in memory so memory is bounded however many versions there are
+            runs[-2] = unspill(spill(runs[-2]))
+    return merge(*runs, key=change_order) if len(runs) > 1 else iter(runs[0] if runs else [])
+
+
+def spill(versions: List[Tuple[Key, bytes]]):
+    """temporary file of length prefixed versions rewound to the start"""
+    f = TemporaryFile()
+    for key, value in versions:
+        name = key_bytes(key)
+        f.write(SPILLED.pack(len(name), len(value)) + name + value)
+    f.seek(0)
+    return f
+
+
+def unspill(f) -> Iterator[Tuple[Key, bytes]]:
+    """versions of a spilled file which is closed once read"""
+    with f:
+        while True:
+            header = f.read(SPILLED.size)
+            if not header:
+                return
+            key_size, value_size = SPILLED.unpack(header)
+            record = f.read(key_size + value_size)
+            yield bytes_key(memoryview(record)[:key_size]), record[key_size:]
+
+
 class Context(object):
     """base class for append only map or queue"""
 
@@ -87,6 +205,10 @@ class Context(object):
         """method to close the map or queue and clean up resources"""
         return self
 
+    def flush(self):
+        """method to make pending writes durable before returning"""
+        return self
+
     def __init__(self, config=None):
         """method to initialize the python object and store configuration"""
         self._config = config
@@ -97,12 +219,60 @@ class Context(object):
 
     def __exit__(self, exit_type, exit_value, traceback):
         """cleans up relevant resources using python with statement"""
-        return self.close()
+        self.close()
+
+    def instrument(self, sink: Sink):
+        """send timings, sizes, errors and retries of this map or queue to the sink"""
+        return instrument(self, sink=sink, operations=self._operations, backend=self._backend)
+
+    def _retried(self):
+        """instrument replaces this to count retries after throttling"""
+
+
+class GroupCommit(object):
+    """commits pending writes once rows have built up or millis have passed, whichever comes first"""
+
+    def __init__(self, commit: Callable[[], None], rows: int = 1, millis: int = 0):
+        self.lock = RLock()  # callers hold the lock while using the connection
+        self._commit = commit
+        self._millis = millis
+        self._pending = 0
+        self._rows = rows
+        self._timer = None
+
+    def add(self, rows: int = 1):
+        """record rows written in the open transaction and commit if the group is full"""
+        with self.lock:
+            self._pending += rows
+            if self._pending >= self._rows:
+                self.flush()
+            elif self._timer is None and self._millis > 0:
+                self._timer = Timer(self._millis / MILLIS, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """commit every pending row"""
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pending > 0:
+                self._commit()
+                self._pending = 0
 
 
 class Map(Context):
     """key/value storage where put appends values as new versions and get retrieves the latest value"""
 
+    _operations = ('read', 'update', 'read_many', 'update_many')  # measured by instrument
+    _backend = ('_get', '_put', '_get_many', '_put_many')
+
+    def __init__(self, config=None, codec: Codec = CODEC):
+        """codec compresses values on update and decompresses them on read"""
+        super().__init__(config=config)
+        self._codec = codec
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
         """_get retrieves the compressed value for the key"""
         raise NotImplementedError(
@@ -113,6 +283,92 @@ class Map(Context):
         raise NotImplementedError(
             '_put stores the compressed value for the key')
 
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        """_get_many retrieves the compressed values for the keys in input order"""
+        return [self._get(uuid=uuid, time=time) for uuid in uuids]
+
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        """_put_many stores the compressed values for the keys in input order"""
+        return [self._put(key=key, value=value) for key, value in items]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        """_history yields the compressed versions of the uuid with start <= time <= end newest first"""
+        raise NotImplementedError(
+            '_history yields the compressed versions of the uuid newest first')
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        """_scan yields the compressed versions of the kind or every kind with start <= time <= end"""
+        raise NotImplementedError(
+            '_scan yields the compressed versions in the order the backend stores them')
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        """_list_kind yields the uuids whose latest version at time has the kind and a value"""
+        # without a native index every version of the kind is a candidate
+        seen = set()
+        for key, _ in self._scan(kind=kind, start=EARLIEST, end=time):
+            if key.uuid not in seen:
+                seen.add(key.uuid)
+                latest = next(self._history(uuid=key.uuid, start=EARLIEST, end=time), None)
+                if latest is not None and latest[0].kind == kind and not is_none(latest[1]):
+                    yield key.uuid
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        """_count_kind counts the uuids whose latest version at time has the kind and a value"""
+        return sum(1 for _ in self._list_kind(kind=kind, time=time))
+
+    def _live(self, end: int) -> Iterator[Tuple[Key, bool]]:
+        """_live yields (key, has a value) for versions with time <= end with each uuid together newest first"""
+        for key, value in self._scan(kind=None, start=EARLIEST, end=end):
+            yield key, not is_none(value)
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        """_drop_many deletes every version of each uuid with time <= the paired time and returns how many"""
+        raise NotImplementedError(
+            '_drop_many deletes every version of each uuid at or before the time')
+
+    def _obsolete(self, older_than: int, keep_versions: int) -> Iterator[Tuple[UUID, int]]:
+        """(uuid, time) where the versions at or before time are superseded or deleted before older_than"""
+        uuid, kept, done = None, 0, False
+        for key, live in self._live(end=older_than - 1):
+            if key.uuid != uuid:
+                uuid, kept, done = key.uuid, 0, False
+            if done:
+                continue
+            # a delete in effect at the horizon goes with every version before it
+            if kept >= keep_versions or (kept == 0 and not live):
+                done = True
+                yield uuid, key.time
+            else:
+                kept += 1
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        """_changes yields the compressed versions with start <= time <= end ordered by time then uuid"""
+        # without a native change log every poll scans the map and sorts it in runs of bounded memory
+        return ordered(self._scan(kind=None, start=start, end=end))
+
+    def _watch(self, since: int, lag: int, poll: int, stop: Optional[Event]) -> Iterator[List[Tuple[Key, bytes]]]:
+        """_watch yields batches of compressed versions from since on in time order until stop is set"""
+        start = since
+        while stop is None or not stop.is_set():
+            # versions are only final once every write with an earlier time has committed
+            end = now() - lag
+            if end >= start:
+                yield from chunks(items=self._changes(start=start, end=end))
+                start = end + 1
+            if stop is None:
+                sleep(poll / MILLIS)
+            else:
+                stop.wait(poll / MILLIS)
+
+    def _events(self, since: Optional[int], values: bool, lag: int, poll: int,
+                stop: Optional[Event]) -> Iterator[List[Tuple[Key, Optional[bytes]]]]:
+        """batches of changes with decompressed values or None for deletes and when values is False"""
+        for versions in self._watch(since=get_or_now(since), lag=lag, poll=poll, stop=stop):
+            yield [
+                (key, None if not values or is_none(value) else self._codec.decode(value))
+                for key, value in versions
+            ]
+
     def exists(self, uuid: UUID, time: Optional[int] = None) -> bool:
         """exists returns True if the key has a value besides None or empty bytes in the Map"""
         return self.read(uuid=uuid, time=get_or_now(time)) is not None
@@ -124,23 +380,158 @@ class Map(Context):
     def read(self, uuid: UUID, time: Optional[int] = None) -> Optional[bytes]:
         """read returns the latest value that was valid at the time specified otherwise None"""
         value = self._get(uuid=uuid, time=get_or_now(time))
-        return None if is_none(value) else decompress(value)
+        return None if is_none(value) else self._codec.decode(value)
 
     def update(self, uuid: UUID, kind: str, value: bytes) -> Key:
         """update stores value into map for given kind, uuid and time"""
         return self._put(
             key=Key(kind=kind, uuid=uuid, time=now()),
-            value=EMPTY if is_none(value) else compress(value)
+            value=EMPTY if is_none(value) else self._codec.encode(value)
         )
 
     def delete(self, uuid: UUID) -> Key:
-        """delete the key but adding an empty byte kind and value"""
-        return self.update(uuid=uuid, kind=EMPTY, value=EMPTY)
+        """delete the key by adding a version with an empty kind and value"""
+        return self.update(uuid=uuid, kind='', value=EMPTY)
+
+    def create_many(self, items: Iterable[Tuple[str, bytes]]) -> List[Key]:
+        """create a new uuid for each kind and value pair"""
+        return self.update_many(
+            items=[(uuid4(), kind, value) for kind, value in items]
+        )
+
+    def read_many(self, uuids: Iterable[UUID], time: Optional[int] = None) -> List[Optional[bytes]]:
+        """read_many returns the latest value of every uuid valid at the same time in input order"""
+        values = self._get_many(uuids=list(uuids), time=get_or_now(time))
+        return [None if is_none(value) else self._codec.decode(value) for value in values]
+
+    def update_many(self, items: Iterable[Tuple[UUID, str, bytes]]) -> List[Key]:
+        """update_many stores (uuid, kind, value) items at one time, a repeated uuid earlier, and returns keys in order"""
+        return self._put_many(items=stamp(items=items, codec=self._codec))
+
+    def history(self, uuid: UUID, start: Optional[int] = None,
+                end: Optional[int] = None) -> Iterator[Tuple[Key, Optional[bytes]]]:
+        """history streams every version of the uuid with start <= time <= end from newest to oldest"""
+        for key, value in self._history(
+                uuid=uuid,
+                start=EARLIEST if start is None else start,
+                end=LATEST if end is None else end):
+            yield key, None if is_none(value) else self._codec.decode(value)
+
+    def scan(self, kind: Optional[str] = None, start: Optional[int] = None,
+             end: Optional[int] = None) -> Iterator[Tuple[Key, Optional[bytes]]]:
+        """scan streams every version of the kind, or of every kind when None, with start <= time <= end"""
+        for key, value in self._scan(
+                kind=kind,
+                start=EARLIEST if start is None else start,
+                end=LATEST if end is None else end):
+            yield key, None if is_none(value) else self._codec.decode(value)
+
+    def list_kind(self, kind: str, time: Optional[int] = None) -> Iterator[UUID]:
+        """list_kind streams the uuids which were live with the kind at the time specified"""
+        return self._list_kind(kind=kind, time=get_or_now(time))
+
+    def count_kind(self, kind: str, time: Optional[int] = None) -> int:
+        """count_kind returns how many uuids were live with the kind at the time specified"""
+        return self._count_kind(kind=kind, time=get_or_now(time))
+
+    def watch(self, since: Optional[int] = None, values: bool = True, lag: int = LAG, poll: int = POLL,
+              stop: Optional[Event] = None) -> Iterator[Tuple[Key, Optional[bytes]]]:
+        """watch streams every update and delete with time >= since, or from now, in time order until stop is set"""
+        for events in self._events(since=since, values=values, lag=lag, poll=poll, stop=stop):
+            yield from events
+
+    def compact(self, older_than: int, keep_versions: int = 1, batch: int = BATCH, pause: int = 0) -> int:
+        """delete versions before older_than except the newest keep_versions of each uuid and return how many"""
+        # keep_versions=1 keeps the version in effect at older_than so reads from then on do not change
+        dropped = 0
+        for items in chunks(items=self._obsolete(older_than=older_than, keep_versions=keep_versions), size=batch):
+            dropped += self._drop_many(items=items)
+            if pause > 0:
+                # give live traffic room between batches
+                sleep(pause / MILLIS)
+        return dropped
+
+
+class Retention(object):
+    """compacts a map every millis so versions older than age are kept only as the newest keep_versions of each uuid"""
+
+    def __init__(self, map: Map, age: int, keep_versions: int = 1, millis: int = RETENTION, batch: int = BATCH,
+                 pause: int = 0):
+        self.dropped = 0  # versions deleted since start
+        self._age = age
+        self._batch = batch
+        self._error = None  # first failed compaction which raises from stop
+        self._keep_versions = keep_versions
+        self._lock = RLock()
+        self._map = map
+        self._millis = millis
+        self._pause = pause
+        self._timer = None
+
+    def run(self) -> int:
+        """compact once now and return how many versions were deleted"""
+        with self._lock:
+            dropped = self._map.compact(
+                older_than=now() - self._age,
+                keep_versions=self._keep_versions,
+                batch=self._batch,
+                pause=self._pause
+            )
+            self.dropped += dropped
+            return dropped
+
+    def _tick(self):
+        try:
+            self.run()
+        except Exception as e:
+            self._error = self._error or e
+        with self._lock:
+            if self._timer is not None:
+                self._schedule()
+
+    def _schedule(self):
+        self._timer = Timer(self._millis / MILLIS, self._tick)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def start(self):
+        with self._lock:
+            if self._timer is None:
+                self._schedule()
+        return self
+
+    def stop(self):
+        """cancel the next compaction and raise the first one which failed"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return self
+
+
+class Lease(bytes):
+    """value popped from a queue which other consumers cannot pop until the lease times out"""
+
+    def __new__(cls, value: bytes, id=None):
+        lease = super().__new__(cls, value)
+        lease.id = id  # backend specific handle used by ack
+        return lease
 
 
 class Queue(Context):
     """queue with no ordering guarantees - values are appended to the end but may pop off out of order"""
 
+    _operations = ('add', 'pop', 'ack', 'add_many', 'pop_many')  # measured by instrument
+    _backend = ()
+
+    def __init__(self, config=None, timeout: int = TIMEOUT):
+        """timeout is the milliseconds a popped value stays leased before it is delivered again"""
+        super().__init__(config=config)
+        self._timeout = timeout
+
     def add(self, kind: str, value: bytes) -> bytes:
         """adds value to queue"""
         raise NotImplementedError('add must append a value to the queue')
@@ -149,6 +540,24 @@ class Queue(Context):
         """returns a value from the queue"""
         raise NotImplementedError('pop must return a value from the queue')
 
+    def ack(self, lease: bytes) -> bool:
+        """acknowledge a popped value so it is not delivered again and return False if the lease expired"""
+        return True
+
+    def add_many(self, items: Iterable[Tuple[str, bytes]]) -> List[bytes]:
+        """adds (kind, value) items to queue"""
+        return [self.add(kind=kind, value=value) for kind, value in items]
+
+    def pop_many(self, count: int) -> List[bytes]:
+        """returns up to count values from the queue"""
+        values = []
+        for _ in range(count):
+            try:
+                values.append(self.pop())
+            except IndexError:
+                break
+        return values
+
     def __iter__(self):
         """implement python iterator"""
         return self
@@ -160,18 +569,236 @@ class Queue(Context):
         except Exception as e:
             raise StopIteration(str(e))
 
+
+class AsyncContext(object):
+    """base class for append only map or queue used from asyncio"""
+
+    async def open(self):
+        """method to open the map or queue for reads and writes"""
+        return self
+
+    async def close(self):
+        """method to close the map or queue and clean up resources"""
+        return self
+
+    async def flush(self):
+        """method to make pending writes durable before returning"""
+        return self
+
+    def __init__(self, config=None, limit: int = LIMIT, codec: Codec = CODEC):
+        """limit caps how many operations run at once so one map cannot starve the others"""
+        self._codec = codec
+        self._config = config
+        self._limit = limit
+        self._semaphore = None
+
+    @property
+    def _slot(self) -> 'Semaphore':
+        """semaphore is created lazily so it belongs to the running event loop"""
+        if self._semaphore is None:
+            # asyncio is only imported by processes which use async maps
+            from asyncio import Semaphore
+            self._semaphore = Semaphore(self._limit)
+        return self._semaphore
+
+    async def __aenter__(self):
+        """creates relevant resources using python async with statement"""
+        return await self.open()
+
+    async def __aexit__(self, exit_type, exit_value, traceback):
+        """cleans up relevant resources using python async with statement"""
+        await self.close()
+
+    def instrument(self, sink: Sink):
+        """send timings, sizes, errors and retries of this map or queue to the sink"""
+        return instrument(self, sink=sink, operations=self._operations, backend=self._backend)
+
+    def _retried(self):
+        """instrument replaces this to count retries after throttling"""
+
+
+class AsyncMap(AsyncContext):
+    """asyncio version of Map where put appends values as new versions and get retrieves the latest value"""
+
+    _operations = ('read', 'update', 'read_many', 'update_many')  # measured by instrument
+    _backend = ('_get', '_put', '_get_many', '_put_many')
+
+    async def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        """_get retrieves the compressed value for the key"""
+        raise NotImplementedError(
+            '_get retrieves the compressed value for the key')
+
+    async def _put(self, key: Key, value: bytes) -> Key:
+        """_put stores the compressed value for the key"""
+        raise NotImplementedError(
+            '_put stores the compressed value for the key')
+
+    async def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        """_get_many retrieves the compressed values for the keys in input order"""
+        return [await self._get(uuid=uuid, time=time) for uuid in uuids]
+
+    async def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        """_put_many stores the compressed values for the keys in input order"""
+        return [await self._put(key=key, value=value) for key, value in items]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        """_history is an async generator of the compressed versions of the uuid newest first"""
+        raise NotImplementedError(
+            '_history yields the compressed versions of the uuid newest first')
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        """_scan is an async generator of the compressed versions of the kind or every kind"""
+        raise NotImplementedError(
+            '_scan yields the compressed versions in the order the backend stores them')
+
+    async def _list_kind(self, kind: str, time: int) -> AsyncIterator[UUID]:
+        """_list_kind yields the uuids whose latest version at time has the kind and a value"""
+        seen = set()
+        async for key, _ in self._scan(kind=kind, start=EARLIEST, end=time):
+            if key.uuid not in seen:
+                seen.add(key.uuid)
+                async for latest, value in self._history(uuid=key.uuid, start=EARLIEST, end=time):
+                    if latest.kind == kind and not is_none(value):
+                        yield key.uuid
+                    break
+
+    async def _count_kind(self, kind: str, time: int) -> int:
+        """_count_kind counts the uuids whose latest version at time has the kind and a value"""
+        return len([uuid async for uuid in self._list_kind(kind=kind, time=time)])
+
+    async def exists(self, uuid: UUID, time: Optional[int] = None) -> bool:
+        """exists returns True if the key has a value besides None or empty bytes in the Map"""
+        return await self.read(uuid=uuid, time=get_or_now(time)) is not None
+
+    async def create(self, kind: str, value: bytes) -> Key:
+        """create a new uuid for the kind and value"""
+        return await self.update(uuid=uuid4(), kind=kind, value=value)
+
+    async def read(self, uuid: UUID, time: Optional[int] = None) -> Optional[bytes]:
+        """read returns the latest value that was valid at the time specified otherwise None"""
+        async with self._slot:
+            value = await self._get(uuid=uuid, time=get_or_now(time))
+        return None if is_none(value) else self._codec.decode(value)
+
+    async def update(self, uuid: UUID, kind: str, value: bytes) -> Key:
+        """update stores value into map for given kind, uuid and time"""
+        value = EMPTY if is_none(value) else self._codec.encode(value)
+        async with self._slot:
+            return await self._put(
+                key=Key(kind=kind, uuid=uuid, time=now()),
+                value=value
+            )
+
+    async def delete(self, uuid: UUID) -> Key:
+        """delete the key by adding a version with an empty kind and value"""
+        return await self.update(uuid=uuid, kind='', value=EMPTY)
+
+    async def create_many(self, items: Iterable[Tuple[str, bytes]]) -> List[Key]:
+        """create a new uuid for each kind and value pair"""
+        return await self.update_many(
+            items=[(uuid4(), kind, value) for kind, value in items]
+        )
+
+    async def read_many(self, uuids: Iterable[UUID], time: Optional[int] = None) -> List[Optional[bytes]]:
+        """read_many returns the latest value of every uuid valid at the same time in input order"""
+        async with self._slot:
+            values = await self._get_many(uuids=list(uuids), time=get_or_now(time))
+        return [None if is_none(value) else self._codec.decode(value) for value in values]
+
+    async def update_many(self, items: Iterable[Tuple[UUID, str, bytes]]) -> List[Key]:
+        """update_many stores (uuid, kind, value) items at one time, a repeated uuid earlier, and returns keys in order"""
+        items = stamp(items=items, codec=self._codec)
+        async with self._slot:
+            return await self._put_many(items=items)
+
+    async def history(self, uuid: UUID, start: Optional[int] = None,
+                      end: Optional[int] = None) -> AsyncIterator[Tuple[Key, Optional[bytes]]]:
+        """history streams every version of the uuid with start <= time <= end from newest to oldest"""
+        async for key, value in self._history(
+                uuid=uuid,
+                start=EARLIEST if start is None else start,
+                end=LATEST if end is None else end):
+            yield key, None if is_none(value) else self._codec.decode(value)
+
+    async def scan(self, kind: Optional[str] = None, start: Optional[int] = None,
+                   end: Optional[int] = None) -> AsyncIterator[Tuple[Key, Optional[bytes]]]:
+        """scan streams every version of the kind, or of every kind when None, with start <= time <= end"""
+        async for key, value in self._scan(
+                kind=kind,
+                start=EARLIEST if start is None else start,
+                end=LATEST if end is None else end):
+            yield key, None if is_none(value) else self._codec.decode(value)
+
+    def list_kind(self, kind: str, time: Optional[int] = None) -> AsyncIterator[UUID]:
+        """list_kind streams the uuids which were live with the kind at the time specified"""
+        return self._list_kind(kind=kind, time=get_or_now(time))
+
+    async def count_kind(self, kind: str, time: Optional[int] = None) -> int:
+        """count_kind returns how many uuids were live with the kind at the time specified"""
+        async with self._slot:
+            return await self._count_kind(kind=kind, time=get_or_now(time))
+
+
+class AsyncQueue(AsyncContext):
+    """asyncio version of Queue with no ordering guarantees"""
+
+    _operations = ('add', 'pop', 'ack', 'add_many', 'pop_many')  # measured by instrument
+    _backend = ()
+
+    async def add(self, kind: str, value: bytes) -> bytes:
+        """adds value to queue"""
+        raise NotImplementedError('add must append a value to the queue')
+
+    async def pop(self) -> bytes:
+        """returns a value from the queue"""
+        raise NotImplementedError('pop must return a value from the queue')
+
+    async def ack(self, lease: bytes) -> bool:
+        """acknowledge a popped value so it is not delivered again and return False if the lease expired"""
+        return True
+
+    async def add_many(self, items: Iterable[Tuple[str, bytes]]) -> List[bytes]:
+        """adds (kind, value) items to queue"""
+        return [await self.add(kind=kind, value=value) for kind, value in items]
+
+    async def pop_many(self, count: int) -> List[bytes]:
+        """returns up to count values from the queue"""
+        values = []
+        for _ in range(count):
+            try:
+                values.append(await self.pop())
+            except IndexError:
+                break
+        return values
+
+    def __aiter__(self):
+        """implement python async iterator"""
+        return self
+
+    async def __anext__(self):
+        """implement async for loop syntax"""
+        try:
+            return await self.pop()
+        except Exception as e:
+            raise StopAsyncIteration(str(e))
+
+
 class Pickle(object):
+    """mixin which saves python objects to a Map as pickled values using the map codec"""
+
     _key: Key = None
 
     def save(self, db: Map):
-        value = pickle.dumps(obj=self)
+        """create or update the object and remember its key"""
+        value = pickle.dumps(self)
         if self._key is None:
             self._key = db.create(kind=self.__class__.__name__, value=value)
         else:
-            self._key = db.update(uuid=key.uuid, kind=key.kind, value=value)
+            self._key = db.update(uuid=self._key.uuid, kind=self._key.kind, value=value)
         return self
-    
+
     def read(self, db: Map):
+        """return the latest saved version of the object"""
         if self._key is None:
-            throw ValueError('_key must not be None')
-        return pickle.loads(s=db.read(uuid=self._key.uuid))
+            raise ValueError('_key must not be None')
+        return pickle.loads(db.read(uuid=self._key.uuid))
@@ -0,0 +1,262 @@
+# Benchmark workloads for Map and Queue implementations
+# python -m mapqueue.bench --maps local,sqlite,lmdb --output after.json --compare before.json
+from .base import Key, Map, namedtuple, now, Queue
+from .registry import BACKENDS, load
+from argparse import ArgumentParser
+from bisect import bisect_left
+from itertools import accumulate
+import json
+import os
+import platform
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uuid import UUID
+
+# backends which run offline and those which need a local server or emulator like test.sh starts
+MAPS = {name: backend.map for name, backend in BACKENDS.items() if backend.map is not None}
+QUEUES = {name: backend.queue for name, backend in BACKENDS.items() if backend.queue is not None}
+OFFLINE = ['local', 'sqlite', 'lmdb']
+WORKLOADS = ['write', 'read-latest', 'read-history', 'zipf']
+HISTORY = 10  # versions written per uuid for read-history
+STEP = 1000  # milliseconds between versions for read-history
+WRITES = 0.1  # share of zipf operations which are writes
+ZIPF = 1.1  # skew of the zipf hot key distribution
+
+Result = namedtuple('Result', [
+    'backend',  # name of the map or queue
+    'workload',  # name of the workload
+    'size',  # bytes per value
+    'operations',  # number of timed operations
+    'seconds',  # seconds spent inside the timed operations
+    'throughput',  # operations per second
+    'p50',  # median latency in milliseconds
+    'p95',  # 95th percentile latency in milliseconds
+    'p99'  # 99th percentile latency in milliseconds
+])
+
+
+def backend(path: str, config=None):
+    """create the module:class so only the drivers of benchmarked backends are imported"""
+    return load(path)(config=config)
+
+
+def config(name: str):
+    """configuration for backends that need more than defaults"""
+    if name == 'dynamodb' or name == 's3':
+        from .config import aws
+        return aws(test=True)
+    if name == 'bigtable':
+        from .config import gcp
+        if 'BIGTABLE_EMULATOR_HOST' in os.environ:
+            return gcp(test=True)
+        return gcp(keys=os.environ['GOOGLE_APPLICATION_CREDENTIALS'])
+    return None
+
+
+def percentile(latencies: list, q: float) -> float:
+    """latency in milliseconds at quantile q of sorted latencies in seconds"""
+    return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000.0, 4)
+
+
+def result(name: str, workload: str, size: int, latencies: list) -> Result:
+    seconds = sum(latencies)
+    latencies = sorted(latencies)
+    return Result(
+        backend=name,
+        workload=workload,
+        size=size,
+        operations=len(latencies),
+        seconds=round(seconds, 6),
+        throughput=round(len(latencies) / seconds, 2) if seconds > 0 else 0.0,
+        p50=percentile(latencies, 0.50),
+        p95=percentile(latencies, 0.95),
+        p99=percentile(latencies, 0.99)
+    )
+
+
+def values(rng: Random, size: int, count: int = 16) -> list:
+    """reproducible values which are half random and half zeros so codecs have work to do"""
+    half = size // 2
+    return [rng.getrandbits(half * 8).to_bytes(half, 'little') + bytes(size - half) for _ in range(count)]
+
+
+def zipf(rng: Random, keys: int, operations: int, skew: float = ZIPF) -> list:
+    """indexes into keys where low indexes are hot"""
+    cumulative = list(accumulate(1.0 / (rank ** skew) for rank in range(1, keys + 1)))
+    total = cumulative[-1]
+    return [min(keys - 1, bisect_left(cumulative, rng.random() * total)) for _ in range(operations)]
+
+
+def random_uuid(rng: Random) -> UUID:
+    return UUID(int=rng.getrandbits(128), version=4)
+
+
+def bench_map(db: Map, name: str, workload: str, operations: int, keys: int, size: int, seed: int) -> Result:
+    """run one workload against an open map and time every operation"""
+    rng = Random(seed)
+    samples = values(rng=rng, size=size)
+    latencies = []
+    if workload == 'write':
+        for i in range(operations):
+            uuid = random_uuid(rng)
+            value = samples[i % len(samples)]
+            start = perf_counter()
+            db.update(uuid=uuid, kind=name, value=value)
+            latencies.append(perf_counter() - start)
+        return result(name=name, workload=workload, size=size, latencies=latencies)
+    uuids = [random_uuid(rng) for _ in range(keys)]
+    if workload == 'read-history':
+        time = now() - HISTORY * STEP
+        for version in range(HISTORY):
+            db._put_many(items=[
+                (Key(uuid=uuid, time=time + version * STEP, kind=name), db._codec.encode(samples[version % len(samples)]))
+                for uuid in uuids
+            ])
+    else:
+        db.update_many(items=[(uuid, name, samples[i % len(samples)]) for i, uuid in enumerate(uuids)])
+    db.flush()
+    if workload == 'read-latest':
+        for _ in range(operations):
+            uuid = uuids[rng.randrange(keys)]
+            start = perf_counter()
+            db.read(uuid=uuid)
+            latencies.append(perf_counter() - start)
+    elif workload == 'read-history':
+        for _ in range(operations):
+            uuid = uuids[rng.randrange(keys)]
+            at = time + rng.randrange(HISTORY * STEP)
+            start = perf_counter()
+            db.read(uuid=uuid, time=at)
+            latencies.append(perf_counter() - start)
+    elif workload == 'zipf':
+        for i, index in enumerate(zipf(rng=rng, keys=keys, operations=operations)):
+            write = rng.random() < WRITES
+            start = perf_counter()
+            if write:
+                db.update(uuid=uuids[index], kind=name, value=samples[i % len(samples)])
+            else:
+                db.read(uuid=uuids[index])
+            latencies.append(perf_counter() - start)
+    else:
+        raise ValueError('unknown workload {workload}'.format(workload=workload))
+    return result(name=name, workload=workload, size=size, latencies=latencies)
+
+
+def bench_queue(queue: Queue, name: str, operations: int, size: int, seed: int) -> list:
+    """time adds and then pops with acks"""
+    samples = values(rng=Random(seed), size=size)
+    adds = []
+    for i in range(operations):
+        start = perf_counter()
+        queue.add(kind=name, value=samples[i % len(samples)])
+        adds.append(perf_counter() - start)
+    pops = []
+    for _ in range(operations):
+        start = perf_counter()
+        queue.ack(queue.pop())
+        pops.append(perf_counter() - start)
+    return [
+        result(name=name, workload='queue-add', size=size, latencies=adds),
+        result(name=name, workload='queue-pop', size=size, latencies=pops)
+    ]
+
+
+def run(maps: list = OFFLINE, queues: list = OFFLINE, workloads: list = WORKLOADS,
+        operations: int = 1000, keys: int = 1000, sizes: list = (100,), seed: int = 0) -> list:
+    """run every workload and value size against each backend in a fresh directory"""
+    results = []
+    directory = os.getcwd()
+    for name in maps:
+        for workload in workloads:
+            for size in sizes:
+                with TemporaryDirectory() as temp:
+                    os.chdir(temp)
+                    try:
+                        with backend(MAPS[name], config=config(name)) as db:
+                            results.append(bench_map(
+                                db=db, name=name, workload=workload, operations=operations,
+                                keys=keys, size=size, seed=seed
+                            ))
+                    finally:
+                        os.chdir(directory)
+    for name in queues:
+        for size in sizes:
+            with TemporaryDirectory() as temp:
+                os.chdir(temp)
+                try:
+                    with backend(QUEUES[name]) as queue:
+                        results.extend(bench_queue(
+                            queue=queue, name=name, operations=operations, size=size, seed=seed
+                        ))
+                finally:
+                    os.chdir(directory)
+    return results
+
+
+def save(results: list, path: str, arguments: dict):
+    with open(path, 'w') as f:
+        json.dump({
+            'arguments': arguments,
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'results': [result._asdict() for result in results]
+        }, f, indent=2)
+
+
+def compare(results: list, path: str) -> list:
+    """lines comparing throughput and p99 against a previous run"""
+    with open(path) as f:
+        before = {
+            (old['backend'], old['workload'], old['size']): old
+            for old in json.load(f)['results']
+        }
+    lines = []
+    for new in results:
+        old = before.get((new.backend, new.workload, new.size))
+        if old is None or old['throughput'] == 0 or old['p99'] == 0:
+            continue
+        lines.append('{backend:10} {workload:14} {size:>8} throughput {throughput:+7.1%} p99 {p99:+7.1%}'.format(
+            backend=new.backend,
+            workload=new.workload,
+            size=new.size,
+            throughput=new.throughput / old['throughput'] - 1,
+            p99=new.p99 / old['p99'] - 1
+        ))
+    return lines
+
+
+def main(argv: list = None):
+    parser = ArgumentParser(prog='python -m mapqueue.bench', description='benchmark Map and Queue backends')
+    parser.add_argument('--maps', default=','.join(OFFLINE), help='comma separated from ' + ','.join(sorted(MAPS)))
+    parser.add_argument('--queues', default=','.join(OFFLINE), help='comma separated from ' + ','.join(sorted(QUEUES)))
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='comma separated from ' + ','.join(WORKLOADS))
+    parser.add_argument('--operations', type=int, default=1000, help='timed operations per workload')
+    parser.add_argument('--keys', type=int, default=1000, help='uuids loaded before read workloads')
+    parser.add_argument('--sizes', default='100', help='comma separated value sizes in bytes')
+    parser.add_argument('--seed', type=int, default=0, help='seed for reproducible keys and values')
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--compare', help='print changes against results from a previous run')
+    arguments = parser.parse_args(argv)
+    results = run(
+        maps=[name for name in arguments.maps.split(',') if name],
+        queues=[name for name in arguments.queues.split(',') if name],
+        workloads=[name for name in arguments.workloads.split(',') if name],
+        operations=arguments.operations,
+        keys=arguments.keys,
+        sizes=[int(size) for size in arguments.sizes.split(',')],
+        seed=arguments.seed
+    )
+    for line in results:
+        print('{backend:10} {workload:14} {size:>8} {throughput:>12.1f}/s p50 {p50:.3f}ms p95 {p95:.3f}ms p99 {p99:.3f}ms'.format(
+            **line._asdict()))
+    if arguments.output is not None:
+        save(results=results, path=arguments.output, arguments=vars(arguments))
+    if arguments.compare is not None:
+        for line in compare(results=results, path=arguments.compare):
+            print(line)
+    return results
+
+
+if __name__ == '__main__':
+    main()
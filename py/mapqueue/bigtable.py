@@ -1,12 +1,49 @@
-from .base import Key, Map, Optional, millis_dt, UUID
+from .base import dt_millis, EARLIEST, Iterator, Key, LATEST, List, Map, MILLIS, Optional, millis_dt, Tuple, UTF8, UUID
+from google.cloud.bigtable.batcher import MutationsBatcher
 from google.cloud.bigtable.client import Client
-from google.cloud.bigtable.row_filters import CellsColumnLimitFilter, TimestampRangeFilter, TimestampRange, RowFilterChain
+from google.cloud.bigtable.row_set import RowSet
+from google.cloud.bigtable.row_filters import (CellsColumnLimitFilter, RowFilterChain, StripValueTransformerFilter,
+                                               TimestampRange, TimestampRangeFilter)
+from threading import Lock
 
 FAMILY = 'f'
 COLUMN = b'c'
+KIND = b'k'  # kind of each version in a cell with the same timestamp as its value
+
+
+def latest(time: int) -> RowFilterChain:
+    """filter to the latest cell written at or before time"""
+    return RowFilterChain(
+        filters=[
+            TimestampRangeFilter(range_=TimestampRange(
+                end=millis_dt(time+1))),
+            CellsColumnLimitFilter(num_cells=1)
+        ]
+    )
+
+
+def between(start: int, end: int) -> TimestampRangeFilter:
+    """filter to cells written from start to end inclusive"""
+    return TimestampRangeFilter(range_=TimestampRange(
+        start=None if start == EARLIEST else millis_dt(start),
+        end=None if end == LATEST else millis_dt(end + 1)
+    ))
+
+
+def versions(row, kind: Optional[str]) -> Iterator[Tuple[Key, bytes]]:
+    """versions of a row newest first as cells are"""
+    cells = row.cells[FAMILY]
+    kinds = {cell.timestamp: cell.value.decode(UTF8) for cell in cells.get(KIND, [])}
+    uuid = UUID(bytes_le=row.row_key)
+    for cell in cells.get(COLUMN, []):
+        # rows written before kinds were stored have no kind cells
+        version_kind = kinds.get(cell.timestamp, '')
+        if kind is None or version_kind == kind:
+            yield Key(uuid=uuid, time=dt_millis(cell.timestamp), kind=version_kind), cell.value
 
 
 class BigTableMap(Map):
+    """writes are sent right away with rows=1 or buffered in a mutations batcher and visible once it flushes"""
 
     def open(self):
         self._table = Client(
@@ -14,23 +51,49 @@ class BigTableMap(Map):
             credentials=self._config.credentials,
             admin=True
         ).instance(self._config.instance).table(self._config.table)
-        # maybe add batcher later as an optimization?
-        # self._buffer = self._table.mutations_batcher()
         # ensure table and column are created
         if not self._table.exists():
             self._table.create()
         columns = self._table.list_column_families().keys()
         if FAMILY not in columns:
             self._table.column_family(FAMILY).create()
+        self._lock = Lock()  # the batcher must not be shared between threads
+        self._batcher = self._batch() if self._config.rows > 1 else None
+        return self
+
+    def _batch(self) -> MutationsBatcher:
+        return MutationsBatcher(
+            table=self._table,
+            flush_count=self._config.rows,
+            max_row_bytes=self._config.max_bytes,
+            flush_interval=self._config.millis / MILLIS if self._config.millis else None
+        )
+
+    def flush(self):
+        # closing the batcher raises failed writes which its own flush only keeps for close
+        if self._batcher is not None:
+            with self._lock:
+                batcher, self._batcher = self._batcher, self._batch()
+                batcher.close()
         return self
 
     def close(self):
-        """does bigtable client require cleanup?"""
-        # maybe add batcher later as an optimization?
-        # self._buffer.flush()
+        if self._batcher is not None:
+            with self._lock:
+                batcher, self._batcher = self._batcher, None
+                batcher.close()
         return self
 
-    def _put(self, key: Key, value: bytes) -> Key:
+    def _mutate(self, rows: list):
+        if self._batcher is not None:
+            with self._lock:
+                self._batcher.mutate_rows(rows)
+            return
+        for status in self._table.mutate_rows(rows):
+            if status.code != 0:
+                raise IOError('bigtable write failed with {message}'.format(message=status.message))
+
+    def _row(self, key: Key, value: bytes):
         row = self._table.row(row_key=key.uuid.bytes_le)
         row.set_cell(
             column_family_id=FAMILY,
@@ -38,17 +101,65 @@ class BigTableMap(Map):
             value=value,
             timestamp=millis_dt(key.time)
         )
-        self._table.mutate_rows([row])
+        row.set_cell(
+            column_family_id=FAMILY,
+            column=KIND,
+            value=key.kind.encode(UTF8),
+            timestamp=millis_dt(key.time)
+        )
+        return row
+
+    def _put(self, key: Key, value: bytes) -> Key:
+        self._mutate([self._row(key=key, value=value)])
         return key
 
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        self._mutate([self._row(key=key, value=value) for key, value in items])
+        return [key for key, _ in items]
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        return self._table.read_row(
+        row = self._table.read_row(
             row_key=uuid.bytes_le,
-            filter_=RowFilterChain(
-                filters=[
-                    TimestampRangeFilter(range_=TimestampRange(
-                        end=millis_dt(time+1))),
-                    CellsColumnLimitFilter(num_cells=1)
-                ]
-            )
-        ).cell_value(column_family_id=FAMILY, column=COLUMN)
+            filter_=latest(time=time)
+        )
+        return None if row is None else row.cell_value(
+            column_family_id=FAMILY, column=COLUMN)
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        # one streaming read for every uuid instead of a request per row
+        row_set = RowSet()
+        for uuid in uuids:
+            row_set.add_row_key(uuid.bytes_le)
+        values = {
+            row.row_key: row.cell_value(column_family_id=FAMILY, column=COLUMN)
+            for row in self._table.read_rows(row_set=row_set, filter_=latest(time=time))
+        }
+        return [values.get(uuid.bytes_le) for uuid in uuids]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        row = self._table.read_row(row_key=uuid.bytes_le, filter_=between(start=start, end=end))
+        if row is not None:
+            yield from versions(row=row, kind=None)
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        # read_rows streams rows in row key order
+        for row in self._table.read_rows(filter_=between(start=start, end=end)):
+            yield from versions(row=row, kind=kind)
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        times = {uuid.bytes_le: time for uuid, time in items}
+        row_set = RowSet()
+        for row_key in times:
+            row_set.add_row_key(row_key)
+        # each row has its own time so values are stripped and the cells before it are counted here
+        dropped = 0
+        for row in self._table.read_rows(row_set=row_set, filter_=StripValueTransformerFilter(True)):
+            dropped += sum(
+                dt_millis(cell.timestamp) <= times[row.row_key] for cell in row.cells[FAMILY].get(COLUMN, []))
+        rows = []
+        for row_key, time in times.items():
+            row = self._table.row(row_key=row_key)
+            row.delete_cells(FAMILY, [COLUMN, KIND], time_range=TimestampRange(end=millis_dt(time + 1)))
+            rows.append(row)
+        self._mutate(rows)
+        return dropped
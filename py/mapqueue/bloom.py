@@ -0,0 +1,213 @@
+# Bloom filter in front of any Map so reads of uuids which were never written skip the round trip
+from .base import (BATCH, EARLIEST, Event, Iterator, Key, LAG, LATEST, List, Map, namedtuple, now, Optional, Tuple,
+                   UUID)
+from hashlib import blake2b
+from math import ceil, log
+import os
+from struct import Struct
+from threading import RLock
+
+ITEMS = 1000000  # default uuids the filter is sized for
+RATE = 0.01  # default share of never written uuids which still reach the map
+MAGIC = b'MQB\x01'  # filter format and version at the start of every saved filter
+HEADER = Struct('>4sqIQQ')  # magic, time saved, hashes, bits and uuids added
+
+# counters to confirm how many round trips the filter saves
+Stats = namedtuple('Stats', [
+    'bits',  # size of the filter
+    'hashes',  # bits set per uuid
+    'hits',  # reads passed to the map because the uuid may exist
+    'items',  # uuids added which counts repeats
+    'skips'  # reads answered without the map because the uuid was never written
+])
+
+
+def size(items: int, rate: float) -> Tuple[int, int]:
+    """bits and hashes which keep the false positive rate at items uuids"""
+    bits = max(8, ceil(-items * log(rate) / log(2) ** 2))
+    return bits, max(1, round(bits / items * log(2)))
+
+
+class Bloom(object):
+    """bit array where a uuid which was added always tests True and others test False with probability 1 - rate"""
+
+    def __init__(self, bits: int, hashes: int, data: Optional[bytearray] = None, items: int = 0):
+        self.bits = bits
+        self.hashes = hashes
+        self.items = items
+        self._data = bytearray((bits + 7) // 8) if data is None else data
+        self._lock = RLock()  # setting a bit rewrites its byte so concurrent adds could lose one
+
+    def _positions(self, uuid: UUID) -> Iterator[int]:
+        # uuids from uuid1 share most bytes so they are hashed before double hashing picks the bits
+        digest = blake2b(uuid.bytes, digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    def add(self, uuid: UUID):
+        with self._lock:
+            for position in self._positions(uuid):
+                self._data[position >> 3] |= 1 << (position & 7)
+            self.items += 1
+
+    def __contains__(self, uuid: UUID) -> bool:
+        return all(self._data[position >> 3] & (1 << (position & 7)) for position in self._positions(uuid))
+
+    def save(self, path: str, time: int):
+        """write the filter with the time it is complete up to and replace the old file only once written"""
+        with self._lock:
+            data = HEADER.pack(MAGIC, time, self.hashes, self.bits, self.items) + bytes(self._data)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+
+def load(path: str, bits: int, hashes: int) -> Tuple[Optional[Bloom], int]:
+    """saved filter and the time it is complete up to or None when missing, damaged or sized differently"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, EARLIEST
+    if len(data) != HEADER.size + (bits + 7) // 8:
+        return None, EARLIEST
+    magic, time, saved_hashes, saved_bits, items = HEADER.unpack_from(data)
+    if magic != MAGIC or saved_bits != bits or saved_hashes != hashes:
+        return None, EARLIEST
+    return Bloom(bits=bits, hashes=hashes, data=bytearray(data[HEADER.size:]), items=items), time
+
+
+class FilteredMap(Map):
+    """any Map behind a bloom filter of the uuids written through it where reads of other uuids return None"""
+
+    def __init__(self, map: Map, items: int = ITEMS, rate: float = RATE, path: Optional[str] = None,
+                 refresh: Optional[int] = None):
+        """size for items uuids at the false positive rate and save to path on close so open skips the rebuild"""
+        super().__init__(codec=map._codec)
+        self._map = map
+        self._bits, self._hashes = size(items=items, rate=rate)
+        self._path = path
+        self._refresh = refresh  # milliseconds before a read which would be skipped first adds writes of others
+        self._filter = None
+        self._caught = EARLIEST  # time the last catch up started which the filter is complete up to
+        self._lock = RLock()
+        self._catching = RLock()
+        self._hits = 0
+        self._skips = 0
+
+    def open(self):
+        self._map.open()
+        found, time = (None, EARLIEST) if self._path is None else load(
+            path=self._path, bits=self._bits, hashes=self._hashes)
+        if found is None:
+            self.rebuild()
+        else:
+            self._filter = found
+            # writes made without the filter since it was saved, where lag covers writers with slow clocks
+            self._catch_up(since=time)
+        return self
+
+    def flush(self):
+        self._map.flush()
+        return self
+
+    def close(self):
+        try:
+            self.flush()
+            if self._path is not None:
+                # writes of other processes after the last catch up are added when the filter opens again
+                self._filter.save(path=self._path, time=self._caught)
+        finally:
+            self._map.close()
+        return self
+
+    def rebuild(self):
+        """refill the filter with one pass over every version such as after compaction deleted many uuids"""
+        start = now()
+        bloom = Bloom(bits=self._bits, hashes=self._hashes)
+        for key, _ in self._map._scan(kind=None, start=EARLIEST, end=LATEST):
+            bloom.add(key.uuid)
+        # reads keep using the old filter until the new one holds every uuid
+        self._filter = bloom
+        self._catch_up(since=start)
+        return self
+
+    def stats(self) -> Stats:
+        """current counters where skips are the round trips saved"""
+        with self._lock:
+            return Stats(
+                bits=self._filter.bits,
+                hashes=self._filter.hashes,
+                hits=self._hits,
+                items=self._filter.items,
+                skips=self._skips
+            )
+
+    def _catch_up(self, since: int):
+        """add the uuids of versions written from since on and remember when the catch up started"""
+        start = now()
+        for key, _ in self._map._changes(start=max(EARLIEST, since - LAG), end=LATEST):
+            self._filter.add(key.uuid)
+        self._caught = start
+
+    def _written(self, uuid: UUID) -> bool:
+        """False only for uuids which were never written"""
+        written = uuid in self._filter
+        if not written and self._refresh is not None and now() - self._caught >= self._refresh:
+            # one reader catches up with the writes of other processes while the others wait for it
+            with self._catching:
+                if now() - self._caught >= self._refresh:
+                    self._catch_up(since=self._caught)
+            written = uuid in self._filter
+        with self._lock:
+            if written:
+                self._hits += 1
+            else:
+                self._skips += 1
+        return written
+
+    # uuids are added before the write so a concurrent read never skips a committed value
+
+    def _put(self, key: Key, value: bytes) -> Key:
+        self._filter.add(key.uuid)
+        return self._map._put(key=key, value=value)
+
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        for key, _ in items:
+            self._filter.add(key.uuid)
+        return self._map._put_many(items=items)
+
+    def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        return self._map._get(uuid=uuid, time=time) if self._written(uuid) else None
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        written = [i for i, uuid in enumerate(uuids) if self._written(uuid)]
+        values = [None] * len(uuids)
+        if written:
+            for i, value in zip(written, self._map._get_many(uuids=[uuids[i] for i in written], time=time)):
+                values[i] = value
+        return values
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._map._history(uuid=uuid, start=start, end=end) if self._written(uuid) else iter([])
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._map._scan(kind=kind, start=start, end=end)
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        return self._map._list_kind(kind=kind, time=time)
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        return self._map._count_kind(kind=kind, time=time)
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._map._changes(start=start, end=end)
+
+    def _watch(self, since: int, lag: int, poll: int, stop: Optional[Event]) -> Iterator[List[Tuple[Key, bytes]]]:
+        return self._map._watch(since=since, lag=lag, poll=poll, stop=stop)
+
+    def compact(self, older_than: int, keep_versions: int = 1, batch: int = BATCH, pause: int = 0) -> int:
+        # dropped uuids stay in the filter which only costs a round trip until rebuild
+        return self._map.compact(older_than=older_than, keep_versions=keep_versions, batch=batch, pause=pause)
@@ -0,0 +1,217 @@
+# Read through cache in front of any Map
+from .base import (BATCH, Event, Iterable, Iterator, Key, List, Map, MILLIS, namedtuple, now, Optional, Tuple,
+                   UUID)
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+
+OVERHEAD = 128  # estimated bytes of bookkeeping for each cached entry
+SIZE = 64 * 1024 * 1024  # default cache size in bytes
+TTL = 1000  # default milliseconds latest values are served before the map is asked again
+
+# counters to tune the cache size
+Stats = namedtuple('Stats', [
+    'entries',  # number of cached values
+    'evictions',  # values dropped to stay under the size
+    'hits',  # reads served from the cache
+    'misses',  # reads passed through to the map
+    'size'  # estimated bytes used by the cache
+])
+
+Entry = namedtuple('Entry', [
+    'cost',  # estimated bytes used by the entry
+    'expires',  # monotonic seconds when the entry goes stale or None
+    'value'  # decompressed value or None
+])
+
+
+class CachedMap(Map):
+    """bounded LRU cache of decompressed values in front of any Map where latest values expire after ttl milliseconds"""
+
+    def __init__(self, map: Map, size: int = SIZE, ttl: Optional[int] = TTL):
+        """ttl=None keeps latest values until evicted which is only safe when every write goes through this map"""
+        super().__init__()
+        self._entries = OrderedDict()  # (uuid, time or None) -> Entry
+        self._lock = RLock()
+        self._map = map
+        self._size = size
+        self._ttl = ttl
+        self._times = {}  # uuid -> set of cached times to invalidate
+        self._used = 0
+        self._writes = 0  # values read while a write was in flight are not cached
+        self._evictions = 0
+        self._hits = 0
+        self._misses = 0
+
+    def open(self):
+        self._map.open()
+        return self
+
+    def flush(self):
+        self._map.flush()
+        return self
+
+    def close(self):
+        self._map.close()
+        self.clear()
+        return self
+
+    def clear(self):
+        """drop every cached value"""
+        with self._lock:
+            self._entries.clear()
+            self._times.clear()
+            self._used = 0
+
+    def stats(self) -> Stats:
+        """current counters for tuning size and ttl"""
+        with self._lock:
+            return Stats(
+                entries=len(self._entries),
+                evictions=self._evictions,
+                hits=self._hits,
+                misses=self._misses,
+                size=self._used
+            )
+
+    def _slot(self, uuid: UUID, time: Optional[int]) -> Optional[Tuple[UUID, Optional[int]]]:
+        """cache key for a read or None when the read can change later"""
+        # versions are append only so reads in the past never change
+        if time is None:
+            return (uuid, None)
+        return (uuid, time) if time < now() else None
+
+    def _lookup(self, slot: Tuple[UUID, Optional[int]]) -> Optional[Entry]:
+        with self._lock:
+            entry = self._entries.get(slot)
+            if entry is not None and entry.expires is not None and entry.expires <= monotonic():
+                self._remove(slot)
+                entry = None
+            if entry is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(slot)
+            return entry
+
+    def _store(self, slot: Tuple[UUID, Optional[int]], value: Optional[bytes], writes: int):
+        expires = None if slot[1] is not None or self._ttl is None else monotonic() + self._ttl / MILLIS
+        entry = Entry(
+            cost=OVERHEAD + (0 if value is None else len(value)),
+            expires=expires,
+            value=value
+        )
+        with self._lock:
+            if writes != self._writes or entry.cost > self._size:
+                return
+            self._remove(slot)
+            self._entries[slot] = entry
+            self._times.setdefault(slot[0], set()).add(slot[1])
+            self._used += entry.cost
+            while self._used > self._size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def _remove(self, slot: Tuple[UUID, Optional[int]]):
+        entry = self._entries.pop(slot, None)
+        if entry is not None:
+            self._used -= entry.cost
+            times = self._times[slot[0]]
+            times.discard(slot[1])
+            if not times:
+                del self._times[slot[0]]
+
+    def _invalidate(self, uuids: Iterable[UUID]):
+        with self._lock:
+            self._writes += 1
+            for uuid in uuids:
+                for time in list(self._times.get(uuid, ())):
+                    self._remove((uuid, time))
+
+    def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        return self._map._get(uuid=uuid, time=time)
+
+    def _put(self, key: Key, value: bytes) -> Key:
+        key = self._map._put(key=key, value=value)
+        self._invalidate(uuids=[key.uuid])
+        return key
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        return self._map._get_many(uuids=uuids, time=time)
+
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        keys = self._map._put_many(items=items)
+        self._invalidate(uuids=[key.uuid for key in keys])
+        return keys
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._map._history(uuid=uuid, start=start, end=end)
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._map._scan(kind=kind, start=start, end=end)
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        return self._map._list_kind(kind=kind, time=time)
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        return self._map._count_kind(kind=kind, time=time)
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._map._changes(start=start, end=end)
+
+    def _watch(self, since: int, lag: int, poll: int, stop: Optional[Event]) -> Iterator[List[Tuple[Key, bytes]]]:
+        return self._map._watch(since=since, lag=lag, poll=poll, stop=stop)
+
+    def compact(self, older_than: int, keep_versions: int = 1, batch: int = BATCH, pause: int = 0) -> int:
+        dropped = self._map.compact(older_than=older_than, keep_versions=keep_versions, batch=batch, pause=pause)
+        # cached reads in the past may name versions which are gone
+        self.clear()
+        return dropped
+
+    # history and scan pass through uncached since exports would evict every hot value
+
+    def history(self, uuid: UUID, start: Optional[int] = None,
+                end: Optional[int] = None) -> Iterator[Tuple[Key, Optional[bytes]]]:
+        return self._map.history(uuid=uuid, start=start, end=end)
+
+    def scan(self, kind: Optional[str] = None, start: Optional[int] = None,
+             end: Optional[int] = None) -> Iterator[Tuple[Key, Optional[bytes]]]:
+        return self._map.scan(kind=kind, start=start, end=end)
+
+    def read(self, uuid: UUID, time: Optional[int] = None) -> Optional[bytes]:
+        slot = self._slot(uuid=uuid, time=time)
+        if slot is None:
+            return self._map.read(uuid=uuid, time=time)
+        entry = self._lookup(slot)
+        if entry is not None:
+            return entry.value
+        writes = self._writes
+        value = self._map.read(uuid=uuid, time=time)
+        self._store(slot=slot, value=value, writes=writes)
+        return value
+
+    def read_many(self, uuids: Iterable[UUID], time: Optional[int] = None) -> List[Optional[bytes]]:
+        uuids = list(uuids)
+        if time is not None and time >= now():
+            return self._map.read_many(uuids=uuids, time=time)
+        values = [self._lookup((uuid, time)) for uuid in uuids]
+        missing = [i for i, entry in enumerate(values) if entry is None]
+        values = [None if entry is None else entry.value for entry in values]
+        if missing:
+            writes = self._writes
+            found = self._map.read_many(uuids=[uuids[i] for i in missing], time=time)
+            for i, value in zip(missing, found):
+                values[i] = value
+                self._store(slot=(uuids[i], time), value=value, writes=writes)
+        return values
+
+    def update(self, uuid: UUID, kind: str, value: bytes) -> Key:
+        key = self._map.update(uuid=uuid, kind=kind, value=value)
+        self._invalidate(uuids=[uuid])
+        return key
+
+    def update_many(self, items: Iterable[Tuple[UUID, str, bytes]]) -> List[Key]:
+        keys = self._map.update_many(items=items)
+        self._invalidate(uuids=[key.uuid for key in keys])
+        return keys
@@ -0,0 +1,164 @@
+# Codecs which compress values before they are stored in a Map
+from threading import local
+import zlib
+
+# one byte tag in front of every stored value
+IDENTITY = b'\x00'
+ZLIB = b'\x01'
+LZ4 = b'\x02'
+ZSTD = b'\x03'
+ZSTD_DICT = b'\x04'
+# values written before tags were added are zlib streams which always start with 0x78
+LEGACY = 0x78
+
+
+class Codec(object):
+    """stores values raw with the identity tag and is the base class for compressing codecs"""
+
+    tag = IDENTITY
+
+    def __init__(self, threshold: int = 0):
+        """values shorter than threshold bytes are stored raw"""
+        self._threshold = threshold
+
+    def compress(self, value: bytes) -> bytes:
+        """compress value without a tag"""
+        return value
+
+    def decompress(self, value: bytes) -> bytes:
+        """decompress value without a tag"""
+        return bytes(value)
+
+    def encode(self, value: bytes) -> bytes:
+        """compress value and prefix the tag or store it raw when compression does not help"""
+        if self.tag != IDENTITY and len(value) >= self._threshold:
+            compressed = self.compress(value)
+            if len(compressed) < len(value):
+                return self.tag + compressed
+        return IDENTITY + value
+
+    def decode(self, value: bytes) -> bytes:
+        """decompress a value written by any codec"""
+        tag = bytes(value[:1])
+        if tag == ZSTD_DICT:
+            # the frame names its dictionary so values of any dictionary decode wherever it is registered
+            return dictionary(memoryview(value)[1:]).decompress(memoryview(value)[1:])
+        if tag == self.tag:
+            return self.decompress(memoryview(value)[1:])
+        if tag == IDENTITY:
+            return bytes(value[1:])
+        if value[0] == LEGACY:
+            return zlib.decompress(value)
+        return decoder(tag).decompress(memoryview(value)[1:])
+
+
+class Zlib(Codec):
+    """zlib at a chosen level from 1 (fastest) to 9 (smallest)"""
+
+    tag = ZLIB
+
+    def __init__(self, level: int = zlib.Z_DEFAULT_COMPRESSION, threshold: int = 0):
+        super().__init__(threshold=threshold)
+        self._level = level
+
+    def compress(self, value: bytes) -> bytes:
+        return zlib.compress(value, self._level)
+
+    def decompress(self, value: bytes) -> bytes:
+        return zlib.decompress(value)
+
+
+class Lz4(Codec):
+    """lz4 frames which trade ratio for speed and require the lz4 package"""
+
+    tag = LZ4
+
+    def __init__(self, level: int = 0, threshold: int = 0):
+        from lz4 import frame
+        super().__init__(threshold=threshold)
+        self._frame = frame
+        self._level = level
+
+    def compress(self, value: bytes) -> bytes:
+        return self._frame.compress(value, compression_level=self._level)
+
+    def decompress(self, value: bytes) -> bytes:
+        return self._frame.decompress(value)
+
+
+class Zstd(Codec):
+    """zstandard with an optional trained dictionary for small values and requires the zstandard package"""
+
+    tag = ZSTD
+
+    def __init__(self, level: int = 3, dictionary: bytes = None, threshold: int = 0):
+        """a dictionary is registered by its id so every codec in the process decodes its values"""
+        import zstandard
+        super().__init__(threshold=threshold)
+        self._dictionary = None if dictionary is None else zstandard.ZstdCompressionDict(dictionary)
+        self._level = level
+        self._local = local()  # zstandard contexts must not be shared between threads
+        self._zstandard = zstandard
+        if dictionary is not None:
+            if self._dictionary.dict_id() == 0:
+                raise ValueError('dictionary has no id - train it with Zstd.train')
+            self.tag = ZSTD_DICT
+            DICTIONARIES.setdefault(self._dictionary.dict_id(), self)
+
+    @staticmethod
+    def train(samples: list, size: int = 16384) -> bytes:
+        """train a dictionary of at most size bytes from sample values"""
+        import zstandard
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+    def compress(self, value: bytes) -> bytes:
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = self._zstandard.ZstdCompressor(level=self._level, dict_data=self._dictionary)
+            self._local.compressor = compressor
+        return compressor.compress(value)
+
+    def decompress(self, value: bytes) -> bytes:
+        decompressor = getattr(self._local, 'decompressor', None)
+        if decompressor is None:
+            decompressor = self._zstandard.ZstdDecompressor(dict_data=self._dictionary)
+            self._local.decompressor = decompressor
+        return decompressor.decompress(value)
+
+
+# shared codecs to decode values written by another codec
+DECODERS = {}
+DICTIONARIES = {}  # zstd dictionary id -> codec which decodes values compressed with it
+
+
+def register_dictionary(dictionary: bytes) -> int:
+    """make values compressed with a dictionary readable by every map in this process and return its id"""
+    codec = Zstd(dictionary=dictionary)
+    return codec._dictionary.dict_id()
+
+
+def dictionary(frame: bytes) -> Codec:
+    """return the registered codec for the dictionary named in a zstd frame"""
+    import zstandard
+    dictionary_id = zstandard.get_frame_parameters(frame).dict_id
+    codec = DICTIONARIES.get(dictionary_id)
+    if codec is None:
+        raise ValueError('zstd dictionary {id} is not registered - pass it to register_dictionary first'.format(
+            id=dictionary_id))
+    return codec
+
+
+def decoder(tag: bytes) -> Codec:
+    """return a codec able to decompress values with the tag"""
+    codec = DECODERS.get(tag)
+    if codec is None:
+        if tag == ZLIB:
+            codec = Zlib()
+        elif tag == LZ4:
+            codec = Lz4()
+        elif tag == ZSTD:
+            codec = Zstd()
+        else:
+            raise ValueError('no codec for tag {tag}'.format(tag=tag))
+        DECODERS[tag] = codec
+    return codec
@@ -1,26 +1,46 @@
-from .base import NAME, namedtuple
-import boto3
-from google.oauth2.service_account import Credentials
+from .base import LIMIT, NAME, namedtuple
 import json
 
+# cloud sdks are imported by the functions which need them so local backends start quickly
+
 # amazon web services
 AWS = namedtuple('AWS', [
     'access',  # aws access key
     'bucket',  # s3 bucket
+    'consistent',  # strongly consistent dynamodb reads which cost twice the read capacity
     'dynamodb', # dynamodb client
+    'index',  # maintain a global secondary index on kind for list_kind and count_kind
     'region',  # data center region
+    's3',  # s3 client
     'secret',  # aws secret key
+    'stream',  # enable the dynamodb stream of the table which watch reads instead of scanning
+    'streams',  # dynamodb streams client
     'table'  # dynamodb table name
 ])
 
 
 def aws(access: str = None, secret: str = None,
         bucket: str = NAME, region: str = 'us-east-1', table: str = NAME,
-        test: bool = False) -> AWS:
+        test: bool = False, index: bool = False, consistent: bool = False, stream: bool = False) -> AWS:
+    import boto3
     if test:
         dynamodb = boto3.client(
             'dynamodb',
-            endpoint_url='http://localhost:8000'
+            endpoint_url='http://localhost:8000',
+            region_name=region
+        )
+        # dynamodb local serves streams from the same endpoint
+        streams = boto3.client(
+            'dynamodbstreams',
+            endpoint_url='http://localhost:8000',
+            region_name=region
+        )
+        # create inside moto's mock_aws which answers s3 requests offline
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+            region_name=region
         )
     else:
         dynamodb = boto3.client(
@@ -29,12 +49,29 @@ def aws(access: str = None, secret: str = None,
             aws_secret_access_key=secret,
             region_name=region
         )
+        streams = boto3.client(
+            'dynamodbstreams',
+            aws_access_key_id=access,
+            aws_secret_access_key=secret,
+            region_name=region
+        )
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id=access,
+            aws_secret_access_key=secret,
+            region_name=region
+        )
     return AWS(
         access=access,
         bucket=bucket,
+        consistent=consistent,
         dynamodb=dynamodb,
+        index=index,
         region=region,
+        s3=s3,
         secret=secret,
+        stream=stream,
+        streams=streams,
         table=table
     )
 
@@ -45,19 +82,137 @@ GCP = namedtuple('GCP', [
     'credentials',  # credentials
     'instance',  # bigtable instance
     'keys',  # filename for the service account json
+    'max_bytes',  # send buffered bigtable writes once they reach this many bytes
+    'millis',  # send buffered bigtable writes after this many milliseconds or 0 to wait for rows or bytes
     'project',  # project
+    'rows',  # send buffered bigtable writes once this many rows are waiting
     'table'  # bigtable table
 ])
 
 
-def gcp(keys: str, bucket: str = NAME, instance: str = NAME, table: str = NAME) -> GCP:
-    with open(keys) as f:
-        account = json.loads(f.read())
-        return GCP(
-            bucket=bucket,
-            credentials=Credentials.from_service_account_file(keys),
-            instance=instance,
-            keys=keys,
-            project=account['project_id'],
-            table=table
-        )
+def gcp(keys: str = None, bucket: str = NAME, instance: str = NAME, table: str = NAME,
+        rows: int = 1, millis: int = 1000, max_bytes: int = 20 * 1024 * 1024, test: bool = False) -> GCP:
+    """rows=1 sends every write while larger values buffer writes - test uses the emulator at BIGTABLE_EMULATOR_HOST"""
+    if test:
+        from google.auth.credentials import AnonymousCredentials
+        credentials = AnonymousCredentials()
+        project = 'test'
+    else:
+        from google.oauth2.service_account import Credentials
+        credentials = Credentials.from_service_account_file(keys)
+        with open(keys) as f:
+            project = json.loads(f.read())['project_id']
+    return GCP(
+        bucket=bucket,
+        credentials=credentials,
+        instance=instance,
+        keys=keys,
+        max_bytes=max_bytes,
+        millis=millis,
+        project=project,
+        rows=rows,
+        table=table
+    )
+
+
+# in process map
+LOCAL = namedtuple('LOCAL', [
+    'age',  # milliseconds of history to keep or None to keep everything
+    'index',  # maintain the uuids of each kind for list_kind and count_kind
+    'versions'  # most versions to keep per uuid or None to keep everything
+])
+
+
+def local(age: int = None, versions: int = None, index: bool = False) -> LOCAL:
+    """the version in effect age milliseconds ago is kept so reads up to then stay correct"""
+    return LOCAL(
+        age=age,
+        index=index,
+        versions=versions
+    )
+
+
+# lightning memory mapped database
+MDB = namedtuple('MDB', [
+    'index',  # maintain a sub database of kinds for list_kind and count_kind
+    'map_size',  # largest size in bytes the database may grow to
+    'max_readers',  # most concurrent read transactions across threads and processes
+    'millis',  # commit pending writes after this many milliseconds
+    'path',  # directory of the environment or None for the default
+    'rows',  # commit pending writes after this many rows
+    'sync',  # flush buffers to disk on every commit
+    'writemap'  # write through the memory map which is faster but less crash safe
+])
+
+
+def mdb(path: str = None, map_size: int = 2 ** 30, max_readers: int = 126, rows: int = 1, millis: int = 0,
+        sync: bool = True, writemap: bool = False, index: bool = False) -> MDB:
+    """rows=1 commits every write while larger values enable group commit"""
+    return MDB(
+        index=index,
+        map_size=map_size,
+        max_readers=max_readers,
+        millis=millis,
+        path=path,
+        rows=rows,
+        sync=sync,
+        writemap=writemap
+    )
+
+
+# relational databases
+SQL = namedtuple('SQL', [
+    'changes',  # create an index on time so watch reads the table as a change log
+    'database',  # database name or sqlite filename
+    'host',  # server address or None for the local default
+    'index',  # create an index on kind for list_kind and count_kind
+    'millis',  # commit pending writes after this many milliseconds
+    'password',  # database password
+    'pool',  # most connections shared by the threads using a map
+    'port',  # server port or None for the default
+    'rows',  # commit pending writes after this many rows
+    'synchronous',  # sqlite synchronous pragma such as FULL or NORMAL
+    'user',  # database user
+    'wal'  # sqlite write ahead log journal mode
+])
+
+
+def sql(database: str = None, rows: int = 1, millis: int = 0, pool: int = LIMIT,
+        synchronous: str = None, user: str = None, wal: bool = False, index: bool = False,
+        host: str = None, port: int = None, password: str = None, changes: bool = False) -> SQL:
+    """rows=1 commits every write while larger values enable group commit"""
+    return SQL(
+        changes=changes,
+        database=database,
+        host=host,
+        index=index,
+        millis=millis,
+        password=password,
+        pool=pool,
+        port=port,
+        rows=rows,
+        synchronous=synchronous,
+        user=user,
+        wal=wal
+    )
+
+
+# key value stores such as redis and memcache
+KV = namedtuple('KV', [
+    'changes',  # most redis changes to log for watch or None to scan the map instead
+    'host',  # server address
+    'pool',  # most connections shared by the threads using a map
+    'port',  # server port or None for the default
+    'versions'  # most redis versions to keep per uuid or None to keep everything
+])
+
+
+def kv(host: str = '127.0.0.1', port: int = None, pool: int = LIMIT, versions: int = None,
+       changes: int = None) -> KV:
+    return KV(
+        changes=changes,
+        host=host,
+        pool=pool,
+        port=port,
+        versions=versions
+    )
@@ -1,57 +1,303 @@
-import boto3
-from .base import Key, is_none, Map, Optional, UUID
+from .base import (chunks, EARLIEST, EMPTY, Event, Iterator, Key, is_none, LIMIT, List, Map, MILLIS, now, Optional,
+                   Tuple, UUID)
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from random import random
+from time import sleep
+
+PUT_BATCH = 25  # request limit for batch_write_item
+BACKOFF = 50  # milliseconds before the first retry of unprocessed items
+CAP = 5000  # most milliseconds between retries
+# the latest version at or before :time is the first item of a descending query
+LATEST_QUERY = '#uuid = :uuid AND #time <= :time'
+# uuid, time and value are reserved words in expressions
+LATEST_NAMES = {'#uuid': 'uuid', '#time': 'time', '#value': 'value'}
+KIND_INDEX = 'kind'
+# deletes have no kind attribute so they stay out of the sparse kind index
+KIND = {
+    'IndexName': KIND_INDEX,
+    'KeySchema': [
+        {'AttributeName': 'kind', 'KeyType': 'HASH'},
+        {'AttributeName': 'time', 'KeyType': 'RANGE'}
+    ],
+    'Projection': {'ProjectionType': 'KEYS_ONLY'}
+}
+# stream records carry the item as written so watch never reads the table
+STREAM = {'StreamEnabled': True, 'StreamViewType': 'NEW_IMAGE'}
+RECORDS = 1000  # most records per get_records
+BUILDING = 60000  # milliseconds between checks of a kind index which is still building
+
+
+def item_key(item: dict) -> Key:
+    return Key(
+        uuid=UUID(bytes_le=item['uuid']['B']),
+        time=int(item['time']['N']),
+        kind=item['kind']['S'] if 'kind' in item else ''
+    )
+
+
+def item_version(item: dict) -> Tuple[Key, bytes]:
+    return item_key(item), item['value']['B'] if 'value' in item else EMPTY
+
+
+def backoff(attempt: int):
+    """sleep with full jitter so throttled writers do not retry in lockstep"""
+    sleep(random() * min(CAP, BACKOFF * 2 ** attempt) / MILLIS)
 
 
 class DynamoMap(Map):
 
     def open(self):
         self._db = self._config.dynamodb
-        table_query = self._db.list_tables(
-            ExclusiveStartTableName=self._config.table[:-1],
-            Limit=1
-        )['TableNames']
-        table_exists = len(
-            table_query) == 1 and table_query[0] == self._config.table
+        try:
+            self._db.describe_table(TableName=self._config.table)
+            table_exists = True
+        except self._db.exceptions.ResourceNotFoundException:
+            table_exists = False
+        attributes = [
+            {'AttributeName': 'uuid', 'AttributeType': 'B'},
+            {'AttributeName': 'time', 'AttributeType': 'N'}
+        ]
+        if self._config.index:
+            attributes.append({'AttributeName': 'kind', 'AttributeType': 'S'})
         if not table_exists:
+            indexes = {'GlobalSecondaryIndexes': [KIND]} if self._config.index else {}
+            if self._config.stream:
+                indexes['StreamSpecification'] = STREAM
             self._db.create_table(
                 TableName=self._config.table,
                 KeySchema=[
                     {'AttributeName': 'uuid', 'KeyType': 'HASH'},
                     {'AttributeName': 'time', 'KeyType': 'RANGE'}
                 ],
-                AttributeDefinitions=[
-                    {'AttributeName': 'uuid', 'AttributeType': 'B'},
-                    {'AttributeName': 'time', 'AttributeType': 'N'}
-                ],
-                BillingMode='PAY_PER_REQUEST'
+                AttributeDefinitions=attributes,
+                BillingMode='PAY_PER_REQUEST',
+                **indexes
             )
+            self._db.get_waiter('table_exists').wait(TableName=self._config.table)
+        else:
+            self._update_table(attributes=attributes)
+        self._describe()
+        # boto3 clients are thread safe so queries for many uuids fan out on a pool
+        self._executor = ThreadPoolExecutor(max_workers=LIMIT)
         return self
 
-    def _put(self, key: Key, value: bytes) -> Key:
+    def _update_table(self, attributes: List[dict]):
+        """add the kind index or the stream to a table created without them"""
+        table = self._db.describe_table(TableName=self._config.table)['Table']
+        if self._config.stream and not table.get('StreamSpecification', {}).get('StreamEnabled'):
+            self._db.update_table(TableName=self._config.table, StreamSpecification=STREAM)
+            self._db.get_waiter('table_exists').wait(TableName=self._config.table)
+        indexes = [index['IndexName'] for index in table.get('GlobalSecondaryIndexes', [])]
+        if self._config.index and KIND_INDEX not in indexes:
+            # the index backfills in the background and list_kind falls back to a scan until then
+            self._db.update_table(
+                TableName=self._config.table,
+                AttributeDefinitions=attributes,
+                GlobalSecondaryIndexUpdates=[{'Create': KIND}]
+            )
+
+    def _item(self, key: Key, value: bytes) -> dict:
         item = {
             'uuid': {'B': key.uuid.bytes_le},
-            'time': {'N': str(key.time)},
-            'kind': {'S': key.kind}
+            'time': {'N': str(key.time)}
         }
+        if key.kind:
+            item['kind'] = {'S': key.kind}
         if not is_none(value):
             item['value'] = {'B': value}
+        return item
+
+    def _put(self, key: Key, value: bytes) -> Key:
         self._db.put_item(
             TableName=self._config.table,
-            Item=item
+            Item=self._item(key=key, value=value)
         )
         return key
 
+    def _batch_write(self, requests: List[dict]):
+        """send put or delete requests in batches and retry the unprocessed ones"""
+        for chunk in chunks(items=requests, size=PUT_BATCH):
+            pending = {self._config.table: chunk}
+            attempt = 0
+            while pending:
+                pending = self._db.batch_write_item(
+                    RequestItems=pending
+                ).get('UnprocessedItems')
+                if pending:
+                    # unprocessed items mean the table is throttling so back off before retrying
+                    self._retried()
+                    backoff(attempt)
+                    attempt += 1
+
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        self._batch_write([{'PutRequest': {'Item': self._item(key=key, value=value)}} for key, value in items])
+        return [key for key, _ in items]
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        value = self._db.get_item(
+        items = self._db.query(
             TableName=self._config.table,
-            Key={
-                'uuid': {'B': uuid.bytes_le},
-                'time': {'N': str(time)}
+            KeyConditionExpression=LATEST_QUERY,
+            ExpressionAttributeNames=LATEST_NAMES,
+            ExpressionAttributeValues={
+                ':uuid': {'B': uuid.bytes_le},
+                ':time': {'N': str(time)}
             },
-            ConsistentRead=False
-        )['Item']
-        return value['value']['B'] if 'value' in value.keys() else None
+            # only the value is returned so reads are billed for the value alone
+            ProjectionExpression='#value',
+            ScanIndexForward=False,
+            Limit=1,
+            ConsistentRead=self._config.consistent
+        )['Items']
+        if not items:
+            return None
+        return items[0]['value']['B'] if 'value' in items[0] else EMPTY
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        # batch_get_item needs exact keys so each uuid is its own query run in parallel
+        return list(self._executor.map(lambda uuid: self._get(uuid=uuid, time=time), uuids))
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        # the paginator fetches the next page only once the previous one is consumed
+        for page in self._db.get_paginator('query').paginate(
+                TableName=self._config.table,
+                KeyConditionExpression='#uuid = :uuid AND #time BETWEEN :start AND :end',
+                ExpressionAttributeNames={'#uuid': 'uuid', '#time': 'time'},
+                ExpressionAttributeValues={
+                    ':uuid': {'B': uuid.bytes_le},
+                    ':start': {'N': str(start)},
+                    ':end': {'N': str(end)}
+                },
+                ScanIndexForward=False,
+                ConsistentRead=self._config.consistent):
+            for item in page['Items']:
+                yield item_key(item), item['value']['B'] if 'value' in item else EMPTY
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        names = {'#time': 'time'}
+        values = {':start': {'N': str(start)}, ':end': {'N': str(end)}}
+        condition = '#time BETWEEN :start AND :end'
+        if kind is not None:
+            names['#kind'] = 'kind'
+            values[':kind'] = {'S': kind}
+            condition += ' AND #kind = :kind'
+        for page in self._db.get_paginator('scan').paginate(
+                TableName=self._config.table,
+                FilterExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ConsistentRead=self._config.consistent):
+            for item in page['Items']:
+                yield item_key(item), item['value']['B'] if 'value' in item else EMPTY
+
+    def _live(self, end: int) -> Iterator[Tuple[Key, bool]]:
+        # scans return the versions of each uuid together but oldest first
+        for _, versions in groupby(super()._live(end=end), key=lambda version: version[0].uuid):
+            yield from sorted(versions, key=lambda version: version[0].time, reverse=True)
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        requests = []
+        for uuid, time in items:
+            for page in self._db.get_paginator('query').paginate(
+                    TableName=self._config.table,
+                    KeyConditionExpression='#uuid = :uuid AND #time <= :time',
+                    ExpressionAttributeNames={'#uuid': 'uuid', '#time': 'time'},
+                    ExpressionAttributeValues={':uuid': {'B': uuid.bytes_le}, ':time': {'N': str(time)}},
+                    ProjectionExpression='#uuid, #time'):
+                requests.extend({'DeleteRequest': {'Key': item}} for item in page['Items'])
+        self._batch_write(requests)
+        return len(requests)
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        if not self._config.index or not self._indexed():
+            yield from super()._list_kind(kind=kind, time=time)
+            return
+        seen = set()
+        for page in self._db.get_paginator('query').paginate(
+                TableName=self._config.table,
+                IndexName=KIND_INDEX,
+                KeyConditionExpression='#kind = :kind AND #time <= :time',
+                ExpressionAttributeNames={'#kind': 'kind', '#time': 'time'},
+                ExpressionAttributeValues={':kind': {'S': kind}, ':time': {'N': str(time)}}):
+            for item in page['Items']:
+                uuid = UUID(bytes_le=item['uuid']['B'])
+                if uuid not in seen:
+                    seen.add(uuid)
+                    latest = next(self._history(uuid=uuid, start=EARLIEST, end=time), None)
+                    if latest is not None and latest[0].kind == kind and not is_none(latest[1]):
+                        yield uuid
+
+    def _shards(self, arn: str) -> Iterator[str]:
+        """ids of the open and closed shards of the stream where splits add new ones over time"""
+        pages = {}
+        while True:
+            stream = self._config.streams.describe_stream(StreamArn=arn, **pages)['StreamDescription']
+            for shard in stream['Shards']:
+                yield shard['ShardId']
+            if 'LastEvaluatedShardId' not in stream:
+                return
+            pages = {'ExclusiveStartShardId': stream['LastEvaluatedShardId']}
+
+    def _records(self, iterator: str) -> Tuple[List[Tuple[Key, bytes]], Optional[str]]:
+        """versions written to one shard since the iterator and the iterator to resume from or None once closed"""
+        versions = []
+        while iterator is not None:
+            response = self._config.streams.get_records(ShardIterator=iterator, Limit=RECORDS)
+            # compaction removes items which are not changes of the map
+            versions.extend(
+                item_version(record['dynamodb']['NewImage'])
+                for record in response['Records'] if record['eventName'] in ('INSERT', 'MODIFY')
+            )
+            iterator = response.get('NextShardIterator')
+            if not response['Records']:
+                break
+        return versions, iterator
+
+    def _watch(self, since: int, lag: int, poll: int, stop: Optional[Event]) -> Iterator[List[Tuple[Key, bytes]]]:
+        if not self._config.stream:
+            yield from super()._watch(since=since, lag=lag, poll=poll, stop=stop)
+            return
+        arn = self._db.describe_table(TableName=self._config.table)['Table']['LatestStreamArn']
+        iterators = {}  # shard id -> iterator to resume from or None once the shard is closed and read
+        pending = []
+        while stop is None or not stop.is_set():
+            for shard in self._shards(arn=arn):
+                if shard not in iterators:
+                    # streams keep 24 hours of records so since can reach back that far
+                    iterators[shard] = self._config.streams.get_shard_iterator(
+                        StreamArn=arn, ShardId=shard, ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+            for shard, iterator in list(iterators.items()):
+                versions, iterators[shard] = self._records(iterator=iterator)
+                pending.extend((key, value) for key, value in versions if key.time >= since)
+            # shards are only ordered per uuid so versions wait out the lag to be released in time order
+            end = now() - lag
+            ready = sorted(
+                ((key, value) for key, value in pending if key.time <= end),
+                key=lambda version: (version[0].time, version[0].uuid.bytes_le)
+            )
+            pending = [(key, value) for key, value in pending if key.time > end]
+            yield from chunks(items=ready)
+            if stop is None:
+                sleep(poll / MILLIS)
+            else:
+                stop.wait(poll / MILLIS)
+
+    def _describe(self):
+        """cache whether the kind index has finished building"""
+        table = self._db.describe_table(TableName=self._config.table)['Table']
+        self._described = now()
+        self._active = any(
+            index['IndexName'] == KIND_INDEX and index['IndexStatus'] == 'ACTIVE'
+            for index in table.get('GlobalSecondaryIndexes', [])
+        )
+
+    def _indexed(self) -> bool:
+        """whether the kind index has finished building where only a building index is described again"""
+        if not self._active and now() - self._described >= BUILDING:
+            self._describe()
+        return self._active
 
     def close(self):
+        self._executor.shutdown(wait=True)
         del(self._db)
         return self
@@ -0,0 +1,68 @@
+# Change feed which pushes the updates and deletes of a map into any queue
+from .base import bytes_key, Key, key_bytes, LAG, Map, Optional, POLL, Queue, Tuple
+from struct import Struct
+from threading import Event, Thread
+
+LENGTH = Struct('>I')  # length of the key_bytes in front of each event
+
+
+def event_bytes(key: Key, value: Optional[bytes]) -> bytes:
+    """queue value holding the key of a change and its value if any"""
+    name = key_bytes(key)
+    return LENGTH.pack(len(name)) + name + (b'' if value is None else value)
+
+
+def bytes_event(b: bytes) -> Tuple[Key, Optional[bytes]]:
+    """key and value of a change popped from a feed queue where None means deleted or sent without values"""
+    length = LENGTH.unpack_from(b)[0]
+    value = bytes(b[LENGTH.size + length:])
+    return bytes_key(memoryview(b)[LENGTH.size:LENGTH.size + length]), value if value else None
+
+
+class Feed(object):
+    """thread adding each batch of changes of an open map to an open queue with the kind of the change"""
+
+    def __init__(self, map: Map, queue: Queue, since: Optional[int] = None, values: bool = True, lag: int = LAG,
+                 poll: int = POLL):
+        """changes reach the queue at most lag + poll milliseconds after they were written"""
+        self.last = None  # key of the last change added to the queue to resume from after a restart
+        self._error = None
+        self._lag = lag
+        self._map = map
+        self._poll = poll
+        self._queue = queue
+        self._since = since
+        self._stop = Event()
+        self._thread = None
+        self._values = values
+
+    def _run(self):
+        try:
+            for events in self._map._events(since=self._since, values=self._values, lag=self._lag, poll=self._poll,
+                                            stop=self._stop):
+                self._queue.add_many(items=[(key.kind, event_bytes(key, value)) for key, value in events])
+                self.last = events[-1][0]
+        except Exception as e:
+            self._error = e
+
+    def start(self):
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stop after the batch being added and raise the error which stopped the feed if any"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exit_type, exit_value, traceback):
+        self.stop()
@@ -1,30 +1,342 @@
 import lmdb
-from .base import Key, int_bytes, key_bytes, Map, Optional, UUID
+import os
+from .base import (BATCH, bytes_int, bytes_keys, EMPTY, FORMAT, GroupCommit, Iterable, Iterator, KEY, Key, key_bytes,
+                   key_time, keys_bytes, int_bytes, Lease, List, Map, NAME, now, Optional, Queue, Tuple, UTF8, UUID)
+from .config import MDB, mdb
 
 PATH = './'
+QUEUE = NAME + '-queue'  # queues need their own environment in this directory of the map path
+SEQUENCE = b'sequence'
+SEPARATOR = b'\x00'  # ends the kind in index keys
+LAST = b'\xff' * 9  # sorts after every time of a uuid in index keys
+VERSION = b'format'  # key of the main database holding the FORMAT of the version keys
+
+
+def sortable(i: int) -> bytes:
+    """convert a non negative int to bytes which sort in numeric order"""
+    return i.to_bytes(length=8, byteorder='big')
+
+
+def upgrade(txn: lmdb.Transaction, db):
+    """rewrite version keys of the first FORMAT with -time big endian one uuid at a time"""
+    cursor = txn.cursor(db=db)
+    found = cursor.first()
+    while found:
+        prefix = cursor.key()[:16]
+        if len(cursor.key()) < KEY.size:
+            # names of the other databases and the format share the main database
+            found = cursor.next()
+            continue
+        versions = []
+        # delete moves the cursor to the next key which is empty past the last key
+        while cursor.key()[:16] == prefix:
+            key = cursor.key()
+            versions.append((prefix + int_bytes(int.from_bytes(key[16:24], 'little', signed=True)) + key[24:],
+                             cursor.value()))
+            cursor.delete()
+        for key, value in versions:
+            txn.put(key, value, db=db)
+        following = int.from_bytes(prefix, 'big') + 1
+        found = following < 2 ** 128 and cursor.set_range(following.to_bytes(length=16, byteorder='big'))
+
+
+def environment(config: MDB, name: str = '', max_dbs: int = 0) -> lmdb.Environment:
+    """open the environment in the named directory of the config path with its tuning options"""
+    return lmdb.open(
+        path=os.path.join(PATH if config.path is None else config.path, name),
+        map_size=config.map_size,
+        max_dbs=max_dbs,
+        max_readers=config.max_readers,
+        metasync=config.sync,
+        sync=config.sync,
+        writemap=config.writemap
+    )
 
 
 class LMDBMap(Map):
+    """many readers run in parallel with short read transactions while writes are grouped into one transaction"""
 
     def open(self):
-        self._env = lmdb.open(path=PATH)
-        self._txn = self._env.begin(write=True)
-        self._cursor = self._txn.cursor()
+        config = mdb() if self._config is None else self._config
+        self._env = environment(config=config, max_dbs=1)
+        # uuid + -time + kind -> value in the main database where environments written before the index keep working
+        self._db = self._env.open_db()
+        try:
+            self._format()
+        except ValueError:
+            self._env.close()
+            raise
+        # kind + 0 + uuid + -time -> empty which every open keeps complete once it exists
+        self._kinds = self._index() if config.index else self._indexed()
+        # lmdb ties a write transaction to the thread that began it so pending writes
+        # wait here and the group commit writes them in one short transaction
+        self._pending = {}  # uuid bytes -> list of (time, key bytes, value)
+        self._commit = GroupCommit(
+            commit=self._write,
+            rows=config.rows,
+            millis=config.millis
+        )
         return self
 
+    def _format(self):
+        """upgrade versions written before the format was stored and refuse newer formats"""
+        with self._env.begin() as txn:
+            version = txn.get(VERSION, db=self._db)
+        if version is not None:
+            if bytes_int(version) > FORMAT:
+                raise ValueError('keys have format {version} which is newer than {format}'.format(
+                    version=bytes_int(version), format=FORMAT))
+            return
+        with self._env.begin(write=True) as txn:
+            if txn.get(VERSION, db=self._db) is None:
+                upgrade(txn=txn, db=self._db)
+                txn.put(VERSION, int_bytes(FORMAT), db=self._db)
+
+    def _indexed(self):
+        """the kinds database or None when no open asked for the index yet"""
+        try:
+            return self._env.open_db(b'kinds', create=False)
+        except lmdb.NotFoundError:
+            return None
+
+    def _index(self):
+        """open the kinds database and fill it from the versions when it is new"""
+        kinds = self._indexed()
+        if kinds is not None:
+            return kinds
+        with self._env.begin(write=True) as txn:
+            kinds = self._env.open_db(b'kinds', txn=txn)
+            with txn.cursor(db=self._db) as cursor:
+                for key, value in cursor:
+                    if len(key) >= KEY.size and value:
+                        txn.put(key[24:] + SEPARATOR + key[:24], EMPTY, db=kinds)
+        return kinds
+
+    def _write(self):
+        rows = {key: value for versions in self._pending.values() for _, key, value in versions}
+        with self._env.begin(write=True) as txn:
+            with txn.cursor(db=self._db) as cursor:
+                # sorted keys fill pages in order instead of splitting them
+                cursor.putmulti(sorted(rows.items()))
+            if self._kinds is not None:
+                with txn.cursor(db=self._kinds) as cursor:
+                    cursor.putmulti(sorted(
+                        (key[24:] + SEPARATOR + key[:24], EMPTY) for key, value in rows.items() if value
+                    ))
+        self._pending = {}
+
+    def _latest(self, cursor: lmdb.Cursor, uuid: UUID, time: int) -> Tuple[Optional[int], Optional[bytes]]:
+        """time and value of the latest version at or before time in a read transaction"""
+        prefix = uuid.bytes_le
+        # keys sort by uuid then by -time so the first key at or after the target is the latest version
+        if cursor.set_range(prefix + int_bytes(-time)):
+            key = cursor.key()
+            if key[:16] == prefix:
+                return key_time(key), bytes(cursor.value())
+        return None, None
+
+    def _unwritten(self, uuids: List[UUID], time: int) -> List[Tuple[Optional[int], Optional[bytes]]]:
+        """time and value of the latest versions still waiting for the group commit"""
+        latest = [(None, None)] * len(uuids)
+        if not self._pending:
+            return latest
+        with self._commit.lock:
+            for i, uuid in enumerate(uuids):
+                for version, _, value in self._pending.get(uuid.bytes_le, ()):
+                    if version <= time and (latest[i][0] is None or version >= latest[i][0]):
+                        latest[i] = (version, value)
+        return latest
+
     def _put(self, key: Key, value: bytes) -> Key:
-        self._cursor.put(
-            key=key_bytes(key),
-            value=value
-        )
+        with self._commit.lock:
+            self._pending.setdefault(key.uuid.bytes_le, []).append((key.time, key_bytes(key), value))
+            self._commit.add()
         return key
 
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        with self._commit.lock:
+            for (key, value), encoded in zip(items, keys_bytes(key for key, _ in items)):
+                self._pending.setdefault(key.uuid.bytes_le, []).append((key.time, encoded, value))
+            self._commit.add(rows=len(items))
+        return [key for key, _ in items]
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        self._cursor.set_range(uuid.bytes_le + int_bytes(-time))
-        return self._cursor.value()
+        return self._get_many(uuids=[uuid], time=time)[0]
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        # pending writes are copied before the snapshot so a commit in between is seen by one or the other
+        unwritten = self._unwritten(uuids=uuids, time=time)
+        # one short read transaction gives every uuid the same snapshot and
+        # buffers avoid copying keys out of the memory map while the cursor seeks
+        with self._env.begin(buffers=True) as txn:
+            cursor = txn.cursor(db=self._db)
+            latest = [self._latest(cursor=cursor, uuid=uuid, time=time) for uuid in uuids]
+        return [
+            stored[1] if pending[0] is None or (stored[0] is not None and stored[0] > pending[0]) else pending[1]
+            for stored, pending in zip(latest, unwritten)
+        ]
+
+    def _range(self, first: bytes, prefix: bytes, kind: Optional[bytes],
+               start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        """yield versions in key order from first while keys share the prefix"""
+        # pending writes are committed so they are seen in key order
+        self.flush()
+        done = False
+        while not done:
+            page = []
+            # short read transactions of one page each keep old snapshots from pinning pages
+            with self._env.begin(buffers=True) as txn:
+                cursor = txn.cursor(db=self._db)
+                done = not cursor.set_range(first)
+                for _ in range(BATCH):
+                    if done:
+                        break
+                    key = cursor.key()
+                    if key[:len(prefix)] != prefix:
+                        done = True
+                        break
+                    # the main database also holds the names of the other databases
+                    time = key_time(key) if len(key) >= KEY.size else None
+                    if prefix and time < start:
+                        done = True
+                        break
+                    if time is not None and start <= time <= end and (kind is None or key[24:] == kind):
+                        page.append((bytes(key), bytes(cursor.value())))
+                    first = bytes(key) + b'\x00'
+                    done = not cursor.next()
+            yield from zip(bytes_keys(key for key, _ in page), (value for _, value in page))
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        prefix = uuid.bytes_le
+        # keys sort by -time within the uuid so iteration runs from end back to start
+        return self._range(first=prefix + int_bytes(-end), prefix=prefix, kind=None, start=start, end=end)
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._range(
+            first=EMPTY,
+            prefix=EMPTY,
+            kind=None if kind is None else kind.encode(UTF8),
+            start=start,
+            end=end
+        )
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        if self._kinds is None:
+            yield from super()._list_kind(kind=kind, time=time)
+            return
+        self.flush()
+        kind = kind.encode(UTF8)
+        prefix = kind + SEPARATOR
+        first = prefix
+        done = False
+        while not done:
+            page = []
+            with self._env.begin(buffers=True) as txn:
+                index = txn.cursor(db=self._kinds)
+                versions = txn.cursor(db=self._db)
+                done = not index.set_range(first)
+                for _ in range(BATCH):
+                    if done:
+                        break
+                    key = index.key()
+                    if key[:len(prefix)] != prefix:
+                        done = True
+                        break
+                    uuid = bytes(key[len(prefix):len(prefix) + 16])
+                    # the uuid is live when its latest version at time still has the kind and a value
+                    if versions.set_range(uuid + int_bytes(-time)):
+                        latest = versions.key()
+                        if latest[:16] == uuid and latest[24:] == kind and len(versions.value()) > 0:
+                            page.append(uuid)
+                    # skip the remaining versions of the uuid in the index
+                    first = prefix + uuid + LAST
+                    done = not index.set_range(first)
+            for uuid in page:
+                yield UUID(bytes_le=uuid)
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        # pending writes are committed first so they are dropped like every other version
+        self.flush()
+        dropped = 0
+        with self._env.begin(write=True) as txn:
+            cursor = txn.cursor(db=self._db)
+            for uuid, time in items:
+                prefix = uuid.bytes_le
+                cursor.set_range(prefix + int_bytes(-time))
+                # delete moves the cursor to the next key which is empty past the last key
+                while cursor.key()[:16] == prefix:
+                    if self._kinds is not None:
+                        key = cursor.key()
+                        txn.delete(key[24:] + SEPARATOR + key[:24], db=self._kinds)
+                    cursor.delete()
+                    dropped += 1
+        return dropped
+
+    def flush(self):
+        self._commit.flush()
+        return self
+
+    def close(self):
+        self.flush()
+        self._env.close()
+        return self
+
+
+class LMDBQueue(Queue):
+    """durable queue where popped values move to a leased database keyed by deadline until acked"""
+
+    def open(self):
+        config = mdb() if self._config is None else self._config
+        self._env = environment(config=config, name=QUEUE, max_dbs=3)
+        self._meta = self._env.open_db(b'meta')
+        self._ready = self._env.open_db(b'ready')  # sequence -> value
+        self._leased = self._env.open_db(b'leased')  # deadline + sequence -> value
+        return self
+
+    def add(self, kind: str, value: bytes) -> bytes:
+        return self.add_many(items=[(kind, value)])[0]
+
+    def add_many(self, items: Iterable[Tuple[str, bytes]]) -> List[bytes]:
+        values = [value for _, value in items]
+        with self._env.begin(write=True) as txn:
+            sequence = int.from_bytes(txn.get(SEQUENCE, b'', db=self._meta), 'big')
+            with txn.cursor(db=self._ready) as cursor:
+                cursor.putmulti(
+                    [(sortable(sequence + i), value) for i, value in enumerate(values)],
+                    append=True
+                )
+            txn.put(SEQUENCE, sortable(sequence + len(values)), db=self._meta)
+        return values
+
+    def pop(self) -> bytes:
+        values = self.pop_many(count=1)
+        if not values:
+            raise IndexError('pop from an empty queue')
+        return values[0]
+
+    def pop_many(self, count: int) -> List[bytes]:
+        time = now()
+        deadline = sortable(time + self._timeout)
+        leases = []
+        # one write transaction at a time across processes so no value is leased twice
+        with self._env.begin(write=True) as txn:
+            ready = txn.cursor(db=self._ready)
+            leased = txn.cursor(db=self._leased)
+            # expired leases go back to the ready database under their original sequence
+            while leased.first() and leased.key()[:8] <= sortable(time):
+                ready.put(leased.key()[8:], leased.value())
+                leased.delete()
+            while len(leases) < count and ready.first():
+                lease = deadline + ready.key()
+                leases.append(Lease(ready.value(), id=lease))
+                leased.put(lease, ready.value())
+                ready.delete()
+        return leases
+
+    def ack(self, lease: bytes) -> bool:
+        with self._env.begin(write=True) as txn:
+            return txn.delete(lease.id, db=self._leased)
 
     def close(self):
-        self._cursor.close()
-        self._txn.commit()
         self._env.close()
         return self
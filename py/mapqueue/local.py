@@ -1,43 +1,151 @@
-from .base import namedtuple, Key, Map, Queue, Optional, UUID
-from bisect import bisect_left
+from .base import EARLIEST, Iterator, Key, List, Map, now, Optional, Queue, Tuple, UUID
+from .config import local
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import deque
+from sys import intern
 
-# inspired by https://code.activestate.com/recipes/577197-sortedcollection/
-Revision = namedtuple('Revision', [
-    'times',  # negative UTC milliseconds since epoch
-    'values'  # stored value
-])
+
+class Revision(object):
+    """versions of one uuid where a single version is stored inline and more use a packed column of times"""
+
+    __slots__ = ('kinds', 'times', 'values')
+
+    def __init__(self, time: int, kind: str, value: bytes):
+        self.kinds = kind  # kind or list of kinds parallel to times
+        self.times = time  # int or array of UTC milliseconds since epoch in ascending order
+        self.values = value  # value or list of values parallel to times
+
+    def versions(self, start: int, end: int) -> Iterator[Tuple[int, str, bytes]]:
+        """(time, kind, value) with start <= time <= end from newest to oldest"""
+        if type(self.times) is int:
+            if start <= self.times <= end:
+                yield self.times, self.kinds, self.values
+            return
+        for i in range(bisect_right(self.times, end) - 1, bisect_left(self.times, start) - 1, -1):
+            yield self.times[i], self.kinds[i], self.values[i]
 
 
 class LocalMap(Map):
+    """in process map which keys revisions by the uuid as an int to save memory"""
 
     def open(self):
+        config = local() if self._config is None else self._config
+        self._age = config.age
+        self._kinds = {} if config.index else None  # kind -> uuids as ints which ever had the kind
+        self._versions = config.versions
         self._map = {}
         return self
 
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        uuid = uuid.bytes_le
-        if uuid not in self._map.keys():
+        revision = self._map.get(uuid.int)
+        if revision is None:
             return None
-        else:
-            revisions = self._map[uuid]
-            i = bisect_left(revisions.times, -time)
-            return revisions.values[i]
+        times = revision.times
+        if type(times) is int:
+            return revision.values if times <= time else None
+        # reads of the latest version skip the search
+        if times[-1] <= time:
+            return revision.values[-1]
+        i = bisect_right(times, time)
+        return None if i == 0 else revision.values[i - 1]
 
     def _put(self, key: Key, value: bytes) -> Key:
-        uuid = key.uuid.bytes_le
-        if uuid not in self._map.keys():
-            self._map[uuid] = Revision(
-                times=[-key.time],
-                values=[value]
-            )
+        # versions share one copy of each kind
+        kind = intern(key.kind)
+        if self._kinds is not None and value:
+            self._kinds.setdefault(kind, set()).add(key.uuid.int)
+        revision = self._map.get(key.uuid.int)
+        if revision is None:
+            self._map[key.uuid.int] = Revision(time=key.time, kind=kind, value=value)
+            return key
+        if type(revision.times) is int:
+            if revision.times == key.time:
+                revision.kinds = kind
+                revision.values = value
+                return key
+            revision.kinds = [revision.kinds]
+            revision.times = array('q', [revision.times])
+            revision.values = [revision.values]
+        times = revision.times
+        # writes in time order append in amortized constant time
+        if times[-1] < key.time:
+            times.append(key.time)
+            revision.kinds.append(kind)
+            revision.values.append(value)
         else:
-            revisions = self._map[uuid]
-            i = bisect_left(revisions.times, -key.time)-1
-            revisions.times.insert(i, -key.time)
-            revisions.values.insert(i, value)
+            i = bisect_left(times, key.time)
+            if i < len(times) and times[i] == key.time:
+                revision.kinds[i] = kind
+                revision.values[i] = value
+            else:
+                times.insert(i, key.time)
+                revision.kinds.insert(i, kind)
+                revision.values.insert(i, value)
+        if self._age is not None or self._versions is not None:
+            self._prune(revision)
         return key
 
+    def _prune(self, revision: Revision):
+        """drop the oldest versions beyond the version count or age"""
+        drop = 0
+        if self._versions is not None:
+            drop = len(revision.times) - self._versions
+        if self._age is not None:
+            # keep the version in effect at the horizon so reads after it stay correct
+            drop = max(drop, bisect_right(revision.times, now() - self._age) - 1)
+        drop = min(drop, len(revision.times) - 1)
+        if drop > 0:
+            del revision.kinds[:drop]
+            del revision.times[:drop]
+            del revision.values[:drop]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        revision = self._map.get(uuid.int)
+        if revision is not None:
+            for time, kind, value in revision.versions(start=start, end=end):
+                yield Key(uuid=uuid, time=time, kind=kind), value
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        # uuids are copied so writes during the scan cannot break the iteration
+        for uuid in list(self._map):
+            revision = self._map.get(uuid)
+            if revision is None:
+                continue
+            for time, version_kind, value in list(revision.versions(start=start, end=end)):
+                if kind is None or version_kind == kind:
+                    yield Key(uuid=UUID(int=uuid), time=time, kind=version_kind), value
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        if self._kinds is None:
+            yield from super()._list_kind(kind=kind, time=time)
+            return
+        for uuid in list(self._kinds.get(kind, ())):
+            revision = self._map.get(uuid)
+            # compaction may have dropped every version of the uuid
+            latest = None if revision is None else next(revision.versions(start=EARLIEST, end=time), None)
+            if latest is not None and latest[1] == kind and latest[2]:
+                yield UUID(int=uuid)
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        dropped = 0
+        for uuid, time in items:
+            revision = self._map.get(uuid.int)
+            if revision is None:
+                continue
+            if type(revision.times) is int:
+                drop, count = int(revision.times <= time), 1
+            else:
+                drop, count = bisect_right(revision.times, time), len(revision.times)
+            if drop == count:
+                del self._map[uuid.int]
+            elif drop > 0:
+                del revision.kinds[:drop]
+                del revision.times[:drop]
+                del revision.values[:drop]
+            dropped += drop
+        return dropped
+
     def close(self):
         del(self._map)
         return self
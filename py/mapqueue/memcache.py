@@ -1,21 +1,55 @@
-import lmdb
-from .base import Key, key_bytes, Map, Optional, UUID
+from .base import Key, List, Map, Optional, Tuple, UUID
+from .config import kv
+from .pool import Pool, Stats
+from functools import partial
 from pymemcache.client.hash import HashClient
+from pymemcache.exceptions import MemcacheUnexpectedCloseError
+
+PORT = 11211
+
+
+def memcache_key(uuid: UUID, time: int) -> str:
+    """memcache keys must be printable so encode uuid and time as text"""
+    return uuid.hex + str(-time)
 
 
 class MemcacheMap(Map):
+    """thread safe map where each operation borrows a client from a pool"""
 
     def open(self):
-        self._db = HashClient(('127.0.0.1', 11211))
+        config = kv() if self._config is None else self._config
+        self._pool = Pool(
+            connect=partial(HashClient, [(config.host, PORT if config.port is None else config.port)]),
+            size=config.pool,
+            errors=(MemcacheUnexpectedCloseError, OSError)
+        )
         return self
 
     def _put(self, key: Key, value: bytes) -> Key:
-        self._db.set(key_bytes(key), value)
+        with self._pool.connection() as db:
+            db.set(memcache_key(uuid=key.uuid, time=key.time), value)
         return key
 
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        with self._pool.connection() as db:
+            db.set_many({
+                memcache_key(uuid=key.uuid, time=key.time): value
+                for key, value in items
+            })
+        return [key for key, _ in items]
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        return self._db.get(key_bytes(key))
+        return self._pool.run(lambda db: db.get(memcache_key(uuid=uuid, time=time)))
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        keys = [memcache_key(uuid=uuid, time=time) for uuid in uuids]
+        values = self._pool.run(lambda db: db.get_many(keys))
+        return [values.get(key) for key in keys]
+
+    def stats(self) -> Stats:
+        """pool counters to watch wait time and utilization"""
+        return self._pool.stats()
 
     def close(self):
-        del(self._db)
+        self._pool.close()
         return self
@@ -0,0 +1,278 @@
+# Timing, size and retry measurements for Map and Queue operations sent to pluggable sinks
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import partial, wraps
+from inspect import iscoroutinefunction
+from threading import Lock
+from time import perf_counter
+
+# phases of an operation
+TOTAL = 'total'  # the whole public call
+BACKEND = 'backend'  # round trips in _get, _put, _get_many and _put_many
+CODEC = 'codec'  # compression in encode and decode
+COMMIT = 'commit'  # flushes and group commits
+# upper bounds in seconds of the latency buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = 'mapqueue'
+
+
+class Sink(object):
+    """receives measurements and ignores them so sinks only override what they need"""
+
+    def timing(self, operation: str, phase: str, seconds: float, error: BaseException = None):
+        """seconds spent in a phase of an operation and the exception it raised if any"""
+
+    def size(self, operation: str, raw: int, stored: int):
+        """bytes before and after compression for encode and decode"""
+
+    def retry(self, operation: str):
+        """an operation is tried again after a broken connection or throttling"""
+
+    def span(self, operation: str, context: str):
+        """context manager around a public operation of the context class"""
+        return nullcontext()
+
+
+class Sinks(Sink):
+    """send every measurement to each sink"""
+
+    def __init__(self, *sinks: Sink):
+        self._sinks = sinks
+
+    def timing(self, operation: str, phase: str, seconds: float, error: BaseException = None):
+        for sink in self._sinks:
+            sink.timing(operation, phase, seconds, error)
+
+    def size(self, operation: str, raw: int, stored: int):
+        for sink in self._sinks:
+            sink.size(operation, raw, stored)
+
+    def retry(self, operation: str):
+        for sink in self._sinks:
+            sink.retry(operation)
+
+    def span(self, operation: str, context: str):
+        spans = [sink.span(operation, context) for sink in self._sinks]
+        return spans[0] if len(spans) == 1 else Nested(spans)
+
+
+class Nested(object):
+    """enter several context managers as one"""
+
+    def __init__(self, managers: list):
+        self._managers = managers
+
+    def __enter__(self):
+        for manager in self._managers:
+            manager.__enter__()
+        return self
+
+    def __exit__(self, exit_type, exit_value, traceback):
+        for manager in reversed(self._managers):
+            manager.__exit__(exit_type, exit_value, traceback)
+        return False
+
+
+class Histogram(Sink):
+    """thread safe latency histograms, byte counters, errors and retries kept in memory"""
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self.counts = {}  # (operation, phase) -> count per bucket with one more for slower calls
+        self.seconds = {}  # (operation, phase) -> total seconds
+        self.errors = {}  # (operation, phase) -> calls which raised
+        self.bytes = {}  # operation -> [raw bytes, stored bytes]
+        self.retries = {}  # operation -> retries
+
+    def timing(self, operation: str, phase: str, seconds: float, error: BaseException = None):
+        bucket = bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts = self.counts.get((operation, phase))
+            if counts is None:
+                counts = self.counts[(operation, phase)] = [0] * (len(self.buckets) + 1)
+                self.seconds[(operation, phase)] = 0.0
+                self.errors[(operation, phase)] = 0
+            counts[bucket] += 1
+            self.seconds[(operation, phase)] += seconds
+            self.errors[(operation, phase)] += error is not None
+
+    def size(self, operation: str, raw: int, stored: int):
+        with self._lock:
+            sizes = self.bytes.setdefault(operation, [0, 0])
+            sizes[0] += raw
+            sizes[1] += stored
+
+    def retry(self, operation: str):
+        with self._lock:
+            self.retries[operation] = self.retries.get(operation, 0) + 1
+
+    def count(self, operation: str, phase: str = TOTAL) -> int:
+        with self._lock:
+            return sum(self.counts.get((operation, phase), ()))
+
+    def quantile(self, operation: str, phase: str = TOTAL, q: float = 0.99) -> float:
+        """upper bound in seconds of the bucket holding the quantile or infinity past the last bucket"""
+        with self._lock:
+            counts = list(self.counts.get((operation, phase), ()))
+        target = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+    def clear(self):
+        with self._lock:
+            self.counts.clear()
+            self.seconds.clear()
+            self.errors.clear()
+            self.bytes.clear()
+            self.retries.clear()
+
+
+def labels(**values) -> str:
+    return ','.join('{name}="{value}"'.format(name=name, value=value) for name, value in values.items())
+
+
+def prometheus(histogram: Histogram, prefix: str = PREFIX) -> str:
+    """prometheus text exposition format of a histogram sink for a /metrics endpoint"""
+    lines = ['# TYPE {prefix}_seconds histogram'.format(prefix=prefix)]
+    with histogram._lock:
+        for (operation, phase), counts in sorted(histogram.counts.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{prefix}_seconds_bucket{{{labels}}} {count}'.format(
+                    prefix=prefix, labels=labels(operation=operation, phase=phase, le=bound), count=cumulative))
+            lines.append('{prefix}_seconds_sum{{{labels}}} {seconds}'.format(
+                prefix=prefix, labels=labels(operation=operation, phase=phase),
+                seconds=histogram.seconds[(operation, phase)]))
+            lines.append('{prefix}_seconds_count{{{labels}}} {count}'.format(
+                prefix=prefix, labels=labels(operation=operation, phase=phase), count=cumulative))
+        lines.append('# TYPE {prefix}_errors_total counter'.format(prefix=prefix))
+        for (operation, phase), errors in sorted(histogram.errors.items()):
+            lines.append('{prefix}_errors_total{{{labels}}} {errors}'.format(
+                prefix=prefix, labels=labels(operation=operation, phase=phase), errors=errors))
+        lines.append('# TYPE {prefix}_bytes_total counter'.format(prefix=prefix))
+        for operation, (raw, stored) in sorted(histogram.bytes.items()):
+            for form, count in [('raw', raw), ('stored', stored)]:
+                lines.append('{prefix}_bytes_total{{{labels}}} {count}'.format(
+                    prefix=prefix, labels=labels(operation=operation, form=form), count=count))
+        lines.append('# TYPE {prefix}_retries_total counter'.format(prefix=prefix))
+        for operation, retries in sorted(histogram.retries.items()):
+            lines.append('{prefix}_retries_total{{{labels}}} {retries}'.format(
+                prefix=prefix, labels=labels(operation=operation), retries=retries))
+    return '\n'.join(lines) + '\n'
+
+
+class Tracer(Sink):
+    """spans from an opentelemetry style tracer with start_as_current_span such as trace.get_tracer(__name__)"""
+
+    def __init__(self, tracer, prefix: str = PREFIX):
+        self._tracer = tracer
+        self._prefix = prefix
+
+    def span(self, operation: str, context: str):
+        return self._tracer.start_as_current_span(
+            '{prefix}.{operation}'.format(prefix=self._prefix, operation=operation),
+            attributes={'{prefix}.context'.format(prefix=self._prefix): context}
+        )
+
+
+class Measured(object):
+    """codec wrapper timing compression and counting bytes before and after it"""
+
+    def __init__(self, codec, sink: Sink):
+        self._codec = codec
+        self._sink = sink
+        self.tag = codec.tag
+
+    def encode(self, value: bytes) -> bytes:
+        start = perf_counter()
+        encoded = self._codec.encode(value)
+        self._sink.timing('encode', CODEC, perf_counter() - start)
+        self._sink.size('encode', len(value), len(encoded))
+        return encoded
+
+    def decode(self, value: bytes) -> bytes:
+        start = perf_counter()
+        decoded = self._codec.decode(value)
+        self._sink.timing('decode', CODEC, perf_counter() - start)
+        self._sink.size('decode', len(decoded), len(value))
+        return decoded
+
+
+def timed(method, sink: Sink, operation: str, phase: str, context: str = None):
+    """wrap a bound method or coroutine to time it and open a span when context names the class"""
+    span = sink.span if context is not None else None
+    if iscoroutinefunction(method):
+        @wraps(method)
+        async def measure(*args, **kwargs):
+            start = perf_counter()
+            error = None
+            try:
+                with span(operation, context) if span is not None else nullcontext():
+                    return await method(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                sink.timing(operation, phase, perf_counter() - start, error)
+        return measure
+
+    @wraps(method)
+    def measure(*args, **kwargs):
+        start = perf_counter()
+        error = None
+        try:
+            with span(operation, context) if span is not None else nullcontext():
+                return method(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            sink.timing(operation, phase, perf_counter() - start, error)
+    return measure
+
+
+def hooks(context, sink: Sink):
+    """measure the group commit and pool retries which maps create when they open"""
+    group = getattr(context, '_commit', None)
+    if group is not None and hasattr(group, '_commit') and not hasattr(group._commit, '__wrapped__'):
+        # group commits also run from writes and timers
+        group._commit = timed(group._commit, sink, 'commit', COMMIT)
+    pool = getattr(context, '_pool', None)
+    if pool is not None and hasattr(pool, 'retried'):
+        pool.retried = partial(sink.retry, 'pool')
+
+
+def instrument(context, sink: Sink, operations: tuple, backend: tuple):
+    """replace the methods of one map or queue with measured ones so uninstrumented instances pay nothing"""
+    name = type(context).__name__
+    for operation in operations:
+        setattr(context, operation, timed(getattr(context, operation), sink, operation, TOTAL, context=name))
+    for method in backend:
+        setattr(context, method, timed(getattr(context, method), sink, method.lstrip('_'), BACKEND))
+    context.flush = timed(context.flush, sink, 'flush', COMMIT)
+    codec = getattr(context, '_codec', None)
+    if codec is not None and not isinstance(codec, Measured):
+        context._codec = Measured(codec=codec, sink=sink)
+    context._retried = partial(sink.retry, name)
+    hooks(context=context, sink=sink)
+    opener = context.open
+    if iscoroutinefunction(opener):
+        @wraps(opener)
+        async def open():
+            opened = await opener()
+            hooks(context=context, sink=sink)
+            return opened
+    else:
+        @wraps(opener)
+        def open():
+            opened = opener()
+            hooks(context=context, sink=sink)
+            return opened
+    context.open = open
+    return context
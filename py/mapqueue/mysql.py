@@ -1,6 +1,10 @@
-from .base import Key, Map, Optional, UUID
-from .config import NAME
-from MySQLdb import connect
+from .base import BATCH, chunks, EMPTY, Iterator, Key, List, Optional, Tuple, UUID
+from .config import NAME, SQL, sql
+from .pool import Pool, PooledMap, rollback
+from functools import partial
+from MySQLdb import connect, InterfaceError, OperationalError
+
+PORT = 3306
 
 CREATE = '''CREATE TABLE IF NOT EXISTS {table}(
 uuid BINARY(16) NOT NULL,
@@ -10,37 +14,201 @@ value BLOB NOT NULL,
 PRIMARY KEY(uuid, time DESC));'''.format(table=NAME)
 
 INSERT = '''INSERT INTO {table}(uuid, kind, time, value)
-VALUES (?, ?, ?, ?);'''.format(table=NAME)
+VALUES (%s, %s, %s, %s);'''.format(table=NAME)
 
 SELECT = '''SELECT value from {table}
-WHERE uuid = ? AND time <= ?
+WHERE uuid = %s AND time <= %s
 ORDER BY time DESC LIMIT 1;'''.format(table=NAME)
 
+# latest value of many uuids at one time in a single statement
+SELECT_MANY = '''SELECT uuid, value from {table} AS latest
+WHERE uuid IN ({{params}}) AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= %s);'''.format(table=NAME)
+
+# versions are read in pages which resume after the last row so no connection is held between pages
+HISTORY = '''SELECT time, kind, value FROM {table}
+WHERE uuid = %s AND time >= %s AND time <= %s
+ORDER BY time DESC LIMIT %s;'''.format(table=NAME)
+
+SCAN = '''SELECT uuid, time, kind, value FROM {table}
+WHERE (uuid > %s OR (uuid = %s AND time < %s)) AND time >= %s AND time <= %s{{kind}}
+ORDER BY uuid, time DESC LIMIT %s;'''.format(table=NAME)
+
+SCAN_KIND = ' AND kind = %s'
+
+# versions are never updated in place so the table ordered by time is the change log
+CHANGES = '''SELECT uuid, time, kind, value FROM {table}
+WHERE (time > %s OR (time = %s AND uuid > %s)) AND time <= %s
+ORDER BY time, uuid LIMIT %s;'''.format(table=NAME)
+
+# uuids whose latest version at a time has the kind where the kind index finds the candidates
+LIST_KIND = '''SELECT uuid FROM {table} AS latest
+WHERE kind = %s AND uuid > %s AND time <= %s AND LENGTH(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= %s)
+ORDER BY uuid LIMIT %s;'''.format(table=NAME)
+
+COUNT_KIND = '''SELECT COUNT(*) FROM {table} AS latest
+WHERE kind = %s AND time <= %s AND LENGTH(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= %s);'''.format(table=NAME)
+
+# compaction drops the versions of a uuid at or before a time with one ranged delete
+DROP = '''DELETE FROM {table}
+WHERE uuid = %s AND time <= %s;'''.format(table=NAME)
+
+# mysql has no CREATE INDEX IF NOT EXISTS
+INDEX_EXISTS = '''SELECT COUNT(*) FROM information_schema.statistics
+WHERE table_schema = DATABASE() AND table_name = '{table}' AND index_name = %s;'''.format(table=NAME)
+
+CREATE_KIND = '''CREATE INDEX {table}_kind
+ON {table}(kind, uuid, time);'''.format(table=NAME)
+
+CREATE_CHANGES = '''CREATE INDEX {table}_time
+ON {table}(time, uuid);'''.format(table=NAME)
+
+
+def connection(config: SQL):
+    # pooled connections autocommit so reads always see the latest commits
+    return connect(
+        db=NAME if config.database is None else config.database,
+        host='localhost' if config.host is None else config.host,
+        passwd='' if config.password is None else config.password,
+        port=PORT if config.port is None else config.port,
+        user='root' if config.user is None else config.user,
+        autocommit=True
+    )
+
 
-class MySQLMap(Map):
+def create_index(cursor, name: str, create: str):
+    cursor.execute(INDEX_EXISTS, (name,))
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(create)
+
+
+class MySQLMap(PooledMap):
 
     def open(self):
-        self._db = connect(db=NAME, user='root')
-        self._cursor = self._db.cursor()
-        self._cursor.execute(CREATE)
-        self._db.commit()
+        config = sql() if self._config is None else self._config
+        self._pooled(
+            pool=Pool(
+                connect=partial(connection, config=config),
+                size=config.pool,
+                check=lambda db: db.ping(),
+                reset=rollback,
+                errors=(InterfaceError, OperationalError)
+            ),
+            rows=config.rows,
+            millis=config.millis
+        )
+        self._read(lambda cursor: cursor.execute(CREATE))
+        if config.index:
+            self._read(partial(create_index, name=NAME + '_kind', create=CREATE_KIND))
+        if config.changes:
+            self._read(partial(create_index, name=NAME + '_time', create=CREATE_CHANGES))
         return self
 
     def _put(self, key: Key, value: bytes) -> Key:
-        self._cursor.execute(
+        self._write(lambda cursor: cursor.execute(
             INSERT,
             (key.uuid.bytes_le, key.kind, key.time, value)
-        )
-        self._db.commit()
+        ))
         return key
 
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        # mysqlclient rewrites executemany inserts into multi row statements
+        self._write(lambda cursor: cursor.executemany(
+            INSERT,
+            [(key.uuid.bytes_le, key.kind, key.time, value)
+             for key, value in items]
+        ), rows=len(items))
+        return [key for key, _ in items]
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        def drop(cursor):
+            # executemany runs deletes one by one and sums their row counts
+            cursor.executemany(DROP, [(uuid.bytes_le, time) for uuid, time in items])
+            return cursor.rowcount
+        return self._write(drop, rows=len(items))
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        return self._cursor.execute(
-            SELECT,
-            (uuid.bytes_le, time)
-        ).fetchone()[0]
-
-    def close(self):
-        self._cursor.close()
-        self._db.close()
-        return self
+        def select(cursor):
+            cursor.execute(SELECT, (uuid.bytes_le, time))
+            return cursor.fetchone()
+        row = self._read(select)
+        return None if row is None else row[0]
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        def select(cursor):
+            values = {}
+            for chunk in chunks(items=[uuid.bytes_le for uuid in uuids], size=BATCH):
+                cursor.execute(
+                    SELECT_MANY.format(params=', '.join(['%s'] * len(chunk))),
+                    chunk + [time]
+                )
+                values.update(cursor.fetchall())
+            return values
+        values = self._read(select)
+        return [values.get(uuid.bytes_le) for uuid in uuids]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        while True:
+            def select(cursor):
+                cursor.execute(HISTORY, (uuid.bytes_le, start, end, BATCH))
+                return cursor.fetchall()
+            rows = self._read(select)
+            for time, kind, value in rows:
+                yield Key(uuid=uuid, time=time, kind=kind), value
+            if len(rows) < BATCH:
+                return
+            end = rows[-1][0] - 1
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        statement = SCAN.format(kind='' if kind is None else SCAN_KIND)
+        after, before = EMPTY, 0  # uuid and time of the last row read
+        while True:
+            def select(cursor):
+                cursor.execute(
+                    statement,
+                    [after, after, before, start, end] + ([] if kind is None else [kind]) + [BATCH]
+                )
+                return cursor.fetchall()
+            rows = self._read(select)
+            for uuid, time, row_kind, value in rows:
+                yield Key(uuid=UUID(bytes_le=uuid), time=time, kind=row_kind), value
+            if len(rows) < BATCH:
+                return
+            after, before = rows[-1][0], rows[-1][1]
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        after, before = start, EMPTY  # time and uuid of the last row read
+        while True:
+            def select(cursor):
+                cursor.execute(CHANGES, (after, after, before, end, BATCH))
+                return cursor.fetchall()
+            rows = self._read(select)
+            for uuid, time, kind, value in rows:
+                yield Key(uuid=UUID(bytes_le=uuid), time=time, kind=kind), value
+            if len(rows) < BATCH:
+                return
+            after, before = rows[-1][1], rows[-1][0]
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        after = EMPTY
+        while True:
+            def select(cursor):
+                cursor.execute(LIST_KIND, (kind, after, time, time, BATCH))
+                return cursor.fetchall()
+            rows = self._read(select)
+            for uuid, in rows:
+                yield UUID(bytes_le=uuid)
+            if len(rows) < BATCH:
+                return
+            after = rows[-1][0]
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        def select(cursor):
+            cursor.execute(COUNT_KIND, (kind, time, time))
+            return cursor.fetchone()[0]
+        return self._read(select)
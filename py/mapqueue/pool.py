@@ -0,0 +1,309 @@
+# Thread safe connection pool shared by the networked maps
+from .base import Callable, GroupCommit, LIMIT, Map, namedtuple, Tuple
+from contextlib import contextmanager
+from threading import Condition
+from time import monotonic
+
+BEGIN = 'BEGIN;'
+COMMIT = 'COMMIT;'
+ROLLBACK = 'ROLLBACK;'
+# each write of a group commit runs in a savepoint so a failed write rolls back alone
+SAVEPOINT = 'SAVEPOINT write;'
+RELEASE = 'RELEASE SAVEPOINT write;'
+ROLLBACK_WRITE = 'ROLLBACK TO SAVEPOINT write;'
+IDLE = 30.0  # seconds a connection may sit in the pool before it is checked on checkout
+
+# counters to size the pool where utilization is the change in busy over the change in seconds * size
+Stats = namedtuple('Stats', [
+    'acquires',  # connections handed out
+    'busy',  # seconds connections spent handed out
+    'idle',  # open connections waiting in the pool
+    'in_use',  # connections handed out and not yet returned
+    'reconnects',  # broken or unhealthy connections which were replaced
+    'size',  # most connections the pool opens
+    'wait',  # seconds callers spent waiting for a free connection
+    'waits'  # acquires which found every connection in use
+])
+
+
+def close_connection(connection):
+    connection.close()
+
+
+class Pool(object):
+    """opens up to size connections on demand, checks idle ones before reuse and replaces broken ones"""
+
+    def __init__(self, connect: Callable[[], object], size: int = LIMIT, check: Callable[[object], None] = None,
+                 close: Callable[[object], None] = close_connection, reset: Callable[[object], None] = None,
+                 errors: Tuple[type, ...] = (), idle: float = IDLE, timeout: float = None):
+        """check raises on unhealthy connections, reset cleans up after failures and errors mean a broken connection"""
+        self._check = check
+        self._close = close
+        self._condition = Condition()
+        self._connect = connect
+        self.errors = errors
+        self.retried = None  # called before each retry when the map is instrumented
+        self._idle = idle
+        self._reset = reset
+        self._size = size
+        self._timeout = timeout
+        self._available = []  # (connection, monotonic seconds when returned) reused newest first
+        self._checked_out = {}  # id(connection) -> monotonic seconds when handed out
+        self._closed = False
+        self._open = 0
+        self._acquires = 0
+        self._busy = 0.0
+        self._reconnects = 0
+        self._wait = 0.0
+        self._waits = 0
+
+    def acquire(self):
+        """take a connection waiting at most timeout seconds for one to be released"""
+        start = monotonic()
+        with self._condition:
+            waited = False
+            while not self._closed and not self._available and self._open >= self._size:
+                waited = True
+                remaining = None if self._timeout is None else self._timeout - (monotonic() - start)
+                if remaining is not None and remaining <= 0:
+                    self._waits += 1
+                    self._wait += monotonic() - start
+                    raise TimeoutError('no connection was released within {timeout} seconds'.format(
+                        timeout=self._timeout))
+                self._condition.wait(timeout=remaining)
+            if self._closed:
+                raise ValueError('acquire from a closed pool')
+            connection, returned = self._available.pop() if self._available else (None, None)
+            if connection is None:
+                self._open += 1
+            self._acquires += 1
+            if waited:
+                self._waits += 1
+                self._wait += monotonic() - start
+        try:
+            if connection is not None and self._check is not None and monotonic() - returned > self._idle:
+                try:
+                    self._check(connection)
+                except Exception:
+                    self._quietly_close(connection)
+                    connection = None
+                    with self._condition:
+                        self._reconnects += 1
+            if connection is None:
+                connection = self._connect()
+        except BaseException:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._checked_out[id(connection)] = monotonic()
+        return connection
+
+    def release(self, connection, broken: bool = False):
+        """return a connection to the pool or close it when broken so the next acquire reconnects"""
+        with self._condition:
+            self._busy += monotonic() - self._checked_out.pop(id(connection))
+            if broken or self._closed:
+                self._open -= 1
+                self._reconnects += broken
+            else:
+                self._available.append((connection, monotonic()))
+            self._condition.notify()
+        if broken or self._closed:
+            self._quietly_close(connection)
+
+    @contextmanager
+    def connection(self):
+        """borrow a connection for the body of a with statement"""
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except self.errors:
+            broken = True
+            raise
+        except BaseException:
+            if self._reset is not None:
+                try:
+                    self._reset(connection)
+                except self.errors:
+                    broken = True
+            raise
+        finally:
+            self.release(connection, broken=broken)
+
+    def run(self, function: Callable[[object], object], retries: int = 1):
+        """call function with a connection and retry on a fresh one when the connection broke"""
+        for attempt in range(retries + 1):
+            try:
+                with self.connection() as connection:
+                    return function(connection)
+            except self.errors:
+                if attempt == retries:
+                    raise
+                if self.retried is not None:
+                    self.retried()
+
+    def stats(self) -> Stats:
+        with self._condition:
+            return Stats(
+                acquires=self._acquires,
+                busy=self._busy + sum(monotonic() - start for start in self._checked_out.values()),
+                idle=len(self._available),
+                in_use=len(self._checked_out),
+                reconnects=self._reconnects,
+                size=self._size,
+                wait=self._wait,
+                waits=self._waits
+            )
+
+    def close(self):
+        """close idle connections now and the rest as they are released"""
+        with self._condition:
+            self._closed = True
+            available, self._available = self._available, []
+            self._open -= len(available)
+            self._condition.notify_all()
+        for connection, _ in available:
+            self._quietly_close(connection)
+        return self
+
+    def _quietly_close(self, connection):
+        try:
+            self._close(connection)
+        except Exception:
+            pass
+
+
+def execute(connection, statement: str):
+    with connection.cursor() as cursor:
+        cursor.execute(statement)
+
+
+def rollback(connection):
+    execute(connection, ROLLBACK)
+
+
+class PooledMap(Map):
+    """thread safe sql map where reads share pooled autocommit connections and grouped writes hold one of them"""
+
+    def _pooled(self, pool: Pool, rows: int, millis: int):
+        self._pool = pool
+        self._rows = rows
+        self._writer = None  # connection holding the open group commit transaction
+        self._grouped = 0  # rows written into the open transaction by writers which already returned
+        self._error = None  # lost group which raises from the next flush
+        self._commit = GroupCommit(
+            commit=self._end,
+            rows=rows,
+            millis=millis
+        )
+
+    def _read(self, function: Callable[[object], object]):
+        """call function with a cursor and retry once when the connection broke"""
+        def read(connection):
+            with connection.cursor() as cursor:
+                return function(cursor)
+        return self._pool.run(read)
+
+    def _write(self, function: Callable[[object], object], rows: int = 1):
+        """call function with a cursor inside a transaction and return its result"""
+        if self._rows == 1:
+            # without group commit writers run in parallel on their own connections
+            with self._pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    if rows > 1:
+                        cursor.execute(BEGIN)
+                    result = function(cursor)
+                    if rows > 1:
+                        cursor.execute(COMMIT)
+            return result
+        with self._commit.lock:
+            if self._writer is None:
+                self._writer = self._pool.acquire()
+                try:
+                    execute(self._writer, BEGIN)
+                except BaseException:
+                    self._abort()
+                    raise
+            failed = None
+            try:
+                with self._writer.cursor() as cursor:
+                    cursor.execute(SAVEPOINT)
+                    try:
+                        result = function(cursor)
+                    except BaseException as e:
+                        if isinstance(e, self._pool.errors):
+                            raise
+                        # only this write rolls back so the writes of the group which returned still commit
+                        cursor.execute(ROLLBACK_WRITE)
+                        failed = e
+                    else:
+                        cursor.execute(RELEASE)
+            except BaseException as e:
+                # the transaction is gone with the connection so the earlier writes of the group are lost
+                if self._grouped > 0:
+                    self._error = e
+                self._abort()
+                raise
+            if failed is not None:
+                raise failed
+            self._grouped += rows
+            self._commit.add(rows=rows)
+            return result
+
+    def _end(self):
+        """commit the group and return its connection to the pool"""
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        self._grouped = 0
+        try:
+            execute(writer, COMMIT)
+        except BaseException as e:
+            # writers of the group already returned and a commit on the timer thread has no caller to raise to
+            self._error = e
+            try:
+                rollback(writer)
+                broken = isinstance(e, self._pool.errors)
+            except Exception:
+                broken = True
+            self._pool.release(writer, broken=broken)
+            raise
+        self._pool.release(writer)
+
+    def _abort(self):
+        writer, self._writer = self._writer, None
+        self._grouped = 0
+        try:
+            rollback(writer)
+            broken = False
+        except Exception:
+            broken = True
+        self._pool.release(writer, broken=broken)
+
+    def stats(self) -> Stats:
+        """pool counters to watch wait time and utilization"""
+        return self._pool.stats()
+
+    def flush(self):
+        """commit the group and raise the error which lost an earlier group if any"""
+        try:
+            self._commit.flush()
+        except BaseException as e:
+            # the error of a commit made by this flush is raised here and not again
+            if self._error is e:
+                self._error = None
+            raise
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return self
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._pool.close()
+        return self
@@ -1,44 +1,398 @@
-from .base import Key, Map, Optional, UUID
-from .config import NAME
-from psycopg2 import connect
+from .base import (AsyncIterator, AsyncMap, BATCH, EMPTY, Iterable, Iterator, Key, Lease, List, now, Optional, Queue,
+                   Tuple, UUID)
+from .config import NAME, SQL, sql
+from .pool import execute, Pool, PooledMap, rollback
+from functools import partial
+from psycopg2 import connect, InterfaceError, OperationalError
+from psycopg2.extras import execute_values
+from uuid import uuid4
+
+PING = 'SELECT 1;'
 
 CREATE = '''CREATE TABLE IF NOT EXISTS {table}(
-uuid BINARY(16) NOT NULL,
+uuid BYTEA NOT NULL,
 time BIGINT NOT NULL,
 kind VARCHAR(255) NOT NULL,
-value BLOB NOT NULL,
-PRIMARY KEY(uuid, time DESC));'''.format(table=NAME)
+value BYTEA NOT NULL,
+PRIMARY KEY(uuid, time));'''.format(table=NAME)
 
 INSERT = '''INSERT INTO {table}(uuid, kind, time, value)
-VALUES (?, ?, ?, ?);'''.format(table=NAME)
+VALUES (%s, %s, %s, %s);'''.format(table=NAME)
+
+INSERT_MANY = '''INSERT INTO {table}(uuid, kind, time, value)
+VALUES %s;'''.format(table=NAME)
 
 SELECT = '''SELECT value from {table}
-WHERE uuid = ? AND time <= ?
+WHERE uuid = %s AND time <= %s
 ORDER BY time DESC LIMIT 1;'''.format(table=NAME)
 
+# latest value of many uuids at one time in a single statement
+SELECT_MANY = '''SELECT DISTINCT ON (uuid) uuid, value from {table}
+WHERE uuid = ANY(%s) AND time <= %s
+ORDER BY uuid, time DESC;'''.format(table=NAME)
+
+# versions are read in pages which resume after the last row so no connection is held between pages
+HISTORY = '''SELECT time, kind, value FROM {table}
+WHERE uuid = %s AND time >= %s AND time <= %s
+ORDER BY time DESC LIMIT %s;'''.format(table=NAME)
+
+SCAN = '''SELECT uuid, time, kind, value FROM {table}
+WHERE (uuid > %s OR (uuid = %s AND time < %s)) AND time >= %s AND time <= %s{{kind}}
+ORDER BY uuid, time DESC LIMIT %s;'''.format(table=NAME)
+
+SCAN_KIND = ' AND kind = %s'
+
+# versions are never updated in place so the table ordered by time is the change log
+CHANGES = '''SELECT uuid, time, kind, value FROM {table}
+WHERE (time > %s OR (time = %s AND uuid > %s)) AND time <= %s
+ORDER BY time, uuid LIMIT %s;'''.format(table=NAME)
+
+# uuids whose latest version at a time has the kind where the kind index finds the candidates
+LIST_KIND = '''SELECT uuid FROM {table} AS latest
+WHERE kind = %s AND uuid > %s AND time <= %s AND length(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= %s)
+ORDER BY uuid LIMIT %s;'''.format(table=NAME)
+
+COUNT_KIND = '''SELECT COUNT(*) FROM {table} AS latest
+WHERE kind = %s AND time <= %s AND length(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= %s);'''.format(table=NAME)
+
+# compaction drops the versions of each uuid at or before its time with one ranged delete
+DROP = '''DELETE FROM {table} USING (VALUES %s) AS obsolete(uuid, time)
+WHERE {table}.uuid = obsolete.uuid AND {table}.time <= obsolete.time;'''.format(table=NAME)
+
+CREATE_KIND = '''CREATE INDEX IF NOT EXISTS {table}_kind
+ON {table}(kind, uuid, time);'''.format(table=NAME)
+
+CREATE_CHANGES = '''CREATE INDEX IF NOT EXISTS {table}_time
+ON {table}(time, uuid);'''.format(table=NAME)
+
+# values are visible to pop once visible <= now and pop leases them by moving visible forward
+CREATE_QUEUE = '''CREATE TABLE IF NOT EXISTS {table}_queue(
+id BIGSERIAL PRIMARY KEY,
+kind VARCHAR(255) NOT NULL,
+value BYTEA NOT NULL,
+visible BIGINT NOT NULL DEFAULT 0,
+token BYTEA);
+CREATE INDEX IF NOT EXISTS {table}_queue_visible
+ON {table}_queue(visible, id);'''.format(table=NAME)
+
+ENQUEUE = '''INSERT INTO {table}_queue(kind, value)
+VALUES %s;'''.format(table=NAME)
+
+# SKIP LOCKED lets concurrent consumers lease different rows without waiting
+DEQUEUE = '''UPDATE {table}_queue SET visible = %s, token = %s
+WHERE id IN (
+SELECT id FROM {table}_queue
+WHERE visible <= %s
+ORDER BY visible, id LIMIT %s
+FOR UPDATE SKIP LOCKED)
+RETURNING id, value;'''.format(table=NAME)
+
+ACK = '''DELETE FROM {table}_queue
+WHERE id = %s AND token = %s;'''.format(table=NAME)
+
+# asyncpg uses numbered placeholders
+INSERT_ASYNC = '''INSERT INTO {table}(uuid, kind, time, value)
+VALUES ($1, $2, $3, $4);'''.format(table=NAME)
+
+SELECT_ASYNC = '''SELECT value from {table}
+WHERE uuid = $1 AND time <= $2
+ORDER BY time DESC LIMIT 1;'''.format(table=NAME)
 
-class PostgreSQLMap(Map):
+HISTORY_ASYNC = '''SELECT time, kind, value FROM {table}
+WHERE uuid = $1 AND time >= $2 AND time <= $3
+ORDER BY time DESC LIMIT $4;'''.format(table=NAME)
+
+SCAN_ASYNC = '''SELECT uuid, time, kind, value FROM {table}
+WHERE (uuid > $1 OR (uuid = $1 AND time < $2)) AND time >= $3 AND time <= $4 AND ($5::text IS NULL OR kind = $5)
+ORDER BY uuid, time DESC LIMIT $6;'''.format(table=NAME)
+
+LIST_KIND_ASYNC = '''SELECT uuid FROM {table} AS latest
+WHERE kind = $1 AND uuid > $2 AND time <= $3 AND length(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= $3)
+ORDER BY uuid LIMIT $4;'''.format(table=NAME)
+
+COUNT_KIND_ASYNC = '''SELECT COUNT(*) FROM {table} AS latest
+WHERE kind = $1 AND time <= $2 AND length(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= $2);'''.format(table=NAME)
+
+SELECT_MANY_ASYNC = '''SELECT DISTINCT ON (uuid) uuid, value from {table}
+WHERE uuid = ANY($1::bytea[]) AND time <= $2
+ORDER BY uuid, time DESC;'''.format(table=NAME)
+
+
+def connection(config: SQL):
+    db = connect(
+        dbname=NAME if config.database is None else config.database,
+        host=config.host,
+        password=config.password,
+        port=config.port,
+        user=config.user
+    )
+    # pooled connections autocommit so reads never hold a transaction open
+    db.autocommit = True
+    return db
+
+
+class PostgreSQLMap(PooledMap):
 
     def open(self):
-        self._db = connect(db=NAME)
-        self._cursor = self._db.cursor()
-        self._cursor.execute(CREATE)
-        self._db.commit()
+        config = sql() if self._config is None else self._config
+        self._pooled(
+            pool=Pool(
+                connect=partial(connection, config=config),
+                size=config.pool,
+                check=partial(execute, statement=PING),
+                reset=rollback,
+                errors=(InterfaceError, OperationalError)
+            ),
+            rows=config.rows,
+            millis=config.millis
+        )
+        self._read(lambda cursor: cursor.execute(CREATE))
+        if config.index:
+            self._read(lambda cursor: cursor.execute(CREATE_KIND))
+        if config.changes:
+            self._read(lambda cursor: cursor.execute(CREATE_CHANGES))
         return self
 
     def _put(self, key: Key, value: bytes) -> Key:
-        self._cursor.execute(
+        self._write(lambda cursor: cursor.execute(
             INSERT,
             (key.uuid.bytes_le, key.kind, key.time, value)
-        )
-        self._db.commit()
+        ))
         return key
 
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        self._write(lambda cursor: execute_values(
+            cursor,
+            INSERT_MANY,
+            [(key.uuid.bytes_le, key.kind, key.time, value)
+             for key, value in items]
+        ), rows=len(items))
+        return [key for key, _ in items]
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        def drop(cursor):
+            # one page so rowcount covers the whole batch
+            execute_values(cursor, DROP, [(uuid.bytes_le, time) for uuid, time in items], page_size=len(items))
+            return cursor.rowcount
+        return self._write(drop, rows=len(items))
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        return self._cursor.execute(
-            SELECT,
-            (uuid.bytes_le, time)
-        ).fetchone()[0]
+        def select(cursor):
+            cursor.execute(SELECT, (uuid.bytes_le, time))
+            return cursor.fetchone()
+        row = self._read(select)
+        return None if row is None else bytes(row[0])
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        def select(cursor):
+            cursor.execute(SELECT_MANY, ([uuid.bytes_le for uuid in uuids], time))
+            return cursor.fetchall()
+        values = {bytes(uuid): bytes(value) for uuid, value in self._read(select)}
+        return [values.get(uuid.bytes_le) for uuid in uuids]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        while True:
+            def select(cursor):
+                cursor.execute(HISTORY, (uuid.bytes_le, start, end, BATCH))
+                return cursor.fetchall()
+            rows = self._read(select)
+            for time, kind, value in rows:
+                yield Key(uuid=uuid, time=time, kind=kind), bytes(value)
+            if len(rows) < BATCH:
+                return
+            end = rows[-1][0] - 1
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        statement = SCAN.format(kind='' if kind is None else SCAN_KIND)
+        after, before = EMPTY, 0  # uuid and time of the last row read
+        while True:
+            def select(cursor):
+                cursor.execute(
+                    statement,
+                    [after, after, before, start, end] + ([] if kind is None else [kind]) + [BATCH]
+                )
+                return cursor.fetchall()
+            rows = self._read(select)
+            for uuid, time, row_kind, value in rows:
+                yield Key(uuid=UUID(bytes_le=bytes(uuid)), time=time, kind=row_kind), bytes(value)
+            if len(rows) < BATCH:
+                return
+            after, before = bytes(rows[-1][0]), rows[-1][1]
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        after, before = start, EMPTY  # time and uuid of the last row read
+        while True:
+            def select(cursor):
+                cursor.execute(CHANGES, (after, after, before, end, BATCH))
+                return cursor.fetchall()
+            rows = self._read(select)
+            for uuid, time, kind, value in rows:
+                yield Key(uuid=UUID(bytes_le=bytes(uuid)), time=time, kind=kind), bytes(value)
+            if len(rows) < BATCH:
+                return
+            after, before = rows[-1][1], bytes(rows[-1][0])
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        after = EMPTY
+        while True:
+            def select(cursor):
+                cursor.execute(LIST_KIND, (kind, after, time, time, BATCH))
+                return cursor.fetchall()
+            rows = self._read(select)
+            for uuid, in rows:
+                yield UUID(bytes_le=bytes(uuid))
+            if len(rows) < BATCH:
+                return
+            after = bytes(rows[-1][0])
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        def select(cursor):
+            cursor.execute(COUNT_KIND, (kind, time, time))
+            return cursor.fetchone()[0]
+        return self._read(select)
+
+
+class AsyncPostgreSQLMap(AsyncMap):
+
+    async def open(self):
+        # the async driver is only imported by processes which use async maps
+        from asyncpg import create_pool
+        config = sql() if self._config is None else self._config
+        # one connection per concurrent operation
+        self._pool = await create_pool(
+            database=NAME if config.database is None else config.database,
+            host=config.host,
+            password=config.password,
+            port=config.port,
+            user=config.user,
+            min_size=1,
+            max_size=self._limit
+        )
+        await self._pool.execute(CREATE)
+        if config.index:
+            await self._pool.execute(CREATE_KIND)
+        if config.changes:
+            await self._pool.execute(CREATE_CHANGES)
+        return self
+
+    async def _put(self, key: Key, value: bytes) -> Key:
+        await self._pool.execute(
+            INSERT_ASYNC,
+            key.uuid.bytes_le, key.kind, key.time, value
+        )
+        return key
+
+    async def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        async with self._pool.acquire() as db:
+            async with db.transaction():
+                await db.executemany(
+                    INSERT_ASYNC,
+                    [(key.uuid.bytes_le, key.kind, key.time, value)
+                     for key, value in items]
+                )
+        return [key for key, _ in items]
+
+    async def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        return await self._pool.fetchval(SELECT_ASYNC, uuid.bytes_le, time)
+
+    async def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        rows = await self._pool.fetch(
+            SELECT_MANY_ASYNC,
+            [uuid.bytes_le for uuid in uuids],
+            time
+        )
+        values = {row['uuid']: row['value'] for row in rows}
+        return [values.get(uuid.bytes_le) for uuid in uuids]
+
+    async def _history(self, uuid: UUID, start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        while True:
+            rows = await self._pool.fetch(HISTORY_ASYNC, uuid.bytes_le, start, end, BATCH)
+            for row in rows:
+                yield Key(uuid=uuid, time=row['time'], kind=row['kind']), row['value']
+            if len(rows) < BATCH:
+                return
+            end = rows[-1]['time'] - 1
+
+    async def _scan(self, kind: Optional[str], start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        after, before = EMPTY, 0  # uuid and time of the last row read
+        while True:
+            rows = await self._pool.fetch(SCAN_ASYNC, after, before, start, end, kind, BATCH)
+            for row in rows:
+                yield Key(uuid=UUID(bytes_le=row['uuid']), time=row['time'], kind=row['kind']), row['value']
+            if len(rows) < BATCH:
+                return
+            after, before = rows[-1]['uuid'], rows[-1]['time']
+
+    async def _list_kind(self, kind: str, time: int) -> AsyncIterator[UUID]:
+        after = EMPTY
+        while True:
+            rows = await self._pool.fetch(LIST_KIND_ASYNC, kind, after, time, BATCH)
+            for row in rows:
+                yield UUID(bytes_le=row['uuid'])
+            if len(rows) < BATCH:
+                return
+            after = rows[-1]['uuid']
+
+    async def _count_kind(self, kind: str, time: int) -> int:
+        return await self._pool.fetchval(COUNT_KIND_ASYNC, kind, time)
+
+    async def close(self):
+        await self._pool.close()
+        return self
+
+
+class PostgreSQLQueue(Queue):
+    """durable queue where popped values are leased until acked or the timeout passes"""
+
+    def open(self):
+        config = sql() if self._config is None else self._config
+        self._db = connect(
+            dbname=NAME if config.database is None else config.database,
+            host=config.host,
+            password=config.password,
+            port=config.port,
+            user=config.user
+        )
+        self._cursor = self._db.cursor()
+        self._cursor.execute(CREATE_QUEUE)
+        self._db.commit()
+        return self
+
+    def add(self, kind: str, value: bytes) -> bytes:
+        return self.add_many(items=[(kind, value)])[0]
+
+    def add_many(self, items: Iterable[Tuple[str, bytes]]) -> List[bytes]:
+        items = list(items)
+        execute_values(self._cursor, ENQUEUE, items)
+        self._db.commit()
+        return [value for _, value in items]
+
+    def pop(self) -> bytes:
+        values = self.pop_many(count=1)
+        if not values:
+            raise IndexError('pop from an empty queue')
+        return values[0]
+
+    def pop_many(self, count: int) -> List[bytes]:
+        token = uuid4().bytes
+        time = now()
+        self._cursor.execute(DEQUEUE, (time + self._timeout, token, time, count))
+        rows = self._cursor.fetchall()
+        self._db.commit()
+        return [Lease(bytes(value), id=(id, token)) for id, value in sorted(rows)]
+
+    def ack(self, lease: bytes) -> bool:
+        self._cursor.execute(ACK, lease.id)
+        self._db.commit()
+        return self._cursor.rowcount == 1
 
     def close(self):
         self._cursor.close()
@@ -1,20 +1,337 @@
-from .base import Key, Map, int_bytes, Optional, UUID
-from .config import NAME
-from redis import Redis as connect
+from .base import (AsyncIterator, AsyncMap, BATCH, bytes_int, EARLIEST, FORMAT, Iterable, Iterator, Key, LATEST, Lease,
+                   Map, int_bytes, List, Optional, Queue, Tuple, UTF8, UUID)
+from .config import kv, NAME
+from .pool import Pool, Stats
+from functools import partial
+from redis import exceptions, Redis as connect
+from redis.exceptions import ResponseError
+from uuid import uuid4
+
+ERRORS = (exceptions.ConnectionError, exceptions.TimeoutError)  # the connection is broken
+PORT = 6379
+
+STREAM = NAME + ':queue'
+GROUP = NAME
+
+# each uuid is a sorted set of versions scored by time so the latest at a time is one ZREVRANGEBYSCORE
+PREFIX = (NAME + ':map:').encode(UTF8)
+LENGTH = 2  # bytes holding the length of the kind in a version
+# change log of uuid bytes_le and the member of each version without its value scored by time
+CHANGES = NAME + ':changes'
+VERSION = NAME + ':format'  # FORMAT of the versions which the first map to open the database stores
+
+# ack only while the consumer that popped the value still holds the lease
+ACK = '''
+if #redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[2], ARGV[2], 1, ARGV[3]) == 0 then
+    return 0
+end
+redis.call('XDEL', KEYS[1], ARGV[2])
+return redis.call('XACK', KEYS[1], ARGV[1], ARGV[2])
+'''
+
+
+def name(uuid: UUID) -> bytes:
+    return PREFIX + uuid.bytes_le
+
+
+def score(time: int, exclusive: bool = False):
+    """sorted set bound for a time where the extremes are infinite"""
+    if time == EARLIEST:
+        return '-inf'
+    if time == LATEST:
+        return '+inf'
+    return '({time}'.format(time=time) if exclusive else time
+
+
+def member(key: Key, value: bytes) -> bytes:
+    """time first keeps members unique per version and kind follows its length"""
+    kind = key.kind.encode(UTF8)
+    return int_bytes(key.time) + len(kind).to_bytes(LENGTH, 'big') + kind + value
+
+
+def version(uuid: UUID, member: bytes) -> Tuple[Key, bytes]:
+    length = int.from_bytes(member[8:8 + LENGTH], 'big')
+    return Key(
+        uuid=uuid,
+        time=bytes_int(member[:8]),
+        kind=member[8 + LENGTH:8 + LENGTH + length].decode(UTF8)
+    ), member[8 + LENGTH + length:]
+
+
+def newest(members: list) -> Optional[bytes]:
+    """value of the only member a latest read returns"""
+    return version(uuid=None, member=members[0])[1] if members else None
+
+
+def add(pipeline, key: Key, value: bytes, versions: Optional[int], changes: Optional[int]):
+    """replace the version at the time and drop the oldest beyond versions and changes"""
+    pipeline.zremrangebyscore(name(key.uuid), key.time, key.time)
+    pipeline.zadd(name(key.uuid), {member(key=key, value=value): key.time})
+    if versions is not None:
+        pipeline.zremrangebyrank(name(key.uuid), 0, -versions - 1)
+    if changes is not None:
+        # members with equal times sort by uuid so the log is ordered like every other change stream
+        pipeline.zadd(CHANGES, {key.uuid.bytes_le + member(key=key, value=b''): key.time})
+        pipeline.zremrangebyrank(CHANGES, 0, -changes - 1)
+
+
+def stored(pipeline):
+    """store the FORMAT in a new database and read the one stored"""
+    pipeline.setnx(VERSION, FORMAT)
+    return pipeline.get(VERSION)
+
+
+def check(version: bytes):
+    """refuse databases written with a newer FORMAT"""
+    if int(version) > FORMAT:
+        raise ValueError('versions have format {version} which is newer than {format}'.format(
+            version=int(version), format=FORMAT))
+
+
+def latest(db, uuid: UUID, time: int):
+    return db.zrevrangebyscore(name(uuid), score(time), '-inf', start=0, num=1)
+
+
+def page(db, uuid: UUID, start: int, end: int, exclusive: bool = False):
+    return db.zrevrangebyscore(name(uuid), score(end, exclusive=exclusive), score(start), start=0, num=BATCH)
+
+
+def names(db, cursor: int):
+    return db.scan(cursor=cursor, match=PREFIX + b'*', count=BATCH)
+
+
+def change_time(change: bytes) -> int:
+    return bytes_int(change[16:24])
+
+
+def logged(db, start: int, end: int, skip: int):
+    """page of the change log from start where skip passes the changes at start already read"""
+    changes = db.zrangebyscore(CHANGES, score(start), score(end), start=skip, num=BATCH)
+    pipeline = db.pipeline(transaction=False)
+    for change in changes:
+        pipeline.zrangebyscore(name(UUID(bytes_le=change[:16])), change_time(change), change_time(change))
+    return changes, pipeline.execute() if changes else []
 
 
 class RedisMap(Map):
+    """thread safe map where each operation borrows a connection from a pool"""
 
     def open(self):
-        self._db = connect(db=NAME)
+        config = kv() if self._config is None else self._config
+        self._versions = config.versions
+        self._changelog = config.changes
+        self._pool = Pool(
+            connect=partial(
+                connect,
+                host=config.host,
+                port=PORT if config.port is None else config.port,
+                single_connection_client=True
+            ),
+            size=config.pool,
+            check=lambda db: db.ping(),
+            errors=ERRORS
+        )
+        try:
+            check(self._pool.run(lambda db: stored(db.pipeline(transaction=True)).execute()[1]))
+        except ValueError:
+            self._pool.close()
+            raise
         return self
 
     def _put(self, key: Key, value: bytes) -> Key:
-        self._db.set(key.uuid.bytes_le + int_bytes(-key.time), value)
-        return key
+        return self._put_many(items=[(key, value)])[0]
+
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        with self._pool.connection() as db:
+            pipeline = db.pipeline(transaction=True)
+            for key, value in items:
+                add(pipeline=pipeline, key=key, value=value, versions=self._versions, changes=self._changelog)
+            pipeline.execute()
+        return [key for key, _ in items]
 
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        return self._db.get(uuid.bytes_le + int_bytes(-time))
+        return newest(self._pool.run(partial(latest, uuid=uuid, time=time)))
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        def get_many(db):
+            pipeline = db.pipeline(transaction=False)
+            for uuid in uuids:
+                latest(db=pipeline, uuid=uuid, time=time)
+            return pipeline.execute()
+        return [newest(members) for members in self._pool.run(get_many)]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        exclusive = False
+        while True:
+            members = self._pool.run(partial(page, uuid=uuid, start=start, end=end, exclusive=exclusive))
+            for member in members:
+                yield version(uuid=uuid, member=member)
+            if len(members) < BATCH:
+                return
+            end, exclusive = bytes_int(members[-1][:8]), True
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        cursor = 0
+        seen = set()  # scan may return a key more than once such as while redis rehashes
+        while True:
+            cursor, keys = self._pool.run(partial(names, cursor=cursor))
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                for found, value in self._history(uuid=UUID(bytes_le=key[len(PREFIX):]), start=start, end=end):
+                    if kind is None or found.kind == kind:
+                        yield found, value
+            if cursor == 0:
+                return
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        if self._changelog is None:
+            yield from super()._changes(start=start, end=end)
+            return
+        skip = 0
+        while True:
+            changes, found = self._pool.run(partial(logged, start=start, end=end, skip=skip))
+            for change, members in zip(changes, found):
+                # versions trimmed or compacted since they were logged are skipped
+                if members:
+                    yield version(uuid=UUID(bytes_le=change[:16]), member=members[0])
+            if len(changes) < BATCH:
+                return
+            time = change_time(changes[-1])
+            same = sum(1 for change in changes if change_time(change) == time)
+            skip, start = skip + same if time == start else same, time
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        def drop(db):
+            pipeline = db.pipeline(transaction=False)
+            for uuid, time in items:
+                pipeline.zremrangebyscore(name(uuid), '-inf', time)
+            return sum(pipeline.execute())
+        return self._pool.run(drop)
+
+    def stats(self) -> Stats:
+        """pool counters to watch wait time and utilization"""
+        return self._pool.stats()
+
+    def close(self):
+        self._pool.close()
+        return self
+
+
+class AsyncRedisMap(AsyncMap):
+
+    async def open(self):
+        config = kv() if self._config is None else self._config
+        self._versions = config.versions
+        self._changelog = config.changes
+        # the async client is only imported by processes which use async maps
+        from redis.asyncio import Redis as connect_async
+        self._db = connect_async(host=config.host, port=PORT if config.port is None else config.port)
+        check((await stored(self._db.pipeline(transaction=True)).execute())[1])
+        return self
+
+    async def _put(self, key: Key, value: bytes) -> Key:
+        return (await self._put_many(items=[(key, value)]))[0]
+
+    async def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        pipeline = self._db.pipeline(transaction=True)
+        for key, value in items:
+            add(pipeline=pipeline, key=key, value=value, versions=self._versions, changes=self._changelog)
+        await pipeline.execute()
+        return [key for key, _ in items]
+
+    async def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        return newest(await latest(db=self._db, uuid=uuid, time=time))
+
+    async def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        pipeline = self._db.pipeline(transaction=False)
+        for uuid in uuids:
+            latest(db=pipeline, uuid=uuid, time=time)
+        return [newest(members) for members in await pipeline.execute()]
+
+    async def _history(self, uuid: UUID, start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        exclusive = False
+        while True:
+            members = await page(db=self._db, uuid=uuid, start=start, end=end, exclusive=exclusive)
+            for member in members:
+                yield version(uuid=uuid, member=member)
+            if len(members) < BATCH:
+                return
+            end, exclusive = bytes_int(members[-1][:8]), True
+
+    async def _scan(self, kind: Optional[str], start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        seen = set()  # scan may return a key more than once such as while redis rehashes
+        async for key in self._db.scan_iter(match=PREFIX + b'*', count=BATCH):
+            if key in seen:
+                continue
+            seen.add(key)
+            async for found, value in self._history(uuid=UUID(bytes_le=key[len(PREFIX):]), start=start, end=end):
+                if kind is None or found.kind == kind:
+                    yield found, value
+
+    async def close(self):
+        await self._db.aclose()
+        del(self._db)
+        return self
+
+
+class RedisQueue(Queue):
+    """durable queue on a stream where a consumer group leases values until they are acked"""
+
+    def open(self):
+        config = kv() if self._config is None else self._config
+        self._db = connect(host=config.host, port=PORT if config.port is None else config.port)
+        self._ack = self._db.register_script(ACK)
+        self._consumer = uuid4().hex
+        try:
+            self._db.xgroup_create(name=STREAM, groupname=GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        return self
+
+    def add(self, kind: str, value: bytes) -> bytes:
+        self._db.xadd(name=STREAM, fields={'kind': kind, 'value': value})
+        return value
+
+    def add_many(self, items: Iterable[Tuple[str, bytes]]) -> List[bytes]:
+        values = []
+        pipeline = self._db.pipeline(transaction=False)
+        for kind, value in items:
+            pipeline.xadd(name=STREAM, fields={'kind': kind, 'value': value})
+            values.append(value)
+        pipeline.execute()
+        return values
+
+    def pop(self) -> bytes:
+        values = self.pop_many(count=1)
+        if not values:
+            raise IndexError('pop from an empty queue')
+        return values[0]
+
+    def pop_many(self, count: int) -> List[bytes]:
+        # values leased longer than the timeout are claimed before new values are read
+        messages = self._db.xautoclaim(
+            name=STREAM,
+            groupname=GROUP,
+            consumername=self._consumer,
+            min_idle_time=self._timeout,
+            count=count
+        )[1]
+        if len(messages) < count:
+            for _, read in self._db.xreadgroup(
+                groupname=GROUP,
+                consumername=self._consumer,
+                streams={STREAM: '>'},
+                count=count - len(messages)
+            ):
+                messages.extend(read)
+        return [Lease(fields[b'value'], id=(id, self._consumer)) for id, fields in messages if fields]
+
+    def ack(self, lease: bytes) -> bool:
+        id, consumer = lease.id
+        return self._ack(keys=[STREAM], args=[GROUP, id, consumer]) == 1
 
     def close(self):
         del(self._db)
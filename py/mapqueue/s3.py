@@ -1,34 +1,109 @@
-from .base import Key, Map, Optional
-import boto3
+from .base import chunks, Iterator, Key, key_str, LATEST, LIMIT, List, Map, Optional, SEPARATOR, str_key, Tuple, UUID
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+CHUNK = 8 * 1024 * 1024  # values at least this large are sent in parts and read with parallel ranged gets
+# sorts after the separator so listing from prefix + time + AFTER skips every kind written at that time
+AFTER = chr(ord(SEPARATOR) + 1)
+DELETE_BATCH = 1000  # most keys delete_objects accepts in one request
+
+
+def prefix(uuid: UUID) -> str:
+    return uuid.hex + SEPARATOR
+
+
+def start_after(uuid: UUID, time: int) -> dict:
+    """list_objects_v2 arguments to list versions of the uuid written at or before time newest first"""
+    if time >= LATEST:
+        return {}
+    return {'StartAfter': '{prefix}{time:016x}{after}'.format(prefix=prefix(uuid), time=LATEST - time - 1, after=AFTER)}
 
 
 class S3Map(Map):
+    """objects named by key_str so the latest version at a time is the first object listed after it"""
 
     def open(self):
-        self._db = boto3.client(
-            's3',
-            aws_access_key_id=self._config.access,
-            aws_secret_access_key=self._config.secret,
-            region_name=self._config.region
+        self._db = self._config.s3
+        try:
+            self._db.head_bucket(Bucket=self._config.bucket)
+        except ClientError:
+            location = {} if self._config.region == 'us-east-1' else {
+                'CreateBucketConfiguration': {'LocationConstraint': self._config.region}}
+            self._db.create_bucket(Bucket=self._config.bucket, **location)
+        self._transfer = TransferConfig(
+            multipart_threshold=CHUNK,
+            multipart_chunksize=CHUNK,
+            max_concurrency=LIMIT
         )
-        if not self._db.get_bucket_location(Bucket=self._config.bucket):
-            self._db.create_bucket(Bucket=self._config.bucket)
+        # boto3 clients are thread safe so bulk reads and writes fan out on a pool
+        self._executor = ThreadPoolExecutor(max_workers=LIMIT)
         return self
 
+    def _download(self, listed: dict) -> bytes:
+        if listed['Size'] < CHUNK:
+            return self._db.get_object(Bucket=self._config.bucket, Key=listed['Key'])['Body'].read()
+        buffer = BytesIO()
+        self._db.download_fileobj(
+            Bucket=self._config.bucket, Key=listed['Key'], Fileobj=buffer, Config=self._transfer)
+        return buffer.getvalue()
+
     def _put(self, key: Key, value: bytes) -> Key:
-        self._db.put_object(
-            Bucket=self._config.bucket,
-            Key=str(key),
-            Body=value
-        )
+        if len(value) < CHUNK:
+            self._db.put_object(Bucket=self._config.bucket, Key=key_str(key), Body=value)
+        else:
+            self._db.upload_fileobj(
+                Fileobj=BytesIO(value), Bucket=self._config.bucket, Key=key_str(key), Config=self._transfer)
         return key
 
-    def _get(self, key: Key) -> Optional[bytes]:
-        return self._db.get(
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        return list(self._executor.map(lambda item: self._put(key=item[0], value=item[1]), items))
+
+    def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        listed = self._db.list_objects_v2(
             Bucket=self._config.bucket,
-            Key=str(key)
-        )
+            Prefix=prefix(uuid),
+            MaxKeys=1,
+            **start_after(uuid=uuid, time=time)
+        ).get('Contents')
+        return self._download(listed[0]) if listed else None
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        return list(self._executor.map(lambda uuid: self._get(uuid=uuid, time=time), uuids))
+
+    def _list(self, **kwargs) -> Iterator[Tuple[Key, dict]]:
+        for page in self._db.get_paginator('list_objects_v2').paginate(Bucket=self._config.bucket, **kwargs):
+            for listed in page.get('Contents', []):
+                yield str_key(listed['Key']), listed
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        for key, listed in self._list(Prefix=prefix(uuid), **start_after(uuid=uuid, time=end)):
+            if key.time < start:
+                return
+            yield key, self._download(listed)
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        for key, listed in self._list():
+            if start <= key.time <= end and (kind is None or key.kind == kind):
+                yield key, self._download(listed)
+
+    def _live(self, end: int) -> Iterator[Tuple[Key, bool]]:
+        # deletes are empty objects so listing alone tells them apart without downloading anything
+        for key, listed in self._list():
+            if key.time <= end:
+                yield key, listed['Size'] > 0
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        names = [
+            {'Key': listed['Key']} for uuid, time in items
+            for _, listed in self._list(Prefix=prefix(uuid), **start_after(uuid=uuid, time=time))
+        ]
+        for chunk in chunks(items=names, size=DELETE_BATCH):
+            self._db.delete_objects(Bucket=self._config.bucket, Delete={'Objects': chunk, 'Quiet': True})
+        return len(names)
 
     def close(self):
+        self._executor.shutdown(wait=True)
         del(self._db)
         return self
@@ -0,0 +1,208 @@
+# Sharded map which spreads uuids across maps with consistent hashing
+from .base import (BATCH, chunks, CODEC, Codec, EARLIEST, Iterator, Key, LATEST, LIMIT, List, Map, now, Optional,
+                   Tuple, UUID)
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from heapq import merge
+from itertools import chain
+from threading import RLock
+
+POINTS = 128  # points per shard on the ring so uuids spread evenly and a new shard takes a little from each
+
+
+def point(value: bytes) -> int:
+    """position on the ring which does not depend on how the uuid was generated"""
+    return int.from_bytes(blake2b(value, digest_size=8).digest(), 'big')
+
+
+class Ring(object):
+    """consistent hash ring where adding a shard only moves the uuids it takes over"""
+
+    def __init__(self, names: List[str], points: int = POINTS):
+        ring = sorted(
+            (point('{name}/{i}'.format(name=name, i=i).encode()), shard)
+            for shard, name in enumerate(names) for i in range(points)
+        )
+        self._points = [position for position, _ in ring]
+        self._shards = [shard for _, shard in ring]
+
+    def shard(self, uuid: UUID) -> int:
+        """index of the shard owning the uuid"""
+        i = bisect_right(self._points, point(uuid.bytes))
+        return self._shards[i % len(self._shards)]
+
+
+class ShardedMap(Map):
+    """routes each uuid to one of the maps so every version of a uuid lives on the same shard"""
+
+    def __init__(self, maps: List[Map], names: List[str] = None, points: int = POINTS, limit: int = LIMIT,
+                 codec: Codec = CODEC):
+        """names place shards on the ring and default to their positions so appending a shard keeps the rest"""
+        super().__init__(codec=codec)
+        names = [str(i) for i in range(len(maps))] if names is None else names
+        if len(names) != len(maps) or len(set(names)) != len(names):
+            raise ValueError('names needs a unique name per map')
+        self._maps = maps
+        self._names = names
+        self._points = points
+        self._ring = Ring(names=names, points=points)
+        self._limit = limit
+        self._lock = RLock()  # one shard is added at a time
+        self._executor = None
+
+    def open(self):
+        for map in self._maps:
+            map.open()
+        # bulk operations run on every shard they touch at once
+        self._executor = ThreadPoolExecutor(max_workers=self._limit)
+        return self
+
+    def flush(self):
+        self._fan_out(lambda shard: self._maps[shard].flush(), range(len(self._maps)))
+        return self
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            for map in self._maps:
+                map.close()
+        return self
+
+    def shard(self, uuid: UUID) -> Map:
+        """map owning the uuid"""
+        return self._maps[self._ring.shard(uuid)]
+
+    def _fan_out(self, call, shards) -> list:
+        """call with each shard index in parallel and return the results in the same order"""
+        shards = list(shards)
+        if len(shards) == 1:
+            return [call(shards[0])]
+        return list(self._executor.map(call, shards))
+
+    def _group(self, uuids: List[UUID]) -> dict:
+        """shard -> positions of the uuids it owns"""
+        groups = {}
+        for i, uuid in enumerate(uuids):
+            groups.setdefault(self._ring.shard(uuid), []).append(i)
+        return groups
+
+    def _put(self, key: Key, value: bytes) -> Key:
+        return self.shard(key.uuid)._put(key=key, value=value)
+
+    def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        return self.shard(uuid)._get(uuid=uuid, time=time)
+
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        groups = self._group(uuids=[key.uuid for key, _ in items])
+        self._fan_out(lambda shard: self._maps[shard]._put_many(items=[items[i] for i in groups[shard]]), groups)
+        return [key for key, _ in items]
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        groups = self._group(uuids=uuids)
+        found = self._fan_out(
+            lambda shard: self._maps[shard]._get_many(uuids=[uuids[i] for i in groups[shard]], time=time), groups)
+        values = [None] * len(uuids)
+        for positions, shard_values in zip(groups.values(), found):
+            for i, value in zip(positions, shard_values):
+                values[i] = value
+        return values
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self.shard(uuid)._history(uuid=uuid, start=start, end=end)
+
+    # migration leaves copies on the shards uuids moved from unless it drops them
+    # so reads across shards only take the uuids each shard owns on the current ring
+
+    def _owned(self, shard: int, versions: Iterator[Tuple[Key, bytes]]) -> Iterator[Tuple[Key, bytes]]:
+        """versions of the uuids the shard owns"""
+        ring = self._ring
+        return ((key, value) for key, value in versions if ring.shard(key.uuid) == shard)
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        # shards are scanned one after another so each uuid stays together
+        return chain.from_iterable(
+            self._owned(shard, map._scan(kind=kind, start=start, end=end)) for shard, map in enumerate(self._maps))
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        # each shard streams in time order so merging them keeps the order across shards
+        return merge(
+            *(self._owned(shard, map._changes(start=start, end=end)) for shard, map in enumerate(self._maps)),
+            key=lambda version: (version[0].time, version[0].uuid.bytes_le)
+        )
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        ring = self._ring
+        return chain.from_iterable(
+            (uuid for uuid in map._list_kind(kind=kind, time=time) if ring.shard(uuid) == shard)
+            for shard, map in enumerate(self._maps)
+        )
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        # shards count the uuids they own in parallel since their native counts would include copies
+        ring = self._ring
+        return sum(self._fan_out(
+            lambda shard: sum(
+                1 for uuid in self._maps[shard]._list_kind(kind=kind, time=time) if ring.shard(uuid) == shard),
+            range(len(self._maps))
+        ))
+
+    def compact(self, older_than: int, keep_versions: int = 1, batch: int = BATCH, pause: int = 0) -> int:
+        return sum(self._fan_out(
+            lambda shard: self._maps[shard].compact(
+                older_than=older_than, keep_versions=keep_versions, batch=batch, pause=pause),
+            range(len(self._maps))
+        ))
+
+    def _migrate(self, ring: Ring, start: int, batch: int) -> set:
+        """copy versions written from start on which ring assigns to another shard and return (shard, uuid) moved"""
+        moved = set()
+        for source, map in enumerate(self._maps):
+            versions = (
+                (key, value) for key, value in map._scan(kind=None, start=start, end=LATEST)
+                if ring.shard(key.uuid) != source
+            )
+            for items in chunks(items=versions, size=batch):
+                groups = {}
+                for key, value in items:
+                    groups.setdefault(ring.shard(key.uuid), []).append((key, value))
+                    moved.add((source, key.uuid))
+                self._fan_out(lambda shard: self._maps[shard]._put_many(items=groups[shard]), groups)
+        return moved
+
+    def _drop(self, moved: set, batch: int):
+        """delete moved uuids from the shards they were copied from"""
+        for source, map in enumerate(self._maps):
+            uuids = sorted(uuid for shard, uuid in moved if shard == source)
+            for items in chunks(items=[(uuid, LATEST) for uuid in uuids], size=batch):
+                map._drop_many(items=items)
+
+    def add_shard(self, map: Map, name: str = None, batch: int = BATCH, drop: bool = False) -> int:
+        """open a new shard, copy the history of the uuids it takes over and return how many moved"""
+        with self._lock:
+            name = str(len(self._maps)) if name is None else name
+            if name in self._names:
+                raise ValueError('shard {name} already exists'.format(name=name))
+            map.open()
+            start = now()
+            self._maps = self._maps + [map]
+            self._names = self._names + [name]
+            ring = Ring(names=self._names, points=self._points)
+            # writes during the first copy still go to the old owners so a second pass copies them after the swap
+            moved = self._migrate(ring=ring, start=EARLIEST, batch=batch)
+            self._ring = ring
+            moved |= self._migrate(ring=ring, start=start, batch=batch)
+            if drop:
+                self._drop(moved=moved, batch=batch)
+            return len({uuid for _, uuid in moved})
+
+    def rebalance(self, batch: int = BATCH, drop: bool = False) -> int:
+        """copy every version held by a shard which does not own it such as after names changed"""
+        with self._lock:
+            moved = self._migrate(ring=self._ring, start=EARLIEST, batch=batch)
+            if drop:
+                self._drop(moved=moved, batch=batch)
+            return len({uuid for _, uuid in moved})
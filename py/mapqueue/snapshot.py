@@ -0,0 +1,171 @@
+# Portable snapshots which stream every version of a map into a file and load it into any other map
+# python -m mapqueue dump sqlite:///mapqueue.db backup.mqs
+# python -m mapqueue load postgresql://localhost/mapqueue backup.mqs --processes 8
+from .base import BATCH, bytes_key, EARLIEST, Iterator, Key, key_bytes, LATEST, List, Map, Optional, Tuple
+from .registry import ALIASES, create
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import os
+from struct import Struct
+import sys
+from urllib.parse import urlsplit
+
+MAGIC = b'MQS\x01'  # snapshot format and version at the start of every file
+RECORD = Struct('>II')  # lengths of the key_bytes and the compressed value which follow
+BUFFER = 1024 * 1024  # bytes of file buffering
+SINGLE = ('local', 'lmdb', 'sqlite')  # schemes with one writer at a time which load in one process
+
+
+@contextmanager
+def snapshot(path: str, mode: str):
+    """binary file for the path or stdin and stdout for -"""
+    if path == '-':
+        f = sys.stdout.buffer if mode == 'wb' else sys.stdin.buffer
+        yield f
+        if mode == 'wb':
+            f.flush()
+        return
+    with open(path, mode, buffering=BUFFER) as f:
+        yield f
+
+
+def write(f, versions: Iterator[Tuple[Key, bytes]], batch: int = BATCH) -> int:
+    """write the header and one length prefixed record per version and return how many"""
+    f.write(MAGIC)
+    count = 0
+    records = []
+    for key, value in versions:
+        name = key_bytes(key)
+        records.append(RECORD.pack(len(name), len(value)) + name + value)
+        if len(records) == batch:
+            f.write(b''.join(records))
+            count += len(records)
+            records = []
+    f.write(b''.join(records))
+    return count + len(records)
+
+
+def read(f) -> Iterator[Tuple[Key, bytes]]:
+    """versions of a snapshot in the order they were written"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a mapqueue snapshot')
+    yield from records(f)
+
+
+def records(f, end: Optional[int] = None) -> Iterator[Tuple[Key, bytes]]:
+    """versions of the records from the position of the file up to the end offset or the end of the file"""
+    while end is None or f.tell() < end:
+        header = f.read(RECORD.size)
+        if not header:
+            return
+        if len(header) < RECORD.size:
+            raise ValueError('snapshot ends inside a record')
+        key_size, value_size = RECORD.unpack(header)
+        record = f.read(key_size + value_size)
+        if len(record) < key_size + value_size:
+            raise ValueError('snapshot ends inside a record')
+        yield bytes_key(memoryview(record)[:key_size]), record[key_size:]
+
+
+def dump(map: Map, path: str, kind: Optional[str] = None, start: int = EARLIEST, end: int = LATEST,
+         batch: int = BATCH) -> int:
+    """stream every version of the open map with start <= time <= end still compressed into a snapshot"""
+    with snapshot(path, 'wb') as f:
+        return write(f, map._scan(kind=kind, start=start, end=end), batch=batch)
+
+
+def put(map: Map, versions: Iterator[Tuple[Key, bytes]], batch: int = BATCH) -> int:
+    """write versions into the open map in batches and return how many"""
+    count = 0
+    items = []
+    for item in versions:
+        items.append(item)
+        if len(items) == batch:
+            map._put_many(items=items)
+            count += len(items)
+            items = []
+    if items:
+        map._put_many(items=items)
+    return count + len(items)
+
+
+def split(path: str, parts: int) -> List[int]:
+    """offsets of the records which start parts of about equal size followed by the size of the file"""
+    size = os.path.getsize(path)
+    offsets = []
+    with snapshot(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a mapqueue snapshot')
+        offset = len(MAGIC)
+        # only the record headers are read and the keys and values are skipped
+        while offset < size:
+            if offset >= size * len(offsets) // parts:
+                offsets.append(offset)
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                raise ValueError('snapshot ends inside a record')
+            key_size, value_size = RECORD.unpack(header)
+            offset += RECORD.size + key_size + value_size
+            f.seek(offset)
+    return offsets + [max(offset, size)]
+
+
+def load_part(url: str, path: str, start: int, end: int, batch: int) -> int:
+    """load the records between two offsets of a snapshot in a worker process with its own connection"""
+    with create(url) as map:
+        with snapshot(path, 'rb') as f:
+            f.seek(start)
+            return put(map, records(f, end=end), batch=batch)
+
+
+def load(map: Map, path: str, batch: int = BATCH) -> int:
+    """write every version of a snapshot into the open map and return how many"""
+    with snapshot(path, 'rb') as f:
+        return put(map, read(f), batch=batch)
+
+
+def load_url(url: str, path: str, processes: int = 1, batch: int = BATCH) -> int:
+    """load a snapshot into the map of url with processes each writing one part of the file"""
+    scheme = urlsplit(url).scheme
+    if processes == 1 or path == '-' or ALIASES.get(scheme, scheme) in SINGLE:
+        with create(url) as map:
+            return load(map, path, batch=batch)
+    # each process reads only its own records so the file is read once
+    offsets = split(path, parts=processes)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return sum(executor.map(
+            load_part, [url] * len(offsets[1:]), [path] * len(offsets[1:]), offsets[:-1], offsets[1:],
+            [batch] * len(offsets[1:])
+        ))
+
+
+def main(argv: list = None) -> int:
+    parser = ArgumentParser(prog='mapqueue', description='copy every version of a map through a snapshot file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    dumping = commands.add_parser('dump', help='write a snapshot of the map at url')
+    dumping.add_argument('url', help='map such as sqlite:///mapqueue.db')
+    dumping.add_argument('path', help='snapshot file or - for stdout')
+    dumping.add_argument('--kind', help='only versions of this kind')
+    dumping.add_argument('--start', type=int, default=EARLIEST, help='only versions at or after these milliseconds')
+    dumping.add_argument('--end', type=int, default=LATEST, help='only versions at or before these milliseconds')
+    dumping.add_argument('--batch', type=int, default=BATCH, help='versions per write')
+    loading = commands.add_parser('load', help='write a snapshot into the map at url')
+    loading.add_argument('url', help='map such as postgresql://localhost/mapqueue')
+    loading.add_argument('path', help='snapshot file or - for stdin')
+    loading.add_argument('--processes', type=int, default=1, help='processes each loading one part of the file')
+    loading.add_argument('--batch', type=int, default=BATCH, help='versions per bulk write')
+    arguments = parser.parse_args(argv)
+    if arguments.command == 'dump':
+        with create(arguments.url) as map:
+            count = dump(map, arguments.path, kind=arguments.kind, start=arguments.start, end=arguments.end,
+                         batch=arguments.batch)
+    else:
+        count = load_url(arguments.url, arguments.path, processes=arguments.processes, batch=arguments.batch)
+    print('{done} {count} versions'.format(
+        done='dumped' if arguments.command == 'dump' else 'loaded', count=count), file=sys.stderr)
+    return count
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
-from .base import Key, Map, Optional, UUID
-from .config import NAME
+from .base import (BATCH, chunks, EMPTY, GroupCommit, Iterable, Iterator, Key, Lease, List, Map, now, Optional, Queue,
+                   Tuple, UUID)
+from .config import NAME, sql
 from sqlite3 import connect
+from threading import RLock
+from uuid import uuid4
 
 # investigate using WITHOUT ROWID
 # https://www.sqlite.org/withoutrowid.html
@@ -18,31 +21,273 @@ SELECT = '''SELECT value from {table}
 WHERE uuid = ? AND time <= ?
 ORDER BY time DESC LIMIT 1;'''.format(table=NAME)
 
+# latest value of many uuids at one time in a single statement
+SELECT_MANY = '''SELECT uuid, value from {table} AS latest
+WHERE uuid IN ({{params}}) AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= ?);'''.format(table=NAME)
+
+# versions are read in pages which resume after the last row so no cursor stays open between pages
+HISTORY = '''SELECT time, kind, value FROM {table}
+WHERE uuid = ? AND time >= ? AND time <= ?
+ORDER BY time DESC LIMIT ?;'''.format(table=NAME)
+
+SCAN = '''SELECT uuid, time, kind, value FROM {table}
+WHERE (uuid > ? OR (uuid = ? AND time < ?)) AND time >= ? AND time <= ?{{kind}}
+ORDER BY uuid, time DESC LIMIT ?;'''.format(table=NAME)
+
+SCAN_KIND = ' AND kind = ?'
+
+# versions are never updated in place so the table ordered by time is the change log
+CHANGES = '''SELECT uuid, time, kind, value FROM {table}
+WHERE (time > ? OR (time = ? AND uuid > ?)) AND time <= ?
+ORDER BY time, uuid LIMIT ?;'''.format(table=NAME)
+
+# uuids whose latest version at a time has the kind where the kind index finds the candidates
+LIST_KIND = '''SELECT uuid FROM {table} AS latest
+WHERE kind = ? AND uuid > ? AND time <= ? AND length(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= ?)
+ORDER BY uuid LIMIT ?;'''.format(table=NAME)
+
+COUNT_KIND = '''SELECT COUNT(*) FROM {table} AS latest
+WHERE kind = ? AND time <= ? AND length(value) > 0 AND time = (
+SELECT MAX(time) FROM {table}
+WHERE uuid = latest.uuid AND time <= ?);'''.format(table=NAME)
+
+# compaction drops the versions of a uuid at or before a time with one ranged delete
+DROP = '''DELETE FROM {table}
+WHERE uuid = ? AND time <= ?;'''.format(table=NAME)
+
+CREATE_KIND = '''CREATE INDEX IF NOT EXISTS {table}_kind
+ON {table}(kind, uuid, time);'''.format(table=NAME)
+
+CREATE_CHANGES = '''CREATE INDEX IF NOT EXISTS {table}_time
+ON {table}(time, uuid);'''.format(table=NAME)
+
+# values are visible to pop once visible <= now and pop leases them by moving visible forward
+CREATE_QUEUE = '''CREATE TABLE IF NOT EXISTS {table}_queue(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+kind TEXT NOT NULL,
+value BLOB NOT NULL,
+visible INTEGER NOT NULL DEFAULT 0,
+token BLOB);'''.format(table=NAME)
+
+CREATE_QUEUE_INDEX = '''CREATE INDEX IF NOT EXISTS {table}_queue_visible
+ON {table}_queue(visible, id);'''.format(table=NAME)
+
+ENQUEUE = '''INSERT INTO {table}_queue(kind, value)
+VALUES (?, ?);'''.format(table=NAME)
+
+DEQUEUE = '''SELECT id, value FROM {table}_queue
+WHERE visible <= ?
+ORDER BY visible, id LIMIT ?;'''.format(table=NAME)
+
+LEASE = '''UPDATE {table}_queue SET visible = ?, token = ?
+WHERE id = ?;'''.format(table=NAME)
+
+ACK = '''DELETE FROM {table}_queue
+WHERE id = ? AND token = ?;'''.format(table=NAME)
+
+SYNCHRONOUS = 'PRAGMA synchronous = {level};'
+WAL = 'PRAGMA journal_mode = WAL;'
+
 
 class SQLiteMap(Map):
 
     def open(self):
-        self._db = connect(NAME + '.db')
+        config = sql() if self._config is None else self._config
+        # the group commit timer commits from its own thread
+        self._db = connect(
+            NAME + '.db' if config.database is None else config.database,
+            check_same_thread=False
+        )
         # prints commands for debugging
         # self._db.set_trace_callback(print)
         self._cursor = self._db.cursor()
+        if config.wal:
+            self._cursor.execute(WAL)
+        if config.synchronous is not None:
+            self._cursor.execute(SYNCHRONOUS.format(level=config.synchronous))
         self._cursor.execute(CREATE)
+        if config.index:
+            self._cursor.execute(CREATE_KIND)
+        if config.changes:
+            self._cursor.execute(CREATE_CHANGES)
         self._db.commit()
+        self._commit = GroupCommit(
+            commit=self._db.commit,
+            rows=config.rows,
+            millis=config.millis
+        )
         return self
 
     def _put(self, key: Key, value: bytes) -> Key:
-        self._cursor.execute(
-            INSERT,
-            (key.uuid.bytes_le, key.kind, key.time, value)
-        )
-        self._db.commit()
+        with self._commit.lock:
+            self._cursor.execute(
+                INSERT,
+                (key.uuid.bytes_le, key.kind, key.time, value)
+            )
+            self._commit.add()
         return key
 
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        with self._commit.lock:
+            self._cursor.executemany(
+                INSERT,
+                [(key.uuid.bytes_le, key.kind, key.time, value)
+                 for key, value in items]
+            )
+            self._commit.add(rows=len(items))
+        return [key for key, _ in items]
+
     def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
-        return self._cursor.execute(
-            SELECT,
-            (uuid.bytes_le, time)
-        ).fetchone()[0]
+        with self._commit.lock:
+            row = self._cursor.execute(
+                SELECT,
+                (uuid.bytes_le, time)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        values = {}
+        with self._commit.lock:
+            for chunk in chunks(items=[uuid.bytes_le for uuid in uuids], size=BATCH):
+                values.update(self._cursor.execute(
+                    SELECT_MANY.format(params=', '.join('?' * len(chunk))),
+                    chunk + [time]
+                ).fetchall())
+        return [values.get(uuid.bytes_le) for uuid in uuids]
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        while True:
+            with self._commit.lock:
+                rows = self._cursor.execute(HISTORY, (uuid.bytes_le, start, end, BATCH)).fetchall()
+            for time, kind, value in rows:
+                yield Key(uuid=uuid, time=time, kind=kind), value
+            if len(rows) < BATCH:
+                return
+            end = rows[-1][0] - 1
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        statement = SCAN.format(kind='' if kind is None else SCAN_KIND)
+        after, before = EMPTY, 0  # uuid and time of the last row read
+        while True:
+            with self._commit.lock:
+                rows = self._cursor.execute(
+                    statement,
+                    [after, after, before, start, end] + ([] if kind is None else [kind]) + [BATCH]
+                ).fetchall()
+            for uuid, time, row_kind, value in rows:
+                yield Key(uuid=UUID(bytes_le=uuid), time=time, kind=row_kind), value
+            if len(rows) < BATCH:
+                return
+            after, before = rows[-1][0], rows[-1][1]
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        after, before = start, EMPTY  # time and uuid of the last row read
+        while True:
+            with self._commit.lock:
+                rows = self._cursor.execute(CHANGES, (after, after, before, end, BATCH)).fetchall()
+            for uuid, time, kind, value in rows:
+                yield Key(uuid=UUID(bytes_le=uuid), time=time, kind=kind), value
+            if len(rows) < BATCH:
+                return
+            after, before = rows[-1][1], rows[-1][0]
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        after = EMPTY
+        while True:
+            with self._commit.lock:
+                rows = self._cursor.execute(LIST_KIND, (kind, after, time, time, BATCH)).fetchall()
+            for uuid, in rows:
+                yield UUID(bytes_le=uuid)
+            if len(rows) < BATCH:
+                return
+            after = rows[-1][0]
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        with self._commit.lock:
+            return self._cursor.execute(COUNT_KIND, (kind, time, time)).fetchone()[0]
+
+    def _drop_many(self, items: List[Tuple[UUID, int]]) -> int:
+        with self._commit.lock:
+            before = self._db.total_changes
+            self._cursor.executemany(DROP, [(uuid.bytes_le, time) for uuid, time in items])
+            dropped = self._db.total_changes - before
+            self._commit.add(rows=len(items))
+        return dropped
+
+    def flush(self):
+        self._commit.flush()
+        return self
+
+    def close(self):
+        self.flush()
+        self._cursor.close()
+        self._db.close()
+        return self
+
+
+class SQLiteQueue(Queue):
+    """durable queue where popped values are leased until acked or the timeout passes"""
+
+    def open(self):
+        config = sql() if self._config is None else self._config
+        # transactions are explicit so pop can take the write lock before it reads
+        self._db = connect(
+            NAME + '.db' if config.database is None else config.database,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._cursor = self._db.cursor()
+        if config.wal:
+            self._cursor.execute(WAL)
+        if config.synchronous is not None:
+            self._cursor.execute(SYNCHRONOUS.format(level=config.synchronous))
+        self._cursor.execute(CREATE_QUEUE)
+        self._cursor.execute(CREATE_QUEUE_INDEX)
+        self._lock = RLock()
+        return self
+
+    def add(self, kind: str, value: bytes) -> bytes:
+        return self.add_many(items=[(kind, value)])[0]
+
+    def add_many(self, items: Iterable[Tuple[str, bytes]]) -> List[bytes]:
+        items = list(items)
+        with self._lock:
+            self._cursor.execute('BEGIN')
+            self._cursor.executemany(ENQUEUE, items)
+            self._cursor.execute('COMMIT')
+        return [value for _, value in items]
+
+    def pop(self) -> bytes:
+        values = self.pop_many(count=1)
+        if not values:
+            raise IndexError('pop from an empty queue')
+        return values[0]
+
+    def pop_many(self, count: int) -> List[bytes]:
+        token = uuid4().bytes
+        time = now()
+        with self._lock:
+            # IMMEDIATE takes the write lock so consumers in other processes wait instead of double leasing
+            self._cursor.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._cursor.execute(DEQUEUE, (time, count)).fetchall()
+                self._cursor.executemany(
+                    LEASE,
+                    [(time + self._timeout, token, id) for id, _ in rows]
+                )
+                self._cursor.execute('COMMIT')
+            except BaseException:
+                self._cursor.execute('ROLLBACK')
+                raise
+        return [Lease(value, id=(id, token)) for id, value in rows]
+
+    def ack(self, lease: bytes) -> bool:
+        with self._lock:
+            return self._cursor.execute(ACK, lease.id).rowcount == 1
 
     def close(self):
         self._cursor.close()
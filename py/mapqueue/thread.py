@@ -0,0 +1,168 @@
+# Run blocking Map and Queue implementations from asyncio
+from .base import (AsyncIterator, AsyncMap, AsyncQueue, BATCH, chunks, Event, Iterable, Iterator, Key, LAG, LIMIT,
+                   List, Map, Optional, POLL, Queue, Tuple, UUID)
+from asyncio import get_running_loop, Queue as Batches
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread
+
+
+class ThreadContext(object):
+    """bounded thread pool shared by the wrappers below - use limit=1 for maps that are not thread safe"""
+
+    async def _run(self, method, **kwargs):
+        """call the blocking method on the pool while holding a slot"""
+        async with self._slot:
+            return await get_running_loop().run_in_executor(
+                self._executor,
+                partial(method, **kwargs)
+            )
+
+    def _iterate(self, iterator: Iterator) -> AsyncIterator:
+        """pull a blocking iterator a page at a time on the pool"""
+        return self._pages(pages=chunks(items=iterator))
+
+    async def _pages(self, pages: Iterator[list]) -> AsyncIterator:
+        """pull each list of a blocking iterator on the pool and yield its items"""
+        while True:
+            page = await self._run(partial(next, pages, None))
+            if page is None:
+                return
+            for item in page:
+                yield item
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=self._limit)
+        await self._run(self._context.open)
+        return self
+
+    async def flush(self):
+        await self._run(self._context.flush)
+        return self
+
+    async def close(self):
+        await self._run(self._context.close)
+        self._executor.shutdown(wait=True)
+        return self
+
+
+class ThreadMap(ThreadContext, AsyncMap):
+    """AsyncMap backed by any Map such as SQLiteMap or LMDBMap"""
+
+    def __init__(self, map: Map, limit: int = LIMIT):
+        super().__init__(limit=limit)
+        self._context = map
+
+    async def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        return await self._run(self._context._get, uuid=uuid, time=time)
+
+    async def _put(self, key: Key, value: bytes) -> Key:
+        return await self._run(self._context._put, key=key, value=value)
+
+    async def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        return await self._run(self._context._get_many, uuids=uuids, time=time)
+
+    async def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        return await self._run(self._context._put_many, items=items)
+
+    def _history(self, uuid: UUID, start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        return self._iterate(self._context._history(uuid=uuid, start=start, end=end))
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> AsyncIterator[Tuple[Key, bytes]]:
+        return self._iterate(self._context._scan(kind=kind, start=start, end=end))
+
+    def _list_kind(self, kind: str, time: int) -> AsyncIterator[UUID]:
+        return self._iterate(self._context._list_kind(kind=kind, time=time))
+
+    async def _count_kind(self, kind: str, time: int) -> int:
+        return await self._run(self._context._count_kind, kind=kind, time=time)
+
+    # public methods run on the pool as well so decompression stays off the event loop
+
+    async def exists(self, uuid: UUID, time: Optional[int] = None) -> bool:
+        return await self._run(self._context.exists, uuid=uuid, time=time)
+
+    async def read(self, uuid: UUID, time: Optional[int] = None) -> Optional[bytes]:
+        return await self._run(self._context.read, uuid=uuid, time=time)
+
+    async def update(self, uuid: UUID, kind: str, value: bytes) -> Key:
+        return await self._run(self._context.update, uuid=uuid, kind=kind, value=value)
+
+    async def read_many(self, uuids: Iterable[UUID], time: Optional[int] = None) -> List[Optional[bytes]]:
+        return await self._run(self._context.read_many, uuids=list(uuids), time=time)
+
+    async def update_many(self, items: Iterable[Tuple[UUID, str, bytes]]) -> List[Key]:
+        return await self._run(self._context.update_many, items=list(items))
+
+    async def count_kind(self, kind: str, time: Optional[int] = None) -> int:
+        # the AsyncMap version holds a slot around _count_kind which would wait forever for a second slot at limit=1
+        return await self._run(self._context.count_kind, kind=kind, time=time)
+
+    async def compact(self, older_than: int, keep_versions: int = 1, batch: int = BATCH, pause: int = 0) -> int:
+        """delete versions before older_than except the newest keep_versions of each uuid and return how many"""
+        return await self._run(
+            self._context.compact, older_than=older_than, keep_versions=keep_versions, batch=batch, pause=pause)
+
+    def history(self, uuid: UUID, start: Optional[int] = None,
+                end: Optional[int] = None) -> AsyncIterator[Tuple[Key, Optional[bytes]]]:
+        return self._iterate(self._context.history(uuid=uuid, start=start, end=end))
+
+    async def watch(self, since: Optional[int] = None, values: bool = True, lag: int = LAG, poll: int = POLL,
+                    stop: Optional[Event] = None) -> AsyncIterator[Tuple[Key, Optional[bytes]]]:
+        """watch follows changes on its own thread so a quiet stream holds no slot - set stop to end the thread"""
+        loop = get_running_loop()
+        batches = Batches()
+
+        def put(item) -> bool:
+            try:
+                loop.call_soon_threadsafe(batches.put_nowait, item)
+                return True
+            except RuntimeError:
+                # the event loop closed while the stream was still running
+                return False
+
+        def follow():
+            try:
+                for events in self._context._events(since=since, values=values, lag=lag, poll=poll, stop=stop):
+                    if not put(events):
+                        return
+                put(None)
+            except BaseException as e:
+                put(e)
+
+        Thread(target=follow, daemon=True).start()
+        while True:
+            events = await batches.get()
+            if events is None:
+                return
+            if isinstance(events, BaseException):
+                raise events
+            for event in events:
+                yield event
+
+    def scan(self, kind: Optional[str] = None, start: Optional[int] = None,
+             end: Optional[int] = None) -> AsyncIterator[Tuple[Key, Optional[bytes]]]:
+        return self._iterate(self._context.scan(kind=kind, start=start, end=end))
+
+
+class ThreadQueue(ThreadContext, AsyncQueue):
+    """AsyncQueue backed by any Queue such as LocalQueue"""
+
+    def __init__(self, queue: Queue, limit: int = LIMIT):
+        super().__init__(limit=limit)
+        self._context = queue
+
+    async def add(self, kind: str, value: bytes) -> bytes:
+        return await self._run(self._context.add, kind=kind, value=value)
+
+    async def pop(self) -> bytes:
+        return await self._run(self._context.pop)
+
+    async def ack(self, lease: bytes) -> bool:
+        return await self._run(self._context.ack, lease=lease)
+
+    async def add_many(self, items: Iterable[Tuple[str, bytes]]) -> List[bytes]:
+        return await self._run(self._context.add_many, items=list(items))
+
+    async def pop_many(self, count: int) -> List[bytes]:
+        return await self._run(self._context.pop_many, count=count)
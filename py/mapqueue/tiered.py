@@ -0,0 +1,184 @@
+# Tiered map which reads the fastest tier first and falls back to slower durable tiers
+from .base import (BATCH, CODEC, Codec, EARLIEST, Event, is_none, Iterable, Iterator, Key, List, Map, now, Optional,
+                   Tuple, UUID)
+from queue import Empty, Queue
+from threading import Thread
+
+KEEP_HISTORY = 'history'  # tier keeps every version written through the map and serves reads at any time
+KEEP_LATEST = 'latest'  # tier may keep only the latest version such as LocalMap(config=local(versions=1))
+QUEUE = 10000  # most writes waiting for the lower tiers before write behind blocks writers
+
+
+def first(map: Map, uuid: UUID, time: int) -> Optional[Tuple[Key, bytes]]:
+    """latest version of the uuid at time with its key so it can be copied into another tier"""
+    return next(iter(map._history(uuid=uuid, start=EARLIEST, end=time)), None)
+
+
+class TieredMap(Map):
+    """chain of maps from fastest to most durable where latest reads promote hits into every tier above them"""
+
+    def __init__(self, maps: List[Map], keep: List[str] = None, behind: bool = False, size: int = QUEUE,
+                 codec: Codec = CODEC):
+        """keep sets KEEP_HISTORY or KEEP_LATEST per tier and behind writes lower tiers from a queue of size"""
+        super().__init__(codec=codec)
+        keep = [KEEP_HISTORY] * len(maps) if keep is None else keep
+        if len(keep) != len(maps) or keep[-1] != KEEP_HISTORY:
+            raise ValueError('keep needs a policy per map and the last map must keep history')
+        self._maps = maps
+        self._keep = keep
+        self._behind = behind
+        self._size = size
+        self._error = None  # first failed write behind which raises from the next write or flush
+        self._queue = None
+        self._thread = None
+
+    def open(self):
+        for map in self._maps:
+            map.open()
+        if self._behind:
+            self._queue = Queue(maxsize=self._size)
+            self._thread = Thread(target=self._drain, daemon=True)
+            self._thread.start()
+        return self
+
+    def flush(self):
+        """wait for writes behind and make every tier durable"""
+        if self._queue is not None:
+            self._queue.join()
+        for map in reversed(self._maps):
+            map.flush()
+        self._raise()
+        return self
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._queue is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._queue = None
+                self._thread = None
+            for map in reversed(self._maps):
+                map.close()
+        return self
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _drain(self):
+        """copy writes into the lower tiers in batches until close queues None"""
+        while True:
+            items = [self._queue.get()]
+            while items[-1] is not None and len(items) < BATCH:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            closed = items[-1] is None
+            if closed:
+                items.pop()
+            if items:
+                try:
+                    for map in reversed(self._maps[1:]):
+                        map._put_many(items=items)
+                except Exception as e:
+                    self._error = self._error or e
+            for _ in range(len(items) + closed):
+                self._queue.task_done()
+            if closed:
+                return
+
+    def _put(self, key: Key, value: bytes) -> Key:
+        return self._put_many(items=[(key, value)])[0]
+
+    def _put_many(self, items: List[Tuple[Key, bytes]]) -> List[Key]:
+        self._raise()
+        if not self._behind:
+            # the most durable tier goes first so faster tiers are never ahead of it
+            for map in reversed(self._maps):
+                map._put_many(items=items)
+            return [key for key, _ in items]
+        self._maps[0]._put_many(items=items)
+        for item in items:
+            self._queue.put(item)
+        return [key for key, _ in items]
+
+    def _get(self, uuid: UUID, time: int) -> Optional[bytes]:
+        # tiers which only keep the latest version cannot answer reads in the past
+        for map, keep in zip(self._maps, self._keep):
+            if keep == KEEP_HISTORY:
+                value = map._get(uuid=uuid, time=time)
+                if value is not None:
+                    return value
+        return None
+
+    def _get_many(self, uuids: List[UUID], time: int) -> List[Optional[bytes]]:
+        values = [None] * len(uuids)
+        missing = list(range(len(uuids)))
+        for map, keep in zip(self._maps, self._keep):
+            if keep == KEEP_HISTORY and missing:
+                found = map._get_many(uuids=[uuids[i] for i in missing], time=time)
+                for i, value in zip(missing, found):
+                    values[i] = value
+                missing = [i for i in missing if values[i] is None]
+        return values
+
+    def _latest(self, uuids: List[UUID]) -> List[Optional[bytes]]:
+        """latest values from the fastest tier holding them which are copied into every tier above"""
+        time = now()
+        values = self._maps[0]._get_many(uuids=uuids, time=time)
+        for depth, map in enumerate(self._maps[1:], start=1):
+            for i, uuid in enumerate(uuids):
+                if values[i] is None:
+                    found = first(map=map, uuid=uuid, time=time)
+                    if found is not None:
+                        values[i] = found[1]
+                        # the latest version keeps a history tier correct since reads before it fall through
+                        for upper in self._maps[:depth]:
+                            upper._put(key=found[0], value=found[1])
+        return values
+
+    def _history(self, uuid: UUID, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._maps[-1]._history(uuid=uuid, start=start, end=end)
+
+    def _scan(self, kind: Optional[str], start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._maps[-1]._scan(kind=kind, start=start, end=end)
+
+    def _list_kind(self, kind: str, time: int) -> Iterator[UUID]:
+        return self._maps[-1]._list_kind(kind=kind, time=time)
+
+    def _count_kind(self, kind: str, time: int) -> int:
+        return self._maps[-1]._count_kind(kind=kind, time=time)
+
+    def exists(self, uuid: UUID, time: Optional[int] = None) -> bool:
+        return self.read(uuid=uuid, time=time) is not None
+
+    def read(self, uuid: UUID, time: Optional[int] = None) -> Optional[bytes]:
+        if time is not None:
+            return super().read(uuid=uuid, time=time)
+        value = self._latest(uuids=[uuid])[0]
+        return None if is_none(value) else self._codec.decode(value)
+
+    def read_many(self, uuids: Iterable[UUID], time: Optional[int] = None) -> List[Optional[bytes]]:
+        if time is not None:
+            return super().read_many(uuids=uuids, time=time)
+        return [None if is_none(value) else self._codec.decode(value) for value in self._latest(uuids=list(uuids))]
+
+    # the last tier sees every write so it carries the change stream where lag covers writes behind
+
+    def _changes(self, start: int, end: int) -> Iterator[Tuple[Key, bytes]]:
+        return self._maps[-1]._changes(start=start, end=end)
+
+    def _watch(self, since: int, lag: int, poll: int, stop: Optional[Event]) -> Iterator[List[Tuple[Key, bytes]]]:
+        return self._maps[-1]._watch(since=since, lag=lag, poll=poll, stop=stop)
+
+    def compact(self, older_than: int, keep_versions: int = 1, batch: int = BATCH, pause: int = 0) -> int:
+        # writes behind are waited for so no tier receives a version after it was compacted
+        self.flush()
+        return sum(
+            map.compact(older_than=older_than, keep_versions=keep_versions, batch=batch, pause=pause)
+            for map in self._maps
+        )
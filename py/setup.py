@@ -20,17 +20,21 @@ setup(
     author='Ariel Marcus',
     author_email='hi+mapqueue@arielmarcus.com',
     packages=['mapqueue'],
-    python_requires=">=3.4",
+    python_requires=">=3.7",
     install_requires=requirements,
-    extras_require={},
+    entry_points={
+        'console_scripts': ['mapqueue=mapqueue.snapshot:main'],
+    },
+    extras_require={
+        'lz4': ['lz4>=2.1'],
+        'test': ['moto>=5.0'],
+        'zstd': ['zstandard>=0.11'],
+    },
     classifiers=[
         'Development Status :: 1 - Planning',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Topic :: Database :: Front-Ends',
         'Operating System :: OS Independent',
@@ -1,19 +1,42 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import lmdb
 import os
+import subprocess
+import sys
+from threading import Event, Timer
 from time import sleep
+from urllib.parse import urlsplit
 from uuid import uuid4
 from zlib import compress
-from mapqueue.base import EMPTY, Key, now
-from mapqueue.config import aws, gcp
+import mapqueue
+from mapqueue.base import (BATCH, bytes_key, bytes_keys, change_order, dt_millis, EARLIEST, EMPTY, FORMAT, int_bytes,
+                           Key, key_bytes, key_str, keys_bytes, LAG, LATEST, now, ordered, Pickle, Retention, str_key)
+from moto import mock_aws
+from mapqueue.config import aws, gcp, kv, local, mdb, sql
+from mapqueue import bench, bloom, snapshot
+from mapqueue.feed import bytes_event, Feed
 from mapqueue.bigtable import BigTableMap
+from mapqueue.bloom import FilteredMap
+from mapqueue.cache import CachedMap, TTL
+from mapqueue.codec import Codec, DICTIONARIES, Lz4, register_dictionary, Zlib, Zstd
 from mapqueue.dynamodb import DynamoMap
-from mapqueue.lmdb import LMDBMap
+from mapqueue.lmdb import LMDBMap, LMDBQueue
 from mapqueue.local import LocalMap, LocalQueue
 from mapqueue.memcache import MemcacheMap
+from mapqueue.metrics import BACKEND, COMMIT, Histogram, prometheus, Sinks, Tracer
 from mapqueue.mysql import MySQLMap
-from mapqueue.postgres import PostgreSQLMap
-from mapqueue.redis import RedisMap
-from mapqueue.s3 import S3Map
-from mapqueue.sqlite import SQLiteMap
+from mapqueue.pool import Pool
+from mapqueue.registry import BACKENDS, configure
+from mapqueue.postgres import AsyncPostgreSQLMap, PostgreSQLMap, PostgreSQLQueue
+from mapqueue.redis import AsyncRedisMap, RedisMap, RedisQueue
+from mapqueue.s3 import CHUNK, S3Map
+from mapqueue.sharded import ShardedMap
+from mapqueue.sqlite import SQLiteMap, SQLiteQueue
+from mapqueue.thread import ThreadMap, ThreadQueue
+from mapqueue.tiered import KEEP_HISTORY, KEEP_LATEST, TieredMap
 
 TEN = 10000
 
@@ -51,6 +74,386 @@ def test_map(m):
     assert db.read(uuid=deleted.uuid, time=NOW) is None
     db.close()
 
+def test_map_many(m):
+    with m as db:
+        keys = db.create_many(items=[('car', b'bmw'), ('car', b'volvo'), ('boat', b'kayak')])
+        assert [key.kind for key in keys] == ['car', 'car', 'boat']
+        before = keys[0].time - 1
+        missing = uuid4()
+        uuids = [key.uuid for key in keys] + [missing]
+        assert db.read_many(uuids=uuids) == [b'bmw', b'volvo', b'kayak', None]
+        assert db.read_many(uuids=uuids, time=before) == [None, None, None, None]
+        sleep(0.01)
+        updated = db.update_many(items=[(keys[1].uuid, 'car', b'saab'), (keys[2].uuid, 'boat', None)])
+        assert [key.uuid for key in updated] == uuids[1:3]
+        assert db.read_many(uuids=uuids) == [b'bmw', b'saab', None, None]
+        assert db.read_many(uuids=uuids, time=keys[0].time) == [b'bmw', b'volvo', b'kayak', None]
+        # a uuid repeated in one batch gets a newer version per repeat
+        repeated = db.update_many(items=[(missing, 'car', b'audi'), (missing, 'car', b'fiat')])
+        assert repeated[1].time == repeated[0].time + 1
+        assert db.read(uuid=missing) == b'fiat'
+        assert db.read(uuid=missing, time=repeated[0].time) == b'audi'
+
+def test_group_commit(m, reader):
+    with reader as other, m as db:
+        pending = db.update(uuid=uuid4(), kind='hello', value=b'pending')
+        assert other.read(uuid=pending.uuid) is None
+        db.flush()
+        assert other.read(uuid=pending.uuid) == b'pending'
+        timed = db.update(uuid=uuid4(), kind='hello', value=b'timed')
+        assert other.read(uuid=timed.uuid) is None
+        sleep(0.5)
+        assert other.read(uuid=timed.uuid) == b'timed'
+        closed = db.update(uuid=uuid4(), kind='hello', value=b'closed')
+    with reader as other:
+        assert other.read(uuid=closed.uuid) == b'closed'
+
+def test_failed_write(m, reader):
+    # a write which fails in a group commit does not take the writes before it down with it
+    with reader as other, m as db:
+        kept = db.update(uuid=uuid4(), kind='hello', value=b'kept')
+        try:
+            db._put(key=kept, value=compress(b'duplicate'))
+            assert False
+        except AssertionError:
+            raise
+        except Exception:
+            pass
+        after = db.update(uuid=uuid4(), kind='hello', value=b'after')
+        db.flush()
+        assert other.read(uuid=kept.uuid) == b'kept'
+        assert other.read(uuid=after.uuid) == b'after'
+
+def test_failed_commit(m):
+    # a group whose commit fails on the timer thread raises from the next flush
+    with m as db:
+        db.update(uuid=uuid4(), kind='hello', value=b'lost')
+        commit, mapqueue.pool.COMMIT = mapqueue.pool.COMMIT, 'COMMIT LOST;'
+        try:
+            sleep(0.3)
+        finally:
+            mapqueue.pool.COMMIT = commit
+        try:
+            db.flush()
+            assert False
+        except AssertionError:
+            raise
+        except Exception:
+            pass
+        kept = db.update(uuid=uuid4(), kind='hello', value=b'kept')
+        db.flush()
+        assert db.read(uuid=kept.uuid) == b'kept'
+
+def test_pending_reads(m, reopened):
+    # maps which allow one connection per process read their own pending writes
+    with m as db:
+        old = db.update(uuid=uuid4(), kind='hello', value=b'old')
+        db.flush()
+        sleep(0.01)
+        new = db.update(uuid=old.uuid, kind='hello', value=b'new')
+        assert db.read(uuid=old.uuid) == b'new'
+        assert db.read(uuid=old.uuid, time=old.time) == b'old'
+        assert db.read_many(uuids=[old.uuid, uuid4()]) == [b'new', None]
+    with reopened as db:
+        assert db.read(uuid=new.uuid) == b'new'
+
+def test_history(m):
+    with m as db:
+        uuid, kind = uuid4(), uuid4().hex
+        keys = []
+        for car in [b'bmw', b'volvo', b'saab']:
+            keys.append(db.update(uuid=uuid, kind=kind, value=car))
+            sleep(0.01)
+        keys.append(db.delete(uuid=uuid))
+        other = db.create(kind=kind, value=b'audi')
+        assert list(db.history(uuid=uuid)) == list(zip(keys[::-1], [None, b'saab', b'volvo', b'bmw']))
+        assert [key for key, _ in db.history(uuid=uuid, start=keys[1].time, end=keys[2].time)] == keys[2:0:-1]
+        assert list(db.history(uuid=uuid4())) == []
+        assert sorted(key for key, _ in db.scan(kind=kind)) == sorted(keys[:3] + [other])
+        assert {key for key, _ in db.scan(start=keys[3].time)} >= {keys[3], other}
+        # more versions than one page
+        paged = Key(uuid=uuid4(), time=0, kind=uuid4().hex)
+        db._put_many(items=[(paged._replace(time=time), EMPTY) for time in range(1, BATCH + 2)])
+        assert [key.time for key, _ in db.history(uuid=paged.uuid)] == list(range(BATCH + 1, 0, -1))
+        assert len(list(db.scan(kind=paged.kind))) == BATCH + 1
+
+def test_kind(m):
+    with m as db:
+        kind = uuid4().hex
+        cars = db.create_many(items=[(kind, car) for car in [b'bmw', b'volvo', b'saab']])
+        sleep(0.01)
+        db.delete(uuid=cars[0].uuid)
+        db.update(uuid=cars[1].uuid, kind='boat', value=b'volvo')
+        after = db.create(kind=kind, value=b'audi')
+        assert set(db.list_kind(kind=kind)) == {cars[2].uuid, after.uuid}
+        assert set(db.list_kind(kind=kind, time=cars[0].time)) == {car.uuid for car in cars}
+        assert db.count_kind(kind=kind) == 2
+        assert db.count_kind(kind=kind, time=cars[0].time) == 3
+        assert list(db.list_kind(kind=uuid4().hex)) == []
+
+def test_lmdb_index(path):
+    # an environment written without the kinds index opens with it and fills it from the versions
+    with LMDBMap(config=mdb(path=path)) as db:
+        car = db.create(kind='car', value=b'saab')
+    with LMDBMap(config=mdb(path=path, index=True)) as db:
+        assert db.read(uuid=car.uuid) == b'saab'
+        assert list(db.list_kind(kind='car')) == [car.uuid]
+        assert list(db.scan()) == [(car, b'saab')]
+    # writes while the index is not asked for still reach it so a later open with the index counts them
+    with LMDBMap(config=mdb(path=path)) as db:
+        volvo = db.create(kind='car', value=b'volvo')
+    with LMDBMap(config=mdb(path=path, index=True)) as db:
+        assert db.count_kind(kind='car') == 2
+        assert set(db.list_kind(kind='car')) == {car.uuid, volvo.uuid}
+    # a queue with the same path keeps its own environment next to the map
+    with LMDBMap(config=mdb(path=path)) as db, LMDBQueue(config=mdb(path=path)) as queue:
+        queue.add(kind='car', value=b'volvo')
+        assert queue.pop() == b'volvo' and db.read(uuid=car.uuid) == b'saab'
+
+def test_lmdb_upgrade(path):
+    # versions written with little endian times before the format was stored are rewritten on open
+    uuid = uuid4()
+    env = lmdb.open(path)
+    with env.begin(write=True) as txn:
+        for time, value in [(1000, b'saab'), (2000, b'volvo')]:
+            little = (-time).to_bytes(length=8, byteorder='little', signed=True)
+            txn.put(uuid.bytes_le + little + b'car', compress(value))
+    env.close()
+    with LMDBMap(config=mdb(path=path)) as db:
+        assert db.read(uuid=uuid) == b'volvo'
+        assert db.read(uuid=uuid, time=1500) == b'saab'
+        assert [key.time for key, _ in db.history(uuid=uuid)] == [2000, 1000]
+    env = lmdb.open(path)
+    with env.begin(write=True) as txn:
+        txn.put(b'format', int_bytes(FORMAT + 1))
+    env.close()
+    try:
+        LMDBMap(config=mdb(path=path)).open()
+        assert False
+    except ValueError:
+        pass
+
+def test_cached_map(m):
+    with CachedMap(m, size=1024, ttl=50) as db:
+        hello = db.create(kind='hello', value=b'hello')
+        assert db.read(uuid=hello.uuid) == b'hello'
+        assert db.read(uuid=hello.uuid) == b'hello'
+        assert db.stats().hits == 1
+        sleep(0.01)
+        db.update(uuid=hello.uuid, kind='hello', value=b'world')
+        assert db.read(uuid=hello.uuid) == b'world'
+        assert db.read(uuid=hello.uuid, time=hello.time) == b'hello'
+        assert db.read_many(uuids=[hello.uuid], time=hello.time) == [b'hello']
+        sleep(0.1)
+        assert db.read(uuid=hello.uuid) == b'world'
+        stats = db.stats()
+        assert stats.hits == 2 and stats.misses == 4
+        for key in db.create_many(items=[('big', bytes(200)) for _ in range(10)]):
+            db.read(uuid=key.uuid)
+        stats = db.stats()
+        assert stats.evictions > 0 and stats.size <= 1024
+    # by default writes which bypass the cache are seen once the ttl passes
+    with CachedMap(m) as db:
+        hello = db.create(kind='hello', value=b'hello')
+        assert db.read(uuid=hello.uuid) == b'hello'
+        sleep(0.01)
+        m.update(uuid=hello.uuid, kind='hello', value=b'elsewhere')
+        assert db.read(uuid=hello.uuid) == b'hello'
+        sleep(TTL / 1000 + 0.1)
+        assert db.read(uuid=hello.uuid) == b'elsewhere'
+
+class Car(Pickle):
+    def __init__(self, make):
+        self.make = make
+
+def test_codecs(m):
+    samples = [('{"make": "car %d", "wheels": 4}' % i).encode() for i in range(100)]
+    dictionary = Zstd.train(samples=samples, size=1024)
+    with m as db:
+        legacy = db._put(key=Key(kind='legacy', uuid=uuid4(), time=now()), value=compress(b'legacy'))
+        assert db.read(uuid=legacy.uuid, time=legacy.time) == b'legacy'
+        for codec in [Codec(), Zlib(level=1), Zlib(level=9, threshold=64), Lz4(), Zstd(), Zstd(dictionary=dictionary)]:
+            db._codec = codec
+            keys = db.create_many(items=[('car', value) for value in samples[:3] + [bytes(1000)]])
+            assert db.read_many(uuids=[key.uuid for key in keys]) == samples[:3] + [bytes(1000)]
+            assert db.read(uuid=legacy.uuid, time=legacy.time) == b'legacy'
+        # values of a dictionary decode with any codec once the dictionary is registered
+        db._codec = Zlib()
+        assert db.read_many(uuids=[key.uuid for key in keys]) == samples[:3] + [bytes(1000)]
+        dictionary_id = register_dictionary(dictionary)
+        del DICTIONARIES[dictionary_id]
+        try:
+            db.read(uuid=keys[0].uuid)
+            assert False
+        except ValueError:
+            pass
+        assert register_dictionary(dictionary) == dictionary_id
+        assert db.read(uuid=keys[0].uuid) == samples[0]
+        car = Car(make='volvo').save(db)
+        assert car.read(db).make == 'volvo'
+        car.make = 'saab'
+        sleep(0.01)
+        assert car.save(db).read(db).make == 'saab'
+
+def test_prune(m):
+    NOW = now()
+    with m as db:
+        hello = uuid4()
+        for i, time in enumerate([NOW - 3 * TEN, NOW - 2 * TEN, NOW - TEN, NOW]):
+            db._put(key=Key(kind='hello', uuid=hello, time=time), value=compress(str(i).encode()))
+        assert db.read(uuid=hello, time=NOW) == b'3'
+        assert db.read(uuid=hello, time=NOW - TEN) == b'2'
+        assert db.read(uuid=hello, time=NOW - 2 * TEN) == b'1'
+        assert db.read(uuid=hello, time=NOW - 3 * TEN) is None
+        db._put(key=Key(kind='hello', uuid=hello, time=NOW - TEN // 2), value=compress(b'late'))
+        assert db.read(uuid=hello, time=NOW - 1) == b'late'
+        assert db.read(uuid=hello, time=NOW) == b'3'
+        assert db.read(uuid=hello, time=NOW - 2 * TEN) is None
+
+def test_compact(m):
+    NOW = now()
+    with m as db:
+        hello, gone = uuid4(), uuid4()
+        for i, time in enumerate([NOW - 3 * TEN, NOW - 2 * TEN, NOW - TEN]):
+            db._put(key=Key(kind='hello', uuid=hello, time=time), value=compress(str(i).encode()))
+        db._put(key=Key(kind='gone', uuid=gone, time=NOW - 2 * TEN), value=compress(b'gone'))
+        db._put(key=Key(kind='', uuid=gone, time=NOW - TEN), value=EMPTY)
+        assert db.compact(older_than=NOW - TEN // 2, batch=1) >= 4
+        # reads from the horizon on are unchanged
+        assert db.read(uuid=hello, time=NOW - TEN) == b'2'
+        assert [key.time for key, _ in db.history(uuid=hello)] == [NOW - TEN]
+        assert db.read(uuid=gone) is None
+        assert list(db.history(uuid=gone)) == []
+        db._put(key=Key(kind='hello', uuid=hello, time=NOW), value=compress(b'3'))
+        db.compact(older_than=NOW + 1, keep_versions=2)
+        assert [key.time for key, _ in db.history(uuid=hello)] == [NOW, NOW - TEN]
+        retention = Retention(map=db, age=0, millis=10).start()
+        sleep(0.1)
+        retention.stop()
+        assert retention.dropped >= 1
+        assert [key.time for key, _ in db.history(uuid=hello)] == [NOW]
+        assert db.read(uuid=hello) == b'3'
+
+def test_watch(m, q=None):
+    NOW = now()
+    with m as db:
+        hello, gone = uuid4(), uuid4()
+        db._put(key=Key(kind='hello', uuid=hello, time=NOW - TEN), value=compress(b'1'))
+        db._put(key=Key(kind='gone', uuid=gone, time=NOW - TEN), value=compress(b'gone'))
+        db._put(key=Key(kind='hello', uuid=hello, time=NOW), value=compress(b'2'))
+        db._put(key=Key(kind='', uuid=gone, time=NOW), value=EMPTY)
+        db.flush()
+        # changes come in time order with uuids ordered like their bytes_le at equal times
+        expected = sorted([
+            (NOW - TEN, hello.bytes_le, b'1'), (NOW - TEN, gone.bytes_le, b'gone'),
+            (NOW, hello.bytes_le, b'2'), (NOW, gone.bytes_le, None)
+        ])
+        stop = Event()
+        Timer(0.2, stop.set).start()
+        changes = [
+            (key.time, key.uuid.bytes_le, value)
+            for key, value in db.watch(since=NOW - TEN, lag=0, poll=10, stop=stop) if key.uuid in (hello, gone)
+        ]
+        assert changes == expected
+        stop = Event()
+        Timer(0.2, stop.set).start()
+        assert [
+            (key.kind, value) for key, value in db.watch(since=NOW, values=False, lag=0, poll=10, stop=stop)
+            if key.uuid == hello
+        ] == [('hello', None)]
+        if q is None:
+            return
+        with q as queue:
+            with Feed(map=db, queue=queue, since=NOW - TEN, lag=0, poll=10) as feed:
+                sleep(0.2)
+            assert feed.last is not None
+            events = [bytes_event(event) for event in queue]
+            assert [
+                (key.time, key.uuid.bytes_le, value) for key, value in events if key.uuid in (hello, gone)
+            ] == expected
+
+def test_bloom(m, path, other=None):
+    with FilteredMap(m, items=1000, rate=0.01, path=path) as db:
+        key = db.create(kind='hello', value=b'hello')
+        assert db.read(uuid=key.uuid) == b'hello'
+        assert db.exists(uuid=key.uuid)
+        never = [uuid4() for _ in range(1000)]
+        assert db.read_many(uuids=never) == [None] * len(never)
+        assert not db.exists(uuid=never[0])
+        stats = db.stats()
+        assert stats.hits >= 2 and stats.skips >= 950
+        saved = bloom.Bloom(bits=stats.bits, hashes=stats.hashes)
+    assert os.path.exists(path)
+    # the saved filter holds every uuid written through the map and the time it last caught up which was on open
+    found, time = bloom.load(path=path, bits=saved.bits, hashes=saved.hashes)
+    assert key.uuid in found and time <= key.time
+    assert bloom.load(path=path, bits=saved.bits + 8, hashes=saved.hashes)[0] is None
+    # writes made while the filter was closed are added when it opens from its file
+    with m as db:
+        late = db.create(kind='late', value=b'late')
+    with FilteredMap(m, items=1000, rate=0.01, path=path) as db:
+        assert db.read(uuid=key.uuid) == b'hello'
+        assert db.read(uuid=late.uuid) == b'late'
+        assert db.rebuild().read(uuid=late.uuid) == b'late'
+    if other is None:
+        return
+    # writes of another process while the filter is open are found after it reopens from its file
+    with FilteredMap(m, items=1000, rate=0.01, path=path) as db, other:
+        shared = other.create(kind='shared', value=b'shared')
+        sleep(LAG / 1000 + 0.1)
+    with FilteredMap(m, items=1000, rate=0.01, path=path) as db:
+        assert db.read(uuid=shared.uuid) == b'shared'
+    # and while it stays open once refresh milliseconds passed
+    with FilteredMap(m, items=1000, rate=0.01, refresh=50) as db, other:
+        assert db.read(uuid=shared.uuid) == b'shared'
+        sleep(0.1)
+        shared = other.create(kind='shared', value=b'refreshed')
+        sleep(0.1)
+        assert db.read(uuid=shared.uuid) == b'refreshed'
+
+def test_async_map(m):
+    async def run():
+        async with m as db:
+            hello = await db.create(kind='hello', value=b'hello')
+            assert await db.exists(uuid=hello.uuid)
+            assert await db.read(uuid=hello.uuid) == b'hello'
+            keys = await asyncio.gather(*[db.create(kind='car', value=car) for car in [b'bmw', b'volvo']])
+            assert await db.read_many(uuids=[key.uuid for key in keys]) == [b'bmw', b'volvo']
+            sleep(0.01)
+            await db.delete(uuid=hello.uuid)
+            assert not await db.exists(uuid=hello.uuid)
+            assert [value async for _, value in db.history(uuid=hello.uuid)] == [None, b'hello']
+            assert [key async for key, _ in db.scan(kind='car', start=keys[0].time)] != []
+            assert await db.count_kind(kind='hello', time=hello.time) >= 1
+    asyncio.run(run())
+
+def test_async_watch(m):
+    async def run():
+        async with m as db:
+            key = await db.create(kind='hello', value=b'hello')
+            stop = Event()
+            Timer(0.3, stop.set).start()
+
+            async def watched():
+                return [value async for changed, value in db.watch(since=key.time, lag=0, poll=10, stop=stop)
+                        if changed.uuid == key.uuid]
+
+            async def read():
+                # a quiet watch holds no slot so other operations still run with limit=1
+                await asyncio.sleep(0.05)
+                return await asyncio.wait_for(db.read(uuid=key.uuid), timeout=0.2)
+
+            assert await asyncio.gather(watched(), read()) == [[b'hello'], b'hello']
+    asyncio.run(run())
+
+def test_async_queue(q):
+    async def run():
+        async with q as queue:
+            expected = sorted([b'bmw', b'volvo'])
+            await asyncio.gather(*[queue.add(kind='car', value=car) for car in expected])
+            assert sorted([value async for value in queue]) == expected
+    asyncio.run(run())
+
 def test_queue(q):
     with q as queue:
         expected = sorted([b'bmw', b'volvo'])
@@ -74,15 +477,385 @@ def test_queue(q):
         assert value == expected[index]
     queue.close()
 
+def check_leases(queue, consumer):
+    expected = [b'audi', b'bmw', b'fiat', b'saab', b'volvo']
+    queue.add_many(items=[('car', car) for car in expected])
+    leased = queue.pop_many(count=3)
+    rest = consumer.pop_many(count=10)
+    assert sorted(leased + rest) == expected
+    assert consumer.pop_many(count=10) == []
+    for lease in leased:
+        assert queue.ack(lease)
+    sleep(0.2)
+    redelivered = queue.pop_many(count=10)
+    assert sorted(redelivered) == sorted(rest)
+    assert not consumer.ack(rest[0])
+    for lease in redelivered:
+        assert queue.ack(lease)
+    sleep(0.2)
+    assert queue.pop_many(count=10) == []
+
+def test_lease_queue(q, other=None):
+    # lmdb allows one environment per process so its second consumer is the same queue
+    with q as queue:
+        if other is None:
+            check_leases(queue=queue, consumer=queue)
+        else:
+            with other as consumer:
+                check_leases(queue=queue, consumer=consumer)
+
+class Connection(object):
+    """stand in for a database connection"""
+
+    def __init__(self):
+        self.closed = False
+        self.healthy = True
+
+    def check(self):
+        if not self.healthy:
+            raise ConnectionError('unhealthy')
+
+    def close(self):
+        self.closed = True
+
+def test_pool():
+    pool = Pool(connect=Connection, size=2, check=Connection.check, errors=(ConnectionError,), idle=0.0, timeout=0.05)
+    first, second = pool.acquire(), pool.acquire()
+    assert first is not second and pool.stats().in_use == 2
+    try:
+        pool.acquire()
+        assert False, 'pool is full'
+    except TimeoutError:
+        pass
+    Timer(0.01, pool.release, [first]).start()
+    assert pool.acquire() is first and pool.stats().waits == 2
+    pool.release(first)
+    first.healthy = False
+    replaced = pool.acquire()
+    assert replaced is not first and first.closed
+    pool.release(replaced)
+    try:
+        with pool.connection():
+            raise ConnectionError('broken')
+    except ConnectionError:
+        pass
+    stats = pool.stats()
+    assert stats.reconnects == 2 and stats.in_use == 1 and stats.idle == 0
+    calls = []
+    def flaky(connection):
+        calls.append(connection)
+        if len(calls) == 1:
+            raise ConnectionError('broken')
+        return connection
+    pool.release(second)
+    assert pool.run(flaky) is calls[1] and calls[0].closed
+    pool.close()
+
+def test_threads(m, threads=8, writes=20):
+    # one map instance shared by many threads
+    with m as db:
+        def work(_):
+            keys = [db.create(kind='thread', value=os.urandom(16)) for _ in range(writes)]
+            return all(db.read(uuid=key.uuid, time=key.time) is not None for key in keys)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            assert all(executor.map(work, range(threads)))
+
+def test_large(m, size=CHUNK + 1):
+    # values past the multipart threshold are uploaded in parts and read with ranged gets
+    with m as db:
+        value = os.urandom(size)
+        key = db.update(uuid=uuid4(), kind='blob', value=value)
+        sleep(0.01)
+        db.update(uuid=key.uuid, kind='blob', value=b'small')
+        assert db.read(uuid=key.uuid) == b'small'
+        assert db.read(uuid=key.uuid, time=key.time) == value
+
+def test_tiered(hot, cold):
+    with TieredMap(maps=[hot, cold], keep=[KEEP_LATEST, KEEP_HISTORY]) as db:
+        key = db.update(uuid=uuid4(), kind='hello', value=b'hello')
+        assert hot.read(uuid=key.uuid) == cold.read(uuid=key.uuid) == b'hello'
+        # hits in the cold tier are promoted into the hot tier
+        missed = cold.update(uuid=uuid4(), kind='hello', value=b'cold')
+        assert hot.read(uuid=missed.uuid) is None
+        assert db.read_many(uuids=[key.uuid, missed.uuid]) == [b'hello', b'cold']
+        assert hot.read(uuid=missed.uuid) == b'cold'
+        # reads in the past skip the hot tier which only keeps the latest version
+        sleep(0.01)
+        db.update(uuid=key.uuid, kind='hello', value=b'world')
+        assert db.read(uuid=key.uuid) == b'world'
+        assert db.read(uuid=key.uuid, time=key.time) == b'hello'
+        sleep(0.01)
+        db.delete(uuid=key.uuid)
+        assert not db.exists(uuid=key.uuid)
+    # the default keeps history in every tier and still promotes hits where reads before them fall through
+    with TieredMap(maps=[hot, cold]) as db:
+        missed = cold.update(uuid=uuid4(), kind='hello', value=b'before')
+        sleep(0.01)
+        cold.update(uuid=missed.uuid, kind='hello', value=b'after')
+        assert db.read(uuid=missed.uuid) == b'after'
+        assert hot.read(uuid=missed.uuid) == b'after'
+        assert db.read(uuid=missed.uuid, time=missed.time) == b'before'
+    with TieredMap(maps=[hot, cold], behind=True, size=2) as db:
+        keys = db.create_many(items=[('behind', str(i).encode()) for i in range(5)])
+        assert db.read_many(uuids=[key.uuid for key in keys]) == [str(i).encode() for i in range(5)]
+        db.flush()
+        assert cold.read_many(uuids=[key.uuid for key in keys]) == [str(i).encode() for i in range(5)]
+
+def test_sharded(m, added, another):
+    with m as db:
+        kind = uuid4().hex
+        keys = db.create_many(items=[(kind, str(i).encode()) for i in range(100)])
+        uuids = [key.uuid for key in keys]
+        values = [str(i).encode() for i in range(100)]
+        assert db.read_many(uuids=uuids) == values
+        owners = [db.shard(uuid) for uuid in uuids]
+        assert len({id(owner) for owner in owners}) == 3
+        # a fourth shard takes about a quarter of the uuids and the others keep theirs
+        moved = db.add_shard(added, drop=True)
+        assert 0 < moved < len(uuids) // 2
+        assert all(db.shard(uuid) in (owner, added) for uuid, owner in zip(uuids, owners))
+        assert sum(db.shard(uuid) is added for uuid in uuids) == moved
+        assert db.read_many(uuids=uuids) == values
+        assert [db.read(uuid=uuid) for uuid in uuids] == values
+        assert [value for _, value in db.history(uuid=uuids[0])] == [b'0']
+        assert db.count_kind(kind=kind) == len(uuids)
+        assert sum(1 for _ in db.scan(kind=kind)) == len(uuids)
+        # by default copies stay on the shards they moved from and reads across shards skip them
+        assert db.add_shard(another) > 0
+        assert db.count_kind(kind=kind) == len(uuids)
+        assert sum(1 for _ in db.scan(kind=kind)) == len(uuids)
+        assert sorted(db.list_kind(kind=kind)) == sorted(uuids)
+        assert db.read_many(uuids=uuids) == values
+
+def test_keys():
+    keys = [Key(uuid=uuid4(), time=time, kind=kind) for time, kind in [(now(), 'hello'), (-1, ''), (0, 'ünïcode')]]
+    assert [bytes_key(memoryview(encoded)) for encoded in keys_bytes(keys)] == keys
+    assert bytes_keys(key_bytes(key) for key in keys) == keys
+    assert [str_key(key_str(key)) for key in keys] == keys
+    assert abs(now() - dt_millis(datetime.now(timezone.utc))) < 1000
+    times = [now() for _ in range(10000)]
+    assert times == sorted(times)
+    # keys are tuples without a dict per instance
+    assert isinstance(keys[0], tuple) and not hasattr(keys[0], '__dict__')
+
+def test_ordered():
+    # changes of maps without a change log are sorted in runs which spill to files and merge
+    keys = [Key(uuid=uuid4(), time=time, kind='car') for time in [5, 1, 3, 1, 4, 2, 5, 0]]
+    versions = [(key, str(key.time).encode()) for key in keys]
+    assert list(ordered(versions, run=3)) == sorted(versions, key=change_order)
+    assert list(ordered(versions)) == sorted(versions, key=change_order)
+    assert list(ordered([], run=3)) == []
+
+def test_metrics(m):
+    histogram = Histogram()
+    spans = []
+    class Spans(object):
+        @contextmanager
+        def start_as_current_span(self, name, attributes=None):
+            spans.append(name)
+            yield
+    with m.instrument(Sinks(histogram, Tracer(Spans()))) as db:
+        key = db.create(kind='hello', value=b'hello' * 100)
+        assert db.read(uuid=key.uuid) == b'hello' * 100
+        db.flush()
+    assert spans == ['mapqueue.update', 'mapqueue.read']
+    assert histogram.count('update') == histogram.count('read') == histogram.count('get', BACKEND) == 1
+    assert histogram.count('flush', COMMIT) >= 1
+    raw, stored = histogram.bytes['encode']
+    assert raw == 500 and stored < raw
+    assert 'mapqueue_seconds_count{operation="read",phase="total"} 1' in prometheus(histogram)
+
+def test_open():
+    db = mapqueue.open('sqlite:///open.db?rows=10&index=true')
+    try:
+        assert isinstance(db, SQLiteMap)
+        assert db._config == sql(database='open.db', rows=10, index=True)
+        key = db.create(kind='car', value=b'bmw')
+        assert db.read(uuid=key.uuid) == b'bmw'
+    finally:
+        db.close()
+    with mapqueue.create('lmdb:///?rows=3', codec=Codec()) as db:
+        assert isinstance(db, LMDBMap) and db._config == mdb(rows=3)
+    with mapqueue.create('sqlite:///:memory:', queue=True) as q:
+        assert isinstance(q, SQLiteQueue)
+    # drivers are only imported by create so configs parse without them
+    assert configure(BACKENDS['postgres'], urlsplit('postgresql://me:p%40ss@db:5433/cars?pool=4')) == sql(
+        database='cars', user='me', password='p@ss', host='db', port=5433, pool=4)
+    assert configure(BACKENDS['redis'], urlsplit('redis://cache:6380?versions=3')) == kv(
+        host='cache', port=6380, versions=3)
+    assert configure(BACKENDS['local'], urlsplit('local://?versions=2&age=100')) == local(versions=2, age=100)
+    for url in ['nope://x', 'sqlite:///x.db?colour=red', 's3://bucket']:
+        try:
+            mapqueue.create(url, queue=url.startswith('s3'))
+            assert False
+        except ValueError:
+            pass
+
+def test_snapshot(m, url):
+    with m as db:
+        kind = uuid4().hex
+        keys = db.create_many(items=[(kind, str(i).encode()) for i in range(100)])
+        keys.append(db.delete(uuid=keys[0].uuid))
+        db.flush()
+        dumped = snapshot.dump(db, 'snapshot.mqs')
+        assert dumped >= len(keys)
+        versions = {key: value for key, value in db._scan(kind=None, start=EARLIEST, end=LATEST)}
+    # sqlite takes one writer at a time so the processes fall back to one
+    assert snapshot.load_url(url, 'snapshot.mqs', processes=2, batch=7) == dumped
+    # parts of the file hold every record once as the processes of other backends load them
+    offsets = snapshot.split('snapshot.mqs', parts=3)
+    assert len(offsets) == 4 and offsets[-1] == os.path.getsize('snapshot.mqs')
+    parts = 'sqlite:///parts.db'
+    assert sum(snapshot.load_part(parts, 'snapshot.mqs', start, end, 7)
+               for start, end in zip(offsets, offsets[1:])) == dumped
+    with mapqueue.create(parts) as copy:
+        assert {key: value for key, value in copy._scan(kind=None, start=EARLIEST, end=LATEST)} == versions
+    assert snapshot.main(['dump', url, 'copy.mqs', '--kind', kind]) == len(keys) - 1
+    with mapqueue.create(url) as copy:
+        # values arrive still compressed
+        assert {key: value for key, value in copy._scan(kind=None, start=EARLIEST, end=LATEST)} == versions
+        assert copy.read(uuid=keys[1].uuid) == b'1'
+        assert copy.read(uuid=keys[0].uuid) is None
+        assert copy.read(uuid=keys[0].uuid, time=keys[0].time) == b'0'
+    with open('snapshot.mqs', 'r+b') as f:
+        f.truncate(os.path.getsize('snapshot.mqs') - 1)
+    try:
+        snapshot.load_url(url, 'snapshot.mqs')
+        assert False
+    except ValueError:
+        pass
+
+def test_import_time():
+    # processes using local backends or the sync postgres map never load the cloud sdks or asyncio
+    imported = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import mapqueue.sqlite, mapqueue.lmdb, mapqueue.local, mapqueue.postgres'],
+        capture_output=True, check=True, text=True,
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    ).stderr
+    modules = {line.split('|')[-1].strip(): int(line.split('|')[1]) for line in imported.splitlines()[1:]}
+    assert not {'asyncio', 'asyncpg', 'boto3', 'botocore', 'google'} & set(modules)
+    assert modules['mapqueue.sqlite'] < 250000  # microseconds
+
+def test_bench():
+    results = bench.run(maps=['local'], queues=['local'], operations=50, keys=20)
+    assert [result.workload for result in results] == bench.WORKLOADS + ['queue-add', 'queue-pop']
+    for result in results:
+        assert result.operations == 50 and result.p50 <= result.p95 <= result.p99
+
 if __name__ == "__main__":
     # test_map(BigTableMap(config=gcp(keys='./keys/gcp.json')))
+    # test_map(BigTableMap(config=gcp(test=True)))
+    # test_map_many(BigTableMap(config=gcp(test=True)))
+    # test_group_commit(BigTableMap(config=gcp(test=True, rows=100, millis=100)), BigTableMap(config=gcp(test=True)))
+    # test_history(BigTableMap(config=gcp(test=True)))
+    # test_compact(BigTableMap(config=gcp(test=True)))
     # test_map(DynamoMap(config=aws(test=True)))
+    # test_map_many(DynamoMap(config=aws(test=True, consistent=True)))
+    # test_history(DynamoMap(config=aws(test=True)))
+    # test_kind(DynamoMap(config=aws(test=True, index=True)))
+    # test_compact(DynamoMap(config=aws(test=True, consistent=True)))
+    # test_watch(DynamoMap(config=aws(test=True, consistent=True, stream=True)))
     test_map(LMDBMap())
+    test_map_many(LMDBMap())
+    test_pending_reads(LMDBMap(config=mdb(rows=3, millis=50)), LMDBMap())
+    test_history(LMDBMap())
+    test_kind(LMDBMap())
+    test_kind(LMDBMap(config=mdb(index=True)))
+    test_compact(LMDBMap(config=mdb(index=True)))
+    test_lmdb_index('index.lmdb')
+    test_lmdb_upgrade('upgrade.lmdb')
+    test_watch(LMDBMap(), LMDBQueue())
+    test_bloom(LMDBMap(), 'bloom.lmdb.filter')
     test_map(LocalMap())
+    test_map_many(LocalMap())
+    test_prune(LocalMap(config=local(versions=3, age=TEN + TEN // 2)))
+    test_history(LocalMap())
+    test_history(CachedMap(LocalMap()))
+    test_compact(LocalMap(config=local(index=True)))
+    test_compact(CachedMap(LocalMap()))
+    test_watch(LocalMap(), LocalQueue())
+    test_watch(CachedMap(LocalMap()))
+    test_map(TieredMap(maps=[LocalMap(config=local(versions=1)), LocalMap()], keep=[KEEP_LATEST, KEEP_HISTORY]))
+    test_map_many(TieredMap(maps=[LocalMap(), SQLiteMap()], behind=True))
+    test_history(TieredMap(maps=[LocalMap(config=local(versions=1)), SQLiteMap()], keep=[KEEP_LATEST, KEEP_HISTORY]))
+    test_tiered(LocalMap(config=local(versions=1)), SQLiteMap())
+    test_compact(TieredMap(maps=[LocalMap(), SQLiteMap()], behind=True))
+    test_map(ShardedMap(maps=[LocalMap(), LocalMap(), LocalMap()]))
+    test_map_many(ShardedMap(maps=[LocalMap(), LocalMap(), LocalMap()]))
+    test_history(ShardedMap(maps=[LocalMap(), LocalMap(), LocalMap()]))
+    test_compact(ShardedMap(maps=[LocalMap(), LocalMap(), LocalMap()]))
+    test_sharded(ShardedMap(maps=[LocalMap(), LocalMap(), LocalMap()]), LocalMap(), LocalMap())
+    test_watch(ShardedMap(maps=[LocalMap(), LocalMap(), LocalMap()]))
+    test_kind(LocalMap())
+    test_kind(LocalMap(config=local(index=True)))
+    # LocalMap is not thread safe so it runs one operation at a time
+    test_async_map(ThreadMap(LocalMap(), limit=1))
+    test_async_watch(ThreadMap(LocalMap(), limit=1))
+    test_cached_map(LocalMap())
+    test_codecs(SQLiteMap())
+    test_pool()
     # test_map(MemcacheMap())
+    # test_threads(MemcacheMap())
     # test_map(MySQLMap())
+    # test_threads(MySQLMap())
+    # test_compact(MySQLMap())
+    # test_failed_write(MySQLMap(config=sql(rows=100, millis=100)), MySQLMap())
+    # test_failed_commit(MySQLMap(config=sql(rows=100, millis=100)))
+    # test_watch(MySQLMap(config=sql(changes=True)))
     # test_map(PostgreSQLMap())
+    # test_threads(PostgreSQLMap())
+    # test_group_commit(PostgreSQLMap(config=sql(rows=100, millis=100)), PostgreSQLMap())
+    # test_failed_write(PostgreSQLMap(config=sql(rows=100, millis=100)), PostgreSQLMap())
+    # test_failed_commit(PostgreSQLMap(config=sql(rows=100, millis=100)))
+    # test_compact(PostgreSQLMap())
+    # test_watch(PostgreSQLMap(config=sql(changes=True)), PostgreSQLQueue())
+    # test_async_map(AsyncPostgreSQLMap())
     # test_map(RedisMap())
-    # test_map(S3Map(config=aws(test=True)))
+    # test_map_many(RedisMap())
+    # test_history(RedisMap())
+    # test_kind(RedisMap())
+    # test_prune(RedisMap(config=kv(versions=3)))
+    # test_compact(RedisMap())
+    # test_watch(RedisMap(config=kv(changes=1000)), RedisQueue())
+    # test_bloom(RedisMap(config=kv(changes=1000)), 'bloom.redis.filter')
+    # test_threads(RedisMap())
+    # test_async_map(AsyncRedisMap())
+    with mock_aws():
+        test_map(S3Map(config=aws(test=True)))
+        test_map_many(S3Map(config=aws(test=True)))
+        test_history(S3Map(config=aws(test=True)))
+        test_kind(S3Map(config=aws(test=True)))
+        test_large(S3Map(config=aws(test=True, bucket='large')))
+        test_compact(S3Map(config=aws(test=True)))
     test_map(SQLiteMap())
-    test_queue(LocalQueue())
\ No newline at end of file
+    test_map_many(SQLiteMap())
+    test_history(SQLiteMap())
+    test_kind(SQLiteMap(config=sql(index=True)))
+    test_compact(SQLiteMap(config=sql(rows=10, millis=100)))
+    test_watch(SQLiteMap(config=sql(changes=True, rows=10, millis=100)), SQLiteQueue())
+    test_bloom(SQLiteMap(config=sql(changes=True)), 'bloom.sqlite.filter', SQLiteMap(config=sql(changes=True)))
+    test_group_commit(
+        SQLiteMap(config=sql(rows=100, millis=100, synchronous='NORMAL', wal=True)),
+        SQLiteMap(config=sql(wal=True))
+    )
+    test_failed_write(SQLiteMap(config=sql(rows=100, millis=100, wal=True)), SQLiteMap(config=sql(wal=True)))
+    test_async_map(ThreadMap(SQLiteMap()))
+    test_threads(SQLiteMap())
+    test_queue(LocalQueue())
+    test_async_queue(ThreadQueue(LocalQueue(), limit=1))
+    test_queue(SQLiteQueue())
+    test_lease_queue(SQLiteQueue(timeout=100), SQLiteQueue(timeout=100))
+    test_queue(LMDBQueue())
+    test_lease_queue(LMDBQueue(timeout=100))
+    # test_lease_queue(PostgreSQLQueue(timeout=100), PostgreSQLQueue(timeout=100))
+    # test_lease_queue(RedisQueue(timeout=100), RedisQueue(timeout=100))
+    # test_queue(RedisQueue(config=kv(host='localhost', port=6379)))
+    test_keys()
+    test_ordered()
+    test_metrics(LMDBMap())
+    test_metrics(SQLiteMap(config=sql(rows=10)))
+    test_open()
+    test_import_time()
+    test_snapshot(LMDBMap(), 'sqlite:///snapshot.db?rows=100')
+    test_bench()
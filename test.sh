@@ -12,4 +12,14 @@
 python py/test.py
 rm mapqueue.db
 rm data.mdb
-rm lock.mdb
\ No newline at end of file
+rm lock.mdb
+rm -r mapqueue-queue
+rm open.db
+rm snapshot.db
+rm snapshot.mqs
+rm copy.mqs
+rm bloom.lmdb.filter
+rm bloom.sqlite.filter
+rm -r upgrade.lmdb
+rm -r index.lmdb
+rm parts.db